@@ -17,6 +17,8 @@ The script can be run with the following command line arguments:
     --eval_criteria: Evaluation criteria
     --samples_size: Samples size
     --train_test_ratio: Train test ratio
+    --num_workers: Number of processes used for the dataset creation
+    --dataset_cache: Use the datasets cache
 
 """
 # Imports
@@ -42,6 +44,8 @@ simulation_commands = {
     "SAVE_TO_FILE": False,
     "CREATE_DATA": False,
     "SAVE_DATASET": True,
+    "USE_DATASET_CACHE": False,  # if True, datasets are looked up by their full parameters, and generated if missing
+    "DATASET_CACHE_BYTES": None,  # disk budget of the datasets cache, None for unlimited
     "LOAD_MODEL": False,
     "TRAIN_MODEL": True,
     "SAVE_MODEL": True,
@@ -113,6 +117,7 @@ training_params = {
     "true_range_test": None,  # if set, this range will be set to all samples in the train dataset
     "use_wandb": False,
     "simulation_name": None,
+    "num_workers": 1,  # number of processes used for the dataset creation
 }
 evaluation_params = {
     "models": {
@@ -187,6 +192,7 @@ def parse_arguments():
 
     parser.add_argument('-ss', '--samples_size', type=int, help='Samples size', default=None)
     parser.add_argument('-ttr', '--train_test_ratio', type=float, help='Train test ratio', default=None)
+    parser.add_argument('-cores', '--num_workers', type=int, help='Number of processes used for the dataset creation', default=None)
     parser.add_argument('-to', '--training_objective', type=str, help='Training objective; angle, range or angle, range.', default=None)
     parser.add_argument('-bs', '--batch_size', type=int, help='Batch size', default=None)
     parser.add_argument('-ep', '--epochs', type=int, help='Number of epochs', default=None)
@@ -204,6 +210,7 @@ def parse_arguments():
 
     parser.add_argument('-c', '--create', action="store_true", help='create a new dataset', default=simulation_commands["CREATE_DATA"])
     parser.add_argument('-sv', '--save', action='store_true', help="save dataset", default=simulation_commands["SAVE_DATASET"])
+    parser.add_argument('-cache', '--dataset_cache', action='store_true', help="use the datasets cache", default=simulation_commands["USE_DATASET_CACHE"])
 
     return parser.parse_args()
 
@@ -246,6 +253,8 @@ if __name__ == "__main__":
         training_params["samples_size"] = args.samples_size
     if args.train_test_ratio is not None:
         training_params["train_test_ratio"] = args.train_test_ratio
+    if args.num_workers is not None:
+        training_params["num_workers"] = args.num_workers
     if args.training_objective is not None:
         if args.training_objective.startswith("angle,range"):
             training_params["training_objective"] = "angle, range"
@@ -275,6 +284,7 @@ if __name__ == "__main__":
 
     simulation_commands["CREATE_DATA"] = args.create
     simulation_commands["SAVE_DATASET"] = args.save
+    simulation_commands["USE_DATASET_CACHE"] = args.dataset_cache
 
     start = time.time()
     loss = run_simulation(simulation_commands=simulation_commands,
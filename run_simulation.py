@@ -97,6 +97,22 @@ def __run_simulation(**kwargs):
     print("---------- New Simulation ----------")
     print("------------------------------------")
 
+    if SIMULATION_COMMANDS.get("USE_DATASET_CACHE", False):
+        # look up the datasets by their full parameters, generate only the missing ones
+        dataset_cache = DatasetCache(datasets_path / "cache", max_bytes=SIMULATION_COMMANDS.get("DATASET_CACHE_BYTES"))
+        dataset_seed = TRAINING_PARAMS.get("dataset_seed", 42)
+        if train_model:
+            train_dataset = dataset_cache.get_or_create(
+                system_model_params, samples_size, seed=dataset_seed,
+                true_doa=TRAINING_PARAMS["true_doa_train"], true_range=TRAINING_PARAMS["true_range_train"],
+                num_workers=TRAINING_PARAMS.get("num_workers", 1))
+        if evaluate_mode:
+            generic_test_dataset = dataset_cache.get_or_create(
+                system_model_params, int(train_test_ratio * samples_size), seed=dataset_seed + 1,
+                true_doa=TRAINING_PARAMS["true_doa_test"], true_range=TRAINING_PARAMS["true_range_test"],
+                num_workers=TRAINING_PARAMS.get("num_workers", 1))
+        load_data = create_data = False
+
     if load_data:
         if train_model:
             try:
@@ -146,6 +162,7 @@ def __run_simulation(**kwargs):
                 true_doa=TRAINING_PARAMS["true_doa_train"],
                 true_range=TRAINING_PARAMS["true_range_train"],
                 phase="train",
+                num_workers=TRAINING_PARAMS.get("num_workers", 1),
             )
             print(f"Create the data took {time.time() - start} sec")
         if evaluate_mode:
@@ -158,6 +175,7 @@ def __run_simulation(**kwargs):
                 true_doa=TRAINING_PARAMS["true_doa_test"],
                 true_range=TRAINING_PARAMS["true_range_test"],
                 phase="test",
+                num_workers=TRAINING_PARAMS.get("num_workers", 1),
             )
 
     if train_model:
@@ -195,6 +213,7 @@ def __run_simulation(**kwargs):
         if isinstance(system_model_params.M, int):
             generic_test_dataset = torch.utils.data.DataLoader(generic_test_dataset,
                                                                 batch_size=100,
+                                                                collate_fn=collate_fn,
                                                                 shuffle=False)
         else:
             batch_sampler_test = SameLengthBatchSampler(generic_test_dataset, batch_size=100)
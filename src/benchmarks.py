@@ -0,0 +1,603 @@
+"""Subspace-Net
+Details
+----------
+Name: benchmarks.py
+
+Purpose:
+--------
+This script defines timing benchmarks for the data pipeline and the estimation methods:
+    * benchmark_dataset_backends: Compares the batch loading time of the HDF5 and the memory mapped backends.
+    * benchmark_autocorrelation_lags: Compares autocorrelation_lags with the former per-lag einsum pre-processing.
+    * benchmark_music_spectrum: Compares the formulations of the MUSIC inverse spectrum, and the automatic choice.
+    * benchmark_grid_search: Compares the coarse to fine peak search of MUSIC and the Beamformer with the dense one.
+    * benchmark_root_music: Compares the batched Root-MUSIC polynomial pipeline with the per-diagonal and per-sample loops.
+    * benchmark_fft_spectrum: Compares the FFT far field spectrum of MUSIC and the Beamformer with the direct one.
+    * benchmark_near_field_fft_spectrum: Compares the FFT near field spectrum of MUSIC and the Beamformer with the
+        direct one.
+    * benchmark_unitary_methods: Compares the real-valued Unitary MUSIC, ESPRIT and Root-MUSIC with the complex ones.
+    * benchmark_partial_eigensolver: Compares the partial eigensolver of the subspace methods with the full eigh, for
+        large arrays.
+    * benchmark_subspace_tracker: Compares the per-hop time of the streaming subspace tracker with the recomputation
+        of the sliding window covariance and its eigendecomposition.
+
+The benchmarks can be run from the project directory by:
+    python -m src.benchmarks
+"""
+
+# Imports
+import time
+import tempfile
+import itertools
+from copy import deepcopy
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from src.data_handler import TimeSeriesDataset, create_dataset, collate_fn
+from src.signal_creation import Samples
+from src.system_model import SystemModel, SystemModelParams
+from src.utils import autocorrelation_lags, sample_covariance, sum_of_diags_torch, find_roots_torch, \
+    roots_closest_unit_circle
+from src.methods_pack.music import MUSIC, UnitaryMUSIC, SPECTRUM_FORMULATIONS, select_spectrum_formulation, \
+    tiled_inverse_spectrum
+from src.methods_pack.beamformer import Beamformer
+from src.methods_pack.esprit import ESPRIT, UnitaryESPRIT
+from src.methods_pack.root_music import RootMusic, UnitaryRootMusic
+from src.methods_pack.subspace_method import eigen_cache, _sorted_eigh, _sorted_unitary_eigh, _partial_eigh
+from src.methods_pack.subspace_tracker import SubspaceTracker
+
+
+def _time_dataloader(dataset: TimeSeriesDataset, batch_size: int, num_batches: int, num_workers: int = 0) -> float:
+    """Returns the average time, in seconds, of loading a random batch through a DataLoader."""
+    sampler = torch.utils.data.RandomSampler(dataset, num_samples=batch_size * num_batches)
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, sampler=sampler,
+                                             collate_fn=collate_fn, num_workers=num_workers)
+    start = time.perf_counter()
+    for _ in dataloader:
+        pass
+    return (time.perf_counter() - start) / num_batches
+
+
+def benchmark_dataset_backends(dataset: TimeSeriesDataset, batch_sizes: tuple = (32, 128, 512, 1024),
+                               num_batches: int = 10, num_workers: int = 0) -> dict:
+    """
+    Saves the dataset in the HDF5 layout and in the memory mapped layout, and compares the time of loading
+    random batches of several sizes from each one.
+
+    Args:
+    -----
+        dataset (TimeSeriesDataset): The dataset to benchmark.
+        batch_sizes (tuple, optional): The batch sizes to test. Defaults to (32, 128, 512, 1024).
+        num_batches (int, optional): The number of batches loaded for each measurement. Defaults to 10.
+        num_workers (int, optional): The number of DataLoader workers. Defaults to 0.
+
+    Returns:
+    --------
+        dict: The average time per batch, in seconds, for each backend and batch size.
+    """
+    results = {"h5": {}, "memmap": {}}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        h5_path, memmap_path = Path(tmp_dir) / "dataset.h5", Path(tmp_dir) / "dataset.npy"
+        dataset.save(h5_path)
+        dataset.save_memmap(memmap_path)
+        backends = {"h5": TimeSeriesDataset(None, None, None).load(h5_path),
+                    "memmap": TimeSeriesDataset(None, None, None).load(memmap_path)}
+        for batch_size in batch_sizes:
+            for name, backend in backends.items():
+                results[name][batch_size] = _time_dataloader(backend, batch_size, num_batches, num_workers)
+            print(f"batch size {batch_size}: h5 {results['h5'][batch_size] * 1e3:.2f} ms, "
+                  f"memmap {results['memmap'][batch_size] * 1e3:.2f} ms")
+        for backend in backends.values():
+            backend.close()
+    return results
+
+
+def _autocorrelation_lags_loop(x: torch.Tensor, tau: int) -> torch.Tensor:
+    """The former SubspaceNet pre-processing, one einsum per lag, kept as the reference of the benchmark."""
+    batch_size, N, T = x.shape
+    Rx_tau = torch.zeros(batch_size, tau, 2 * N, N, device=x.device)
+    center_x = x - torch.mean(x, dim=-1, keepdim=True)
+    for i in range(tau):
+        x1 = center_x[:, :, :T - i].to(torch.complex128)
+        x2 = torch.conj(center_x[:, :, i:]).transpose(1, 2).to(torch.complex128)
+        Rx_lag = torch.einsum("BNT, BTM -> BNM", x1, x2) / (T - i - 1)
+        Rx_tau[:, i, :, :] = torch.cat((torch.real(Rx_lag), torch.imag(Rx_lag)), dim=1)
+    return Rx_tau
+
+
+def _time_function(function, *args, repeats: int = 5, **kwargs) -> float:
+    """Returns the best time, in seconds, of repeats calls of the function, after a warm up call."""
+    function(*args, **kwargs)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def benchmark_autocorrelation_lags(sensors: tuple = (15, 32, 64), snapshots: tuple = (100, 1000),
+                                   taus: tuple = (8, 16), batch_size: int = 64, repeats: int = 5) -> dict:
+    """
+    Compares the time of the former per-lag einsum pre-processing, and of autocorrelation_lags with its lag products
+    in double and single precision, on random complex samples of each size. Both loop over the lags, and both
+    return float32 matrices.
+
+    Args:
+    -----
+        sensors (tuple, optional): The numbers of sensors N. Defaults to (15, 32, 64).
+        snapshots (tuple, optional): The numbers of snapshots T. Defaults to (100, 1000).
+        taus (tuple, optional): The numbers of lags. Defaults to (8, 16).
+        batch_size (int, optional): The batch size. Defaults to 64.
+        repeats (int, optional): The number of timed calls of each function. Defaults to 5.
+
+    Returns:
+    --------
+        dict: The time, in seconds, of the "loop", "complex128" and "complex64" versions for each (N, T, tau).
+    """
+    results = {}
+    for N, T, tau in itertools.product(sensors, snapshots, taus):
+        x = torch.randn(batch_size, N, T, dtype=torch.complex128)
+        results[(N, T, tau)] = {
+            "loop": _time_function(_autocorrelation_lags_loop, x, tau, repeats=repeats),
+            "complex128": _time_function(autocorrelation_lags, x, tau, dtype=torch.complex128, repeats=repeats),
+            "complex64": _time_function(autocorrelation_lags, x, tau, dtype=torch.complex64, repeats=repeats),
+        }
+        times = results[(N, T, tau)]
+        print(f"N={N}, T={T}, tau={tau}: loop {times['loop'] * 1e3:.2f} ms, "
+              f"complex128 {times['complex128'] * 1e3:.2f} ms (x{times['loop'] / times['complex128']:.1f}), "
+              f"complex64 {times['complex64'] * 1e3:.2f} ms (x{times['loop'] / times['complex64']:.1f})")
+    return results
+
+
+def benchmark_music_spectrum(sensors: tuple = (8, 16, 32, 64), sources: tuple = (1, 2, 4, 8),
+                             grid_shapes: tuple = ((361,), (241, 85)), batch_size: int = 64,
+                             repeats: int = 3) -> dict:
+    """
+    Compares the time of the "noise" and "signal" formulations of the MUSIC inverse spectrum on random
+    subspaces and unit modulus steering dictionaries, and reports the formulation chosen by
+    select_spectrum_formulation.
+
+    Args:
+    -----
+        sensors (tuple, optional): The numbers of sensors N. Defaults to (8, 16, 32, 64).
+        sources (tuple, optional): The numbers of sources M. Defaults to (1, 2, 4, 8).
+        grid_shapes (tuple, optional): The shapes of the grids, a far field grid and a near field grid.
+            Defaults to ((361,), (241, 85)).
+        batch_size (int, optional): The batch size. Defaults to 64.
+        repeats (int, optional): The number of timed calls of each formulation. Defaults to 3.
+
+    Returns:
+    --------
+        dict: The time, in seconds, of each formulation and the chosen one ("auto"), for each (N, M, grid shape).
+    """
+    results = {}
+    for N, M, grid_shape in itertools.product(sensors, sources, grid_shapes):
+        if M >= N:
+            continue
+        steering_dict = torch.exp(2j * torch.pi * torch.rand(N, *grid_shape, dtype=torch.float64))
+        eigenvectors = torch.linalg.qr(torch.randn(batch_size, N, N, dtype=torch.complex128))[0]
+        subspaces = {"noise": eigenvectors[:, :, M:], "signal": eigenvectors[:, :, :M]}
+        times = {formulation: _time_function(tiled_inverse_spectrum, steering_dict, subspaces[formulation],
+                                             formulation=formulation, repeats=repeats)
+                 for formulation in SPECTRUM_FORMULATIONS}
+        times["auto"] = select_spectrum_formulation(N, M, steering_dict[0].numel())
+        results[(N, M, grid_shape)] = times
+        print(f"N={N}, M={M}, grid={grid_shape}: " +
+              ", ".join(f"{formulation} {times[formulation] * 1e3:.2f} ms" for formulation in SPECTRUM_FORMULATIONS) +
+              f", selected {times['auto']} (x{times['noise'] / times[times['auto']]:.1f} over noise)")
+    return results
+
+
+def _sort_predictions(predictions) -> torch.Tensor:
+    """Stacks the angles, and the ranges if any, of the predictions, sorted by angle for comparing the searches."""
+    predictions = torch.stack(predictions, dim=-1) if isinstance(predictions, tuple) else predictions[..., None]
+    order = torch.argsort(predictions[..., 0], dim=1)
+    return torch.gather(predictions, 1, order[..., None].expand_as(predictions))
+
+
+def benchmark_grid_search(system_model_params: SystemModelParams, samples_size: int = 256,
+                          doa_resolutions: tuple = (1, 0.1, 0.02), coarse_steps: tuple = (4, 8, 16)) -> dict:
+    """
+    Compares the time and the predictions of the coarse to fine peak search of MUSIC and the Beamformer with the
+    dense search, on simulated samples, for several resolutions of the angles grid. In the near field, only MUSIC is
+    compared, the coarse to fine search of the Beamformer is for the far field only.
+
+    Args:
+    -----
+        system_model_params (SystemModelParams): The parameters of the simulated samples.
+        samples_size (int, optional): The number of samples, evaluated as a single batch. Defaults to 256.
+        doa_resolutions (tuple, optional): The resolutions of the angles grid, in degrees. Defaults to (1, 0.1, 0.02).
+        coarse_steps (tuple, optional): The coarse steps of the search, each an int or an (angle, range) pair.
+            Defaults to (4, 8, 16).
+
+    Returns:
+    --------
+        dict: The time, in seconds, of the "dense" search and of each coarse step, and the fraction of samples
+            whose predictions match the dense ones, for each (method, resolution).
+    """
+    np.random.seed(42)
+    dataset, _ = create_dataset(Samples(system_model_params), samples_size=samples_size)
+    cov = sample_covariance(torch.stack([dataset[i][0] for i in range(len(dataset))]))
+    number_of_sources = int(dataset[0][1])
+    estimation_parameter = "angle" if system_model_params.field_type.startswith("far") else "angle, range"
+    results = {}
+    for doa_resolution in doa_resolutions:
+        system_model = SystemModel(deepcopy(system_model_params).set_parameter("doa_resolution", doa_resolution))
+        methods = {"music": MUSIC(system_model, estimation_parameter)}
+        if estimation_parameter == "angle":
+            methods["beamformer"] = Beamformer(system_model)
+        for name, method in methods.items():
+            method.eval()
+            # MUSIC returns the source estimation and the eigen regularization as well
+            predict = (lambda: method(cov, number_of_sources)[0]) if name == "music" else \
+                (lambda: method(cov, number_of_sources))
+            times = {"dense": _time_function(predict, repeats=1)}
+            dense = _sort_predictions(predict())
+            for coarse_step in coarse_steps:
+                method.set_search_mode("coarse_to_fine", coarse_step=coarse_step)
+                times[coarse_step] = _time_function(predict, repeats=1)
+                match = torch.isclose(_sort_predictions(predict()), dense).flatten(1).all(dim=1)
+                times[f"match {coarse_step}"] = match.double().mean().item()
+                print(f"{name}, resolution {doa_resolution}: dense {times['dense'] * 1e3:.1f} ms, coarse step "
+                      f"{coarse_step} {times[coarse_step] * 1e3:.1f} ms (x{times['dense'] / times[coarse_step]:.1f}),"
+                      f" {times[f'match {coarse_step}'] * 100:.1f}% matching")
+            method.set_search_mode("dense")
+            results[(name, doa_resolution)] = times
+    return results
+
+
+def _root_music_loop(noise_subspace: torch.Tensor, k: int) -> torch.Tensor:
+    """The former Root-MUSIC polynomial pipeline, one sum per diagonal and one selection per sample, kept as the
+    reference of the benchmark."""
+    poly_generator = torch.bmm(noise_subspace, noise_subspace.conj().transpose(1, 2))
+    N = poly_generator.shape[-1]
+    diag_sum = torch.zeros(poly_generator.shape[0], 2 * N - 1, dtype=torch.complex128)
+    for idx, diag_idx in enumerate(range(-N + 1, N)):
+        diag_sum[:, idx] = torch.sum(torch.diagonal(poly_generator, dim1=1, dim2=2, offset=diag_idx), dim=-1)
+    A = torch.diag(torch.ones(diag_sum.shape[-1] - 2, dtype=diag_sum.dtype), -1).repeat(diag_sum.shape[0], 1, 1)
+    A[:, 0, :] = -torch.div(diag_sum[:, 1:], diag_sum[:, 0][:, None])
+    roots = torch.linalg.eigvals(A)
+    roots_sorted = roots.gather(1, torch.argsort(torch.abs(torch.abs(roots) - 1), dim=1))
+    closest_roots = torch.zeros(roots.shape[0], k, dtype=torch.complex128)
+    for i in range(roots_sorted.shape[0]):
+        closest_roots[i] = roots_sorted[i, torch.abs(roots_sorted[i]) < 1][:k]
+    return closest_roots
+
+
+def _root_music_batched(noise_subspace: torch.Tensor, k: int) -> torch.Tensor:
+    """The batched Root-MUSIC polynomial pipeline of RootMusic."""
+    poly_generator = torch.bmm(noise_subspace, noise_subspace.conj().transpose(1, 2))
+    return roots_closest_unit_circle(find_roots_torch(sum_of_diags_torch(poly_generator)), k)
+
+
+def benchmark_root_music(sensors: tuple = (8, 16, 32), batch_sizes: tuple = (64, 1024), sources: int = 3,
+                         repeats: int = 3) -> dict:
+    """
+    Compares the throughput of the Root-MUSIC polynomial pipeline, from the noise subspace to the roots closest to
+    the unit circle, of the former loops and of the batched version, on the noise subspaces of random covariances.
+
+    Args:
+    -----
+        sensors (tuple, optional): The numbers of sensors N. Defaults to (8, 16, 32).
+        batch_sizes (tuple, optional): The batch sizes. Defaults to (64, 1024).
+        sources (int, optional): The number of sources M. Defaults to 3.
+        repeats (int, optional): The number of timed calls of each version. Defaults to 3.
+
+    Returns:
+    --------
+        dict: The throughput, in samples per second, of the "loop" and "batched" versions for each (N, batch size).
+    """
+    results = {}
+    for N, batch_size in itertools.product(sensors, batch_sizes):
+        x = torch.randn(batch_size, N, 2 * N, dtype=torch.complex128)
+        noise_subspace = torch.linalg.eigh(sample_covariance(x))[1][:, :, :N - sources]
+        loop = _root_music_loop(noise_subspace, sources)
+        batched = _root_music_batched(noise_subspace, sources)
+        # the roots are compared as sets, equal distances may be ordered differently
+        match = torch.allclose(torch.sort(torch.angle(loop), dim=1).values,
+                               torch.sort(torch.angle(batched), dim=1).values)
+        times = {version: batch_size / _time_function(function, noise_subspace, sources, repeats=repeats)
+                 for version, function in (("loop", _root_music_loop), ("batched", _root_music_batched))}
+        results[(N, batch_size)] = times
+        print(f"N={N}, batch size {batch_size}: loop {times['loop']:.0f} samples/s, batched {times['batched']:.0f} "
+              f"samples/s (x{times['batched'] / times['loop']:.1f}), {'matching' if match else 'NOT matching'}")
+    return results
+
+
+def benchmark_fft_spectrum(system_model_params: SystemModelParams, samples_size: int = 256,
+                           doa_resolutions: tuple = (1, 0.1, 0.01), oversampling: int = 4) -> dict:
+    """
+    Compares the time and the predictions of the FFT far field spectrum of MUSIC and the Beamformer with the direct
+    spectrum, on simulated samples, for several resolutions of the angles grid.
+
+    Args:
+    -----
+        system_model_params (SystemModelParams): The parameters of the simulated far field samples.
+        samples_size (int, optional): The number of samples, evaluated as a single batch. Defaults to 256.
+        doa_resolutions (tuple, optional): The resolutions of the angles grid, in degrees. Defaults to (1, 0.1, 0.01).
+        oversampling (int, optional): The ratio of the FFT size to the grid size. Defaults to 4.
+
+    Returns:
+    --------
+        dict: The time, in seconds, of the "direct" and the "fft" spectra, the fraction of samples whose predictions
+            match the direct ones, and the largest difference of the predictions in grid points, for each
+            (method, resolution).
+    """
+    np.random.seed(42)
+    dataset, _ = create_dataset(Samples(system_model_params), samples_size=samples_size)
+    cov = sample_covariance(torch.stack([dataset[i][0] for i in range(len(dataset))]))
+    number_of_sources = int(dataset[0][1])
+    results = {}
+    for doa_resolution in doa_resolutions:
+        system_model = SystemModel(deepcopy(system_model_params).set_parameter("doa_resolution", doa_resolution))
+        methods = {"music": MUSIC(system_model, "angle"), "beamformer": Beamformer(system_model)}
+        for name, method in methods.items():
+            method.eval()
+            # MUSIC returns the source estimation and the eigen regularization as well
+            predict = (lambda: method(cov, number_of_sources)[0]) if name == "music" else \
+                (lambda: method(cov, number_of_sources))
+            times = {"direct": _time_function(predict, repeats=1)}
+            direct = _sort_predictions(predict())
+            if name == "music":
+                method.set_spectrum_formulation("fft", oversampling=oversampling)
+            else:
+                method.set_spectrum_mode("fft", oversampling=oversampling)
+            times["fft"] = _time_function(predict, repeats=1)
+            fft = _sort_predictions(predict())
+            grid_step = (method.angles_dict[1] - method.angles_dict[0]).item()
+            times["match"] = torch.isclose(fft, direct).flatten(1).all(dim=1).double().mean().item()
+            times["max grid points"] = round(((fft - direct).abs().max() / grid_step).item())
+            print(f"{name}, resolution {doa_resolution}: direct {times['direct'] * 1e3:.1f} ms, fft "
+                  f"{times['fft'] * 1e3:.1f} ms (x{times['direct'] / times['fft']:.1f}), "
+                  f"{times['match'] * 100:.1f}% matching, at most {times['max grid points']} grid points apart")
+            results[(name, doa_resolution)] = times
+    return results
+
+
+def benchmark_near_field_fft_spectrum(system_model_params: SystemModelParams, samples_size: int = 64,
+                                      range_resolutions: tuple = (1, 0.5, 0.2), oversampling: int = 4) -> dict:
+    """
+    Compares the time and the predictions of the FFT near field spectrum of MUSIC and the Beamformer with the direct
+    spectrum, on simulated samples, for several resolutions of the ranges grid.
+
+    Args:
+    -----
+        system_model_params (SystemModelParams): The parameters of the simulated near field samples.
+        samples_size (int, optional): The number of samples, evaluated as a single batch. Defaults to 64, as the
+            direct near field Beamformer holds the BxAxRxN products.
+        range_resolutions (tuple, optional): The resolutions of the ranges grid. Defaults to (1, 0.5, 0.2).
+        oversampling (int, optional): The ratio of the FFT size to the angles grid size, and the density of the
+            kappa nodes. Defaults to 4.
+
+    Returns:
+    --------
+        dict: The time, in seconds, of the "direct" and the "fft" spectra, the fraction of samples whose predictions
+            match the direct ones, and the largest difference of the angles and of the ranges predictions in grid
+            points, for each (method, resolution).
+    """
+    np.random.seed(42)
+    dataset, _ = create_dataset(Samples(system_model_params), samples_size=samples_size)
+    cov = sample_covariance(torch.stack([dataset[i][0] for i in range(len(dataset))]))
+    number_of_sources = int(dataset[0][1])
+    results = {}
+    for range_resolution in range_resolutions:
+        system_model = SystemModel(deepcopy(system_model_params).set_parameter("range_resolution", range_resolution))
+        methods = {"music": MUSIC(system_model, "angle, range"), "beamformer": Beamformer(system_model)}
+        for name, method in methods.items():
+            method.eval()
+            # MUSIC returns the source estimation and the eigen regularization as well
+            predict = (lambda: method(cov, number_of_sources)[0]) if name == "music" else \
+                (lambda: method(cov, number_of_sources))
+            times = {"direct": _time_function(predict, repeats=1)}
+            direct = _sort_predictions(predict())
+            if name == "music":
+                method.set_spectrum_formulation("fft", oversampling=oversampling)
+            else:
+                method.set_spectrum_mode("fft", oversampling=oversampling)
+            times["fft"] = _time_function(predict, repeats=1)
+            fft = _sort_predictions(predict())
+            grid_steps = torch.tensor([(method.angles_dict[1] - method.angles_dict[0]).item(),
+                                       (method.ranges_dict[1] - method.ranges_dict[0]).item()], dtype=torch.float64)
+            times["match"] = torch.isclose(fft, direct).flatten(1).all(dim=1).double().mean().item()
+            times["max grid points"] = tuple(torch.round((fft - direct).abs().flatten(0, 1).max(dim=0).values
+                                                         / grid_steps).int().tolist())
+            print(f"{name}, range resolution {range_resolution}: direct {times['direct'] * 1e3:.1f} ms, fft "
+                  f"{times['fft'] * 1e3:.1f} ms (x{times['direct'] / times['fft']:.1f}), "
+                  f"{times['match'] * 100:.1f}% matching, at most {times['max grid points']} (angle, range) grid "
+                  f"points apart")
+            results[(name, range_resolution)] = times
+    return results
+
+
+def benchmark_unitary_methods(system_model_params: SystemModelParams, samples_size: int = 1024,
+                              sensors: tuple = (15, 63), repeats: int = 3) -> dict:
+    """
+    Compares the time and the accuracy of the real-valued Unitary MUSIC, ESPRIT and Root-MUSIC with the complex
+    methods, on simulated far field samples, for several numbers of sensors. The eigendecompositions are timed alone
+    as well. The shared eigendecomposition cache is disabled, so every call decomposes the covariances.
+
+    Args:
+    -----
+        system_model_params (SystemModelParams): The parameters of the simulated far field samples.
+        samples_size (int, optional): The number of samples, evaluated as a single batch. Defaults to 1024.
+        sensors (tuple, optional): The numbers of sensors N. Defaults to (15, 63).
+        repeats (int, optional): The number of timed calls of each method. Defaults to 3.
+
+    Returns:
+    --------
+        dict: The time, in seconds, and the RMSPE of the "complex" and the "unitary" versions, for each
+            (method, N).
+    """
+    eigen_cache.enabled, cache_enabled = False, eigen_cache.enabled
+    results = {}
+    try:
+        for N in sensors:
+            params = deepcopy(system_model_params).set_parameter("N", N)
+            np.random.seed(42)
+            dataset, _ = create_dataset(Samples(params), samples_size=samples_size)
+            cov = sample_covariance(torch.stack([dataset[i][0] for i in range(len(dataset))]))
+            angles = torch.stack([dataset[i][2] for i in range(len(dataset))]).to(torch.float64)
+            number_of_sources = int(dataset[0][1])
+            times = {"complex": _time_function(_sorted_eigh, cov, repeats=repeats),
+                     "unitary": _time_function(_sorted_unitary_eigh, cov, repeats=repeats)}
+            print(f"eigh, N={N}: complex {times['complex'] * 1e3:.1f} ms, real-valued {times['unitary'] * 1e3:.1f} ms "
+                  f"(x{times['complex'] / times['unitary']:.1f})")
+            results[("eigh", N)] = times
+            system_model = SystemModel(params)
+            methods = {"music": (MUSIC(system_model, "angle"), UnitaryMUSIC(system_model)),
+                       "esprit": (ESPRIT(system_model), UnitaryESPRIT(system_model)),
+                       "root_music": (RootMusic(system_model), UnitaryRootMusic(system_model))}
+            for name, versions in methods.items():
+                times = {}
+                for version, method in zip(("complex", "unitary"), versions):
+                    method.eval()
+                    times[version] = _time_function(method, cov, number_of_sources, repeats=repeats)
+                    predictions = method(cov, number_of_sources)[0]
+                    times[f"{version} rmspe"] = method.criterion(predictions, angles).mean().item()
+                print(f"{name}, N={N}: complex {times['complex'] * 1e3:.1f} ms, unitary {times['unitary'] * 1e3:.1f} ms "
+                      f"(x{times['complex'] / times['unitary']:.1f}), RMSPE complex {times['complex rmspe']:.4f}, "
+                      f"unitary {times['unitary rmspe']:.4f}")
+                results[(name, N)] = times
+    finally:
+        eigen_cache.enabled = cache_enabled
+    return results
+
+
+def benchmark_partial_eigensolver(system_model_params: SystemModelParams, samples_size: int = 256,
+                                  sensors: tuple = (64, 128, 256), repeats: int = 3) -> dict:
+    """
+    Compares the time of the partial eigensolver with the full eigh, from random vectors and warm started by the
+    signal subspace of the first half of the snapshots, as the subspace of the previous batch of a tracking, on
+    simulated far field samples of large arrays. MUSIC and ESPRIT are compared as well, with the largest difference
+    of their predictions. The shared eigendecomposition cache is disabled, so every call decomposes the covariances.
+
+    Args:
+    -----
+        system_model_params (SystemModelParams): The parameters of the simulated far field samples.
+        samples_size (int, optional): The number of samples, evaluated as a single batch. Defaults to 256.
+        sensors (tuple, optional): The numbers of sensors N. Defaults to (64, 128, 256).
+        repeats (int, optional): The number of timed calls of each function. Defaults to 3.
+
+    Returns:
+    --------
+        dict: The time, in seconds, of the "full", "partial" and "warm" eigendecompositions for each ("eigh", N),
+            and of the "full" and "partial" methods, with the largest "difference" of their predictions, for each
+            (method, N).
+    """
+    eigen_cache.enabled, cache_enabled = False, eigen_cache.enabled
+    results = {}
+    try:
+        for N in sensors:
+            params = deepcopy(system_model_params).set_parameter("N", N)
+            np.random.seed(42)
+            dataset, _ = create_dataset(Samples(params), samples_size=samples_size)
+            x = torch.stack([dataset[i][0] for i in range(len(dataset))])
+            cov = sample_covariance(x)
+            number_of_sources = int(dataset[0][1])
+            initial = _partial_eigh(sample_covariance(x[:, :, :x.shape[-1] // 2]), number_of_sources)[1]
+            initial = initial[:, :, :number_of_sources]
+            times = {"full": _time_function(_sorted_eigh, cov, repeats=repeats),
+                     "partial": _time_function(_partial_eigh, cov, number_of_sources, repeats=repeats),
+                     "warm": _time_function(_partial_eigh, cov, number_of_sources, initial, repeats=repeats)}
+            print(f"eigh, N={N}: full {times['full'] * 1e3:.1f} ms, partial {times['partial'] * 1e3:.1f} ms "
+                  f"(x{times['full'] / times['partial']:.1f}), warm started {times['warm'] * 1e3:.1f} ms "
+                  f"(x{times['full'] / times['warm']:.1f})")
+            results[("eigh", N)] = times
+            system_model = SystemModel(params)
+            methods = {"music": lambda: MUSIC(system_model, "angle"), "esprit": lambda: ESPRIT(system_model)}
+            for name, create_method in methods.items():
+                times, predictions = {}, {}
+                for eigensolver in ("full", "partial"):
+                    method = create_method()
+                    method.set_eigensolver(eigensolver)
+                    method.eval()
+                    times[eigensolver] = _time_function(method, cov, number_of_sources, repeats=repeats)
+                    predictions[eigensolver] = _sort_predictions(method(cov, number_of_sources)[0])
+                times["difference"] = (predictions["full"] - predictions["partial"]).abs().max().item()
+                print(f"{name}, N={N}: full {times['full'] * 1e3:.1f} ms, partial {times['partial'] * 1e3:.1f} ms "
+                      f"(x{times['full'] / times['partial']:.1f}), largest difference {times['difference']:.1e} rad")
+                results[(name, N)] = times
+    finally:
+        eigen_cache.enabled = cache_enabled
+    return results
+
+
+def benchmark_subspace_tracker(system_model_params: SystemModelParams, streams: int = 16, sensors: tuple = (64, 128),
+                               window_lengths: tuple = (200, 800, 3200), hop: int = 10, hops: int = 20) -> dict:
+    """
+    Compares the per-hop time of the SubspaceTracker of ESPRIT and MUSIC, over a sliding window, with the
+    recomputation of the sample covariance of the window and of its full eigendecomposition at each hop, on simulated
+    far field streams, for several window lengths. The tracker starts once its window is filled.
+
+    Args:
+    -----
+        system_model_params (SystemModelParams): The parameters of the simulated far field streams.
+        streams (int, optional): The number of streams B, tracked as a batch. Defaults to 16.
+        sensors (tuple, optional): The numbers of sensors N. Defaults to (64, 128).
+        window_lengths (tuple, optional): The window lengths L. Defaults to (200, 800, 3200).
+        hop (int, optional): The number of snapshots between two estimates. Defaults to 10.
+        hops (int, optional): The number of timed hops. Defaults to 20.
+
+    Returns:
+    --------
+        dict: The time per hop, in seconds, of the "tracker" and of the "recompute", with the largest "difference" of
+            their predictions, for each (method, N, L).
+    """
+    results = {}
+    for N, window_length in itertools.product(sensors, window_lengths):
+        params = deepcopy(system_model_params).set_parameter("N", N).set_parameter("T", window_length + hop * hops)
+        np.random.seed(42)
+        dataset, _ = create_dataset(Samples(params), samples_size=streams)
+        x = torch.stack([dataset[i][0] for i in range(len(dataset))]).to(torch.complex128)
+        number_of_sources = int(dataset[0][1])
+        system_model = SystemModel(params)
+        methods = {"esprit": lambda: ESPRIT(system_model), "music": lambda: MUSIC(system_model, "angle")}
+        for name, create_method in methods.items():
+            tracker = SubspaceTracker(create_method().eval(), number_of_sources, hop, window_length=window_length)
+            tracker.update(x[:, :, :window_length])
+            start = time.perf_counter()
+            tracked = [tracker.update(x[:, :, end - hop:end])[0]
+                       for end in range(window_length + hop, x.shape[-1] + 1, hop)]
+            tracker_time = (time.perf_counter() - start) / hops
+            method = create_method().eval()
+            start = time.perf_counter()
+            with torch.no_grad():
+                recomputed = [method(sample_covariance(x[:, :, end - window_length:end]), number_of_sources)[0]
+                              for end in range(window_length + hop, x.shape[-1] + 1, hop)]
+            recompute_time = (time.perf_counter() - start) / hops
+            difference = max((_sort_predictions(tracked_prediction) - _sort_predictions(prediction)).abs().max().item()
+                             for tracked_prediction, prediction in zip(tracked, recomputed))
+            results[(name, N, window_length)] = {"tracker": tracker_time, "recompute": recompute_time,
+                                                 "difference": difference}
+            print(f"{name}, N={N}, L={window_length}: tracker {tracker_time * 1e3:.1f} ms, recompute "
+                  f"{recompute_time * 1e3:.1f} ms per hop (x{recompute_time / tracker_time:.1f}), largest difference "
+                  f"{difference:.1e} rad")
+    return results
+
+
+if __name__ == "__main__":
+    system_model_params = (
+        SystemModelParams()
+        .set_parameter("N", 15)
+        .set_parameter("M", (2, 5))
+        .set_parameter("T", 100)
+        .set_parameter("snr", 0)
+        .set_parameter("field_type", "near")
+        .set_parameter("signal_nature", "non-coherent")
+    )
+    np.random.seed(42)
+    generic_dataset, _ = create_dataset(Samples(system_model_params), samples_size=8192)
+    benchmark_dataset_backends(generic_dataset)
+    benchmark_autocorrelation_lags()
+    benchmark_music_spectrum()
+    benchmark_grid_search(deepcopy(system_model_params).set_parameter("field_type", "far").set_parameter("M", 2))
+    benchmark_grid_search(deepcopy(system_model_params).set_parameter("M", 2).set_parameter("snr", 10),
+                          samples_size=96, doa_resolutions=(1, 0.5, 0.1), coarse_steps=((4, 2), (8, 2), (16, 2)))
+    benchmark_root_music()
+    benchmark_fft_spectrum(deepcopy(system_model_params).set_parameter("field_type", "far").set_parameter("M", 2))
+    benchmark_near_field_fft_spectrum(deepcopy(system_model_params).set_parameter("M", 2))
+    benchmark_unitary_methods(deepcopy(system_model_params).set_parameter("field_type", "far").set_parameter("M", 2))
+    benchmark_partial_eigensolver(deepcopy(system_model_params).set_parameter("field_type", "far").set_parameter("M", 2))
+    benchmark_subspace_tracker(deepcopy(system_model_params).set_parameter("field_type", "far").set_parameter("M", 2))
@@ -25,6 +25,11 @@ Attributes:
     * create_cov_tensor: Creates a 3D tensor containing the real part,
         imaginary part, and phase component of the covariance matrix.
     * set_dataset_filename: Returns the generic suffix of the datasets filename.
+    * SamplesStream: A dataset which generates fresh batches on the fly, instead of storing them.
+    * DatasetCache: A content addressed cache of generated datasets, with LRU eviction under a disk budget.
+    * get_sources_num: Returns the number of sources of each sample from the dataset metadata.
+    * compute_features: Computes the lag tensor and the covariances of a batch, which are stored by the feature store.
+    * convert_legacy_dataset: Converts a dataset saved in the legacy per-sample HDF5 layout to the contiguous layout.
 
 """
 
@@ -41,9 +46,24 @@ import torch
 import numpy as np
 import random
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import hashlib
+import json
+import shutil
+import time
+from torch.utils.data import IterableDataset
 
 from src.signal_creation import Samples
 from src.system_model import SystemModelParams
+from src.utils import autocorrelation_lags, sample_covariance, spatial_smoothing_covariance
+from src.config import device
+
+# version of the contiguous HDF5 layout written by TimeSeriesDataset.save
+HDF5_FORMAT_VERSION = 2
+HDF5_CHUNK_CACHE_BYTES = 64 * 1024 ** 2
+# version of the samples generator, part of the DatasetCache key. Bump it whenever the generated data changes.
+GENERATOR_VERSION = 1
 
 def create_dataset(
         samples_model: Samples,
@@ -53,9 +73,18 @@ def create_dataset(
         true_doa: list = None,
         true_range: list = None,
         phase: str = None,
+        generation_batch_size: int = 4096,
+        num_workers: int = 1,
+        seed: int = None,
+        shard_size: int = 1024,
+        storage_format: str = "h5",
+        features_tau: int = None,
         ) -> tuple:
     """
     Generates a synthetic dataset based on the specified parameters and model type.
+    The dataset is split into shards of shard_size samples, each generated from its own seed derived from
+    (seed, shard id), so the dataset is reproducible regardless of the number of workers used.
+    The shards are generated by a pool of num_workers processes and merged, in order, into a single dataset.
 
     Args:
     -----
@@ -66,49 +95,156 @@ def create_dataset(
         true_doa (list, optional): Predefined angles. Defaults to None.
         true_range (list, optional): Predefined ranges. Defaults to None.
         phase (str, optional): The phase of the dataset (test or training phase for CNN model). Defaults to None.
+        generation_batch_size (int, optional): The maximal number of samples generated at once. Defaults to 4096.
+        num_workers (int, optional): The number of processes used for the generation. Defaults to 1.
+        seed (int, optional): The global seed of the dataset. If None, it is drawn from the numpy global random
+            state, hence set by set_unified_seed. Defaults to None.
+        shard_size (int, optional): The number of samples in each shard. Defaults to 1024.
+        storage_format (str, optional): The format of the saved dataset, "h5" for a single HDF5 file or "npy" for
+            a directory of memory mapped .npy files. Defaults to "h5".
+        features_tau (int, optional): If given, the lag tensor with features_tau lags and the covariances of
+            each sample are precomputed and stored with the dataset, see TimeSeriesDataset.add_features.
+            Defaults to None.
 
     Returns:
     --------
         tuple: A tuple containing the desired dataset and the samples model.
 
     """
-    time_series, labels, sources_num = [], [], []
+    samples_size = int(samples_size)
+    if seed is None:
+        seed = np.random.randint(0, 2 ** 31 - 1)
+    shards = [(shard_id, min(shard_size, samples_size - start))
+              for shard_id, start in enumerate(range(0, samples_size, shard_size))]
+    shard_args = [(samples_model, shard_len, seed, shard_id, true_doa, true_range, generation_batch_size)
+                  for shard_id, shard_len in shards]
 
-    M_is_tuple = isinstance(samples_model.params.M, tuple)
-
-    for _ in tqdm(range(samples_size), desc="Creating dataset"):
-        if M_is_tuple:
-            low_M, high_M = samples_model.params.M
-            high_M = min(high_M, samples_model.params.N-1)
-            # make sure that low_M is less than high_M, otherwise, the randint function will raise an error
-            M = low_M if low_M >= high_M else random.randint(low_M, high_M)
+    time_series, labels, sources_num = [], [], []
+    with tqdm(total=samples_size, desc="Creating dataset") as pbar:
+        if num_workers > 1 and len(shards) > 1:
+            with ProcessPoolExecutor(max_workers=min(num_workers, len(shards)),
+                                     initializer=_shard_worker_init) as executor:
+                shard_results = executor.map(_create_shard, *zip(*shard_args))
+                for shard_x, shard_y, shard_m in shard_results:
+                    _merge_shard(time_series, labels, sources_num, shard_x, shard_y, shard_m)
+                    pbar.update(len(shard_m))
         else:
-            M = samples_model.params.M
-        # Samples model creation
-        samples_model.set_labels(M, true_doa, true_range)
-        # Observations matrix creation
-        X = samples_model.samples_creation(
-                noise_mean=0, noise_variance=1, signal_mean=0, signal_variance=1, source_number=M
-            )[0]
-        # Ground-truth creation
-        Y = samples_model.get_labels()
-        time_series.append(X)
-        labels.append(Y)
-        sources_num.append(M)
-
+            for args in shard_args:
+                shard_x, shard_y, shard_m = _create_shard(*args)
+                _merge_shard(time_series, labels, sources_num, shard_x, shard_y, shard_m)
+                pbar.update(len(shard_m))
 
     generic_dataset = TimeSeriesDataset(time_series, labels, sources_num, len(set(sources_num)) == 1)
+    if features_tau is not None:
+        generic_dataset.add_features(features_tau)
     if save_datasets:
         generic_dataset_filename = f"Generic_DataSet" + set_dataset_filename(samples_model.params, int(samples_size))
-        generic_dataset.save(datasets_path / phase / generic_dataset_filename)
+        if storage_format == "npy":
+            generic_dataset.save_memmap((datasets_path / phase / generic_dataset_filename).with_suffix(".npy"))
+        elif storage_format == "h5":
+            generic_dataset.save(datasets_path / phase / generic_dataset_filename)
+        else:
+            raise ValueError(f"create_dataset: storage format {storage_format} is not defined")
 
     return generic_dataset, samples_model
 
+
+def _shard_worker_init():
+    """Limits each generation process to a single thread, to avoid oversubscription of the cores."""
+    torch.set_num_threads(1)
+
+
+def _get_shard_seed(seed: int, *keys: int) -> int:
+    """Derives the seed of a shard from the global seed of the dataset and the shard keys (e.g. shard id)."""
+    return int(np.random.SeedSequence([seed, *keys]).generate_state(1)[0])
+
+
+@contextmanager
+def _seeded_random_state(seed: int):
+    """Seeds the global random states and restores them on exit, so the rest of the simulation is not affected."""
+    random_state, np_random_state = random.getstate(), np.random.get_state()
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        yield
+    finally:
+        random.setstate(random_state)
+        np.random.set_state(np_random_state)
+
+
+def _draw_sources_num(samples_model: Samples, size: int) -> np.ndarray:
+    """Draws the number of sources of each sample, uniformly in the range of samples_model.params.M if it's a tuple."""
+    if isinstance(samples_model.params.M, tuple):
+        low_M, high_M = samples_model.params.M
+        high_M = min(high_M, samples_model.params.N - 1)
+        # make sure that low_M is less than high_M, otherwise, the randint function will raise an error
+        if low_M >= high_M:
+            return np.full(size, low_M)
+        return np.random.randint(low_M, high_M + 1, size=size)
+    return np.full(size, samples_model.params.M)
+
+
+def _create_shard(samples_model: Samples, shard_len: int, seed: int, shard_id: int, true_doa: list = None,
+                  true_range: list = None, generation_batch_size: int = 4096) -> tuple:
+    """
+    Generates a single shard of the dataset, seeded by (seed, shard_id).
+    The samples are generated in vectorized chunks of samples sharing the same number of sources,
+    and are kept in their original (random) order. The global random states are restored afterward,
+    so generating the shards in the calling process does not affect the rest of the simulation.
+
+    Args:
+    -----
+        samples_model (Samples): The samples model.
+        shard_len (int): The number of samples in the shard.
+        seed (int): The global seed of the dataset.
+        shard_id (int): The index of the shard.
+        true_doa (list, optional): Predefined angles. Defaults to None.
+        true_range (list, optional): Predefined ranges. Defaults to None.
+        generation_batch_size (int, optional): The maximal number of samples generated at once. Defaults to 4096.
+
+    Returns:
+    --------
+        tuple: The observations as np.ndarray [shard_len, N, T], a list of labels as np.ndarray,
+            and the number of sources as np.ndarray [shard_len].
+    """
+    with _seeded_random_state(_get_shard_seed(seed, shard_id)):
+        sources_num = _draw_sources_num(samples_model, shard_len)
+
+        time_series = np.empty((shard_len, samples_model.params.N, samples_model.params.T), dtype=np.complex128)
+        labels = [None] * shard_len
+        for M in np.unique(sources_num):
+            M = int(M)
+            indices = np.flatnonzero(sources_num == M)
+            for start in range(0, len(indices), generation_batch_size):
+                chunk = indices[start:start + generation_batch_size]
+                # Samples model creation
+                samples_model.set_labels_batch(len(chunk), M, true_doa, true_range)
+                # Observations matrices creation
+                X = samples_model.samples_creation_batch(
+                    noise_mean=0, noise_variance=1, signal_mean=0, signal_variance=1, source_number=M
+                )[0]
+                # Ground-truth creation
+                Y = samples_model.get_labels_batch().numpy()
+                time_series[chunk] = X.numpy()
+                for i, idx in enumerate(chunk):
+                    labels[idx] = Y[i]
+    return time_series, labels, sources_num
+
+
+def _merge_shard(time_series: list, labels: list, sources_num: list, shard_x: np.ndarray, shard_y: list,
+                  shard_m: np.ndarray):
+    """Appends a generated shard to the dataset lists."""
+    time_series.extend(torch.from_numpy(shard_x))
+    labels.extend(torch.from_numpy(y) for y in shard_y)
+    sources_num.extend(shard_m.tolist())
+
+
 def load_datasets(
         system_model_params: SystemModelParams,
         samples_size: int,
         datasets_path: Path,
         is_training: bool = False,
+        storage_format: str = "h5",
 ):
     """
     Load different datasets based on the specified parameters and phase.
@@ -120,6 +256,7 @@ def load_datasets(
         datasets_path (Path): The path to the datasets.
         train_test_ratio (float): The ration between train and test datasets.
         is_training (bool): Specifies whether to load the training dataset.
+        storage_format (str): The format of the saved dataset, "h5" or "npy". Defaults to "h5".
 
     Returns:
     --------
@@ -130,6 +267,8 @@ def load_datasets(
     generic_dataset = TimeSeriesDataset(None, None, None)
     model_trainingset_filename = f"Generic_DataSet" + set_dataset_filename(system_model_params, int(samples_size))
     file_name = datasets_path / f"{'train' if is_training  else 'test'}" / model_trainingset_filename
+    if storage_format == "npy":
+        file_name = file_name.with_suffix(".npy")
     try:
         generic_dataset.load(file_name)
         return generic_dataset
@@ -172,6 +311,8 @@ class TimeSeriesDataset(Dataset):
     X is for the signal - a list of B elements, each element is a tensor of shape (N, T)
     Y is for the labels - a list of B elements, each element is a tensor of shape (M, ) in the far field case or (2M, ) in the near field case.
     M is for the number of sources - a list of B elements, each element is an integer.
+    features holds the optional precomputed features of the samples, see add_features. When present, each sample
+    and each batch is returned with a fourth element - a dict of the features.
     """
     def __init__(self, X, Y, M, is_constant_M: bool = False):
         self.X = X
@@ -181,10 +322,40 @@ class TimeSeriesDataset(Dataset):
         self.path = None
         self.len = None
         self.h5f = None
+        self.is_legacy = False
+        self.backend = None
+        self._X, self._angles, self._ranges = None, None, None
+        self.features = None
+        self._features = None
 
     def _open_h5_file(self):
         if self.h5f is None:
-            self.h5f = h5py.File(self.path, 'r')
+            # a large chunk cache avoids decompressing the same chunk for each sample
+            self.h5f = h5py.File(self.path, 'r', rdcc_nbytes=HDF5_CHUNK_CACHE_BYTES, rdcc_nslots=10007)
+            if 'format_version' in self.h5f.attrs:
+                self._X, self._angles = self.h5f['X'], self.h5f['angles']
+                self._ranges = self.h5f['ranges'] if 'ranges' in self.h5f else None
+                if 'features' in self.h5f:
+                    self._features = {name: feature for name, feature in self.h5f['features'].items()}
+
+    def _open_memmap_files(self):
+        if self._X is None:
+            # copy-on-write mapping: the arrays are writable for torch.from_numpy, but the file is never modified
+            self._X = np.load(self.path / "X.npy", mmap_mode='c')
+            self._angles = np.load(self.path / "angles.npy", mmap_mode='c')
+            ranges_path = self.path / "ranges.npy"
+            self._ranges = np.load(ranges_path, mmap_mode='c') if ranges_path.exists() else None
+            features_paths = sorted(self.path.glob("features_*.npy"))
+            if features_paths:
+                self._features = {path.stem[len("features_"):]: np.load(path, mmap_mode='c')
+                                  for path in features_paths}
+
+    def __getstate__(self):
+        # file handles and mappings are reopened lazily by each process
+        state = self.__dict__.copy()
+        if self.path is not None:
+            state.update(h5f=None, _X=None, _angles=None, _ranges=None, _features=None)
+        return state
 
     def __len__(self):
         if self.len is None:
@@ -194,13 +365,96 @@ class TimeSeriesDataset(Dataset):
 
     def __getitem__(self, idx):
         if self.path is None:
+            if self.features is not None:
+                return self.X[idx], self.M[idx], self.Y[idx], {name: feature[idx] for name, feature in self.features.items()}
             return self.X[idx], self.M[idx], self.Y[idx]
-        else:
-            self._open_h5_file()
+        if self.backend == "memmap":
+            # views over the mapped pages, no copy is made
+            self._open_memmap_files()
+            m = int(self.M[idx])
+            x = torch.from_numpy(self._X[idx])
+            y = torch.from_numpy(self._angles[idx, :m])
+            if self._ranges is not None:
+                y = torch.cat((y, torch.from_numpy(self._ranges[idx, :m])))
+            if self._features is not None:
+                return x, m, y, {name: torch.from_numpy(feature[idx]) for name, feature in self._features.items()}
+            return x, m, y
+        self._open_h5_file()
+        if self.is_legacy:
             x = torch.tensor(self.h5f[f'X/tensor_{idx}'][:])
             y = torch.tensor(self.h5f[f'Y/label_{idx}'][:])
             m = int(self.h5f['M'][idx])
             return x, m, y
+        m = int(self.M[idx])
+        x = torch.from_numpy(self._X[idx])
+        y = torch.from_numpy(self._angles[idx, :m])
+        if self._ranges is not None:
+            y = torch.cat((y, torch.from_numpy(self._ranges[idx, :m])))
+        if self._features is not None:
+            return x, m, y, {name: torch.from_numpy(feature[idx]) for name, feature in self._features.items()}
+        return x, m, y
+
+    def __getitems__(self, indices):
+        """
+        Fetches a whole batch at once, with a single read from the backing store when possible.
+        Used by the DataLoader instead of calling __getitem__ for each sample.
+
+        Args:
+        -----
+            indices (list): The indices of the samples in the batch.
+
+        Returns:
+        --------
+            tuple: The collated batch, as returned by collate_fn, followed by a dict of the features of the batch
+                if the dataset has precomputed features.
+        """
+        if self.path is None:
+            if self.features is None:
+                return collate_fn([self[idx] for idx in indices])
+            x, sources_num, labels = collate_fn([self[idx][:3] for idx in indices])
+            return x, sources_num, labels, {name: feature[indices] for name, feature in self.features.items()}
+        if self.is_legacy:
+            return collate_fn([self[idx] for idx in indices])
+        indices = np.asarray(indices, dtype=int)
+        features = None
+        if self.backend == "memmap":
+            self._open_memmap_files()
+            x, angles = self._X[indices], self._angles[indices]
+            ranges = self._ranges[indices] if self._ranges is not None else None
+            if self._features is not None:
+                features = {name: feature[indices] for name, feature in self._features.items()}
+        else:
+            self._open_h5_file()
+            x, angles, ranges = self.__read_h5_rows(indices, self._X, self._angles, self._ranges)
+            if self._features is not None:
+                features = dict(zip(self._features.keys(), self.__read_h5_rows(indices, *self._features.values())))
+        sources_num = torch.from_numpy(np.asarray(self.M[indices], dtype=np.int64))
+        # the stored labels are already padded, keep the padding up to the largest number of sources in the batch
+        max_m = int(sources_num.max())
+        labels = torch.from_numpy(np.ascontiguousarray(angles[:, :max_m]))
+        if ranges is not None:
+            labels = torch.cat((labels, torch.from_numpy(np.ascontiguousarray(ranges[:, :max_m]))), dim=1)
+        if features is not None:
+            features = {name: torch.from_numpy(feature) for name, feature in features.items()}
+            return torch.from_numpy(x), sources_num, labels, features
+        return torch.from_numpy(x), sources_num, labels
+
+    @staticmethod
+    def __read_h5_rows(indices: np.ndarray, *datasets):
+        """Reads the rows of the given indices from each of the HDF5 datasets (None is passed through), in the order of the indices."""
+        start, stop = int(indices.min()), int(indices.max()) + 1
+        is_dense = stop - start <= 4 * len(indices)
+        if not is_dense:
+            # h5py requires increasing indices for fancy indexing
+            sorted_indices, inverse = np.unique(indices, return_inverse=True)
+
+        def read(dataset):
+            if is_dense:
+                # a single contiguous read is cheaper than a scattered one
+                return dataset[start:stop][indices - start]
+            return dataset[sorted_indices][inverse]
+
+        return tuple(read(dataset) if dataset is not None else None for dataset in datasets)
 
     def get_dataloaders(self, batch_size):
         # Divide into training and validation datasets
@@ -233,44 +487,254 @@ class TimeSeriesDataset(Dataset):
             )
         else:
             train_dataloader = torch.utils.data.DataLoader(
-                train_dataset, shuffle=True, batch_size=batch_size, num_workers=num_workers
+                train_dataset, shuffle=True, batch_size=batch_size, collate_fn=collate_fn, num_workers=num_workers
             )
             valid_dataloader = torch.utils.data.DataLoader(
-                valid_dataset, shuffle=False, batch_size=32, num_workers=max(num_workers // 2, 1)
+                valid_dataset, shuffle=False, batch_size=32, collate_fn=collate_fn, num_workers=max(num_workers // 2, 1)
             )
         return train_dataloader, valid_dataloader
 
-    def save(self, path):
+    def save(self, path, chunk_size: int = 256, compression: str = None):
+        """
+        Saves the dataset to an HDF5 file, using a contiguous layout: a single chunked complex array X of shape
+        [B, N, T], padded angles (and ranges, in the near field case) arrays of shape [B, max(M)] and the M index.
+        The precomputed features, if any, are saved to the features group, one array per feature.
+
+        Args:
+        -----
+            path (Path): The path of the file.
+            chunk_size (int, optional): The number of samples in each HDF5 chunk. Defaults to 256.
+            compression (str, optional): HDF5 compression filter, "gzip" or "lzf". Defaults to None.
+        """
+        M = np.asarray(self.M, dtype=int)
+        B, max_m = len(M), int(M.max())
+        N, T = self.X[0].shape
+        is_near_field = len(self.Y[0]) == 2 * M[0]
+        chunk_size = max(1, min(chunk_size, B))
         with h5py.File(path, 'w') as h5f:
-            X_grp = h5f.create_group('X')  # Create a group for X
-            for i, x in enumerate(self.X):
-                X_grp.create_dataset(f"tensor_{i}", data=x.numpy())  # Save each tensor separately
-
-            Y_grp = h5f.create_group('Y')
-            for i, y in enumerate(self.Y):
-                Y_grp.create_dataset(f"label_{i}", data=np.array(y))
-
-            h5f.create_dataset('M', data=self.M)
+            h5f.attrs['format_version'] = HDF5_FORMAT_VERSION
+            X = h5f.create_dataset('X', shape=(B, N, T), dtype=np.complex128,
+                                   chunks=(chunk_size, N, T), compression=compression)
+            angles = np.zeros((B, max_m), dtype=np.float32)
+            ranges = np.zeros((B, max_m), dtype=np.float32) if is_near_field else None
+            for start in range(0, B, chunk_size):
+                stop = min(start + chunk_size, B)
+                X[start:stop] = np.stack([np.asarray(x) for x in self.X[start:stop]])
+            for i, (y, m) in enumerate(zip(self.Y, M)):
+                y = np.asarray(y, dtype=np.float32)
+                angles[i, :m] = y[:m]
+                if is_near_field:
+                    ranges[i, :m] = y[m:2 * m]
+            h5f.create_dataset('angles', data=angles, chunks=(chunk_size, max_m), compression=compression)
+            if is_near_field:
+                h5f.create_dataset('ranges', data=ranges, chunks=(chunk_size, max_m), compression=compression)
+            h5f.create_dataset('M', data=M)
+            if self.features is not None:
+                features_group = h5f.create_group('features')
+                for name, feature in self.features.items():
+                    feature = feature.numpy()
+                    features_group.create_dataset(name, data=feature, chunks=(chunk_size, *feature.shape[1:]),
+                                                  compression=compression)
+                features_group.attrs['tau'] = self.features["lag_tensor"].shape[1]
 
     def load(self, path):
-        self.path = path
-        self._open_h5_file()
-        M = self.h5f['M']
-        self.len = len(M)
-        self.is_constant_M = len(set(M)) == 1
+        """
+        Loads a dataset saved either to an HDF5 file, in the contiguous or the legacy per-sample layout,
+        or to a directory of .npy files by save_memmap. The samples are read lazily by __getitem__.
+        """
+        self.path = Path(path)
+        if self.path.is_dir():
+            self.backend = "memmap"
+            self.M = np.load(self.path / "M.npy")
+        else:
+            self.backend = "h5"
+            self._open_h5_file()
+            self.is_legacy = isinstance(self.h5f['X'], h5py.Group)
+            self.M = self.h5f['M'][:]
+        self.len = len(self.M)
+        self.is_constant_M = len(np.unique(self.M)) == 1
 
         return self
 
+    def save_memmap(self, path, chunk_size: int = 1024):
+        """
+        Saves the dataset to a directory of raw .npy files (X [B, N, T], angles and ranges [B, max(M)], M and
+        a features_<name>.npy file for each precomputed feature), which are memory mapped when loaded. Works for in-memory datasets and for datasets loaded from a file,
+        which are copied chunk by chunk, so they don't have to fit in RAM.
+
+        Args:
+        -----
+            path (Path): The path of the directory.
+            chunk_size (int, optional): The number of samples copied at once. Defaults to 1024.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        M = np.asarray(self.M if self.path is None else self.M[:], dtype=int)
+        B, max_m = len(M), int(M.max())
+        x_0, _, y_0 = self[0][:3]
+        is_near_field = len(y_0) == 2 * M[0]
+        X = np.lib.format.open_memmap(path / "X.npy", mode='w+', dtype=np.complex128, shape=(B, *x_0.shape))
+        angles = np.zeros((B, max_m), dtype=np.float32)
+        ranges = np.zeros((B, max_m), dtype=np.float32) if is_near_field else None
+        for start in range(0, B, chunk_size):
+            stop = min(start + chunk_size, B)
+            for i in range(start, stop):
+                x, m, y = self[i][:3]
+                X[i] = x.numpy()
+                angles[i, :m] = y[:m].numpy()
+                if is_near_field:
+                    ranges[i, :m] = y[m:2 * m].numpy()
+            X.flush()
+        del X
+        np.save(path / "angles.npy", angles)
+        if is_near_field:
+            np.save(path / "ranges.npy", ranges)
+        np.save(path / "M.npy", M)
+        features = self.features if self.path is None else self.__get_backend_features()
+        for name, feature in (features or {}).items():
+            saved_feature = np.lib.format.open_memmap(path / f"features_{name}.npy", mode='w+',
+                                                      dtype=np.asarray(feature[:1]).dtype, shape=tuple(feature.shape))
+            for start in range(0, B, chunk_size):
+                saved_feature[start:start + chunk_size] = np.asarray(feature[start:start + chunk_size])
+            saved_feature.flush()
+            del saved_feature
+
+    def __get_backend_features(self):
+        """Returns the handles of the stored features, None if the dataset has no precomputed features."""
+        if self.backend == "memmap":
+            self._open_memmap_files()
+        else:
+            self._open_h5_file()
+        return self._features
+
+    def add_features(self, tau: int, batch_size: int = 1024):
+        """
+        Precomputes the features of all the samples, see compute_features, and stores them next to X, so the models
+        and the methods don't recompute them from the samples in every epoch. For a dataset loaded from a file,
+        the features are computed batch by batch and written to the same file (or directory).
+
+        Args:
+        -----
+            tau (int): The number of lags of the lag tensor, which must be at least the tau of the models using it.
+            batch_size (int, optional): The number of samples processed at once. Defaults to 1024.
+
+        Returns:
+        --------
+            TimeSeriesDataset: The dataset itself.
+        """
+        if self.is_legacy:
+            raise Exception("TimeSeriesDataset.add_features: convert the legacy dataset first, see convert_legacy_dataset")
+        B = len(self)
+        if self.path is None:
+            self.features = None
+            features = [compute_features(torch.stack([torch.as_tensor(self.X[i]) for i in range(start, min(start + batch_size, B))]), tau)
+                        for start in range(0, B, batch_size)]
+            self.features = {name: torch.cat([batch_features[name] for batch_features in features])
+                             for name in features[0].keys()}
+            return self
+        # the stored features are recomputed from scratch, drop the handles before the files are overwritten
+        self.close()
+        if self.backend == "memmap":
+            for feature_path in self.path.glob("features_*.npy"):
+                feature_path.unlink()
+            self._open_memmap_files()
+            saved_features = None
+            for start in range(0, B, batch_size):
+                batch_features = compute_features(torch.from_numpy(self._X[start:start + batch_size]), tau)
+                if saved_features is None:
+                    saved_features = {name: np.lib.format.open_memmap(self.path / f"features_{name}.npy", mode='w+',
+                                                                      dtype=feature.numpy().dtype,
+                                                                      shape=(B, *feature.shape[1:]))
+                                      for name, feature in batch_features.items()}
+                for name, feature in batch_features.items():
+                    saved_features[name][start:start + batch_size] = feature.numpy()
+            for saved_feature in saved_features.values():
+                saved_feature.flush()
+            del saved_features
+        else:
+            with h5py.File(self.path, 'a') as h5f:
+                if 'features' in h5f:
+                    del h5f['features']
+                features_group = h5f.create_group('features')
+                features_group.attrs['tau'] = tau
+                chunk_size = h5f['X'].chunks[0]
+                for start in range(0, B, batch_size):
+                    batch_features = compute_features(torch.from_numpy(h5f['X'][start:start + batch_size]), tau)
+                    for name, feature in batch_features.items():
+                        if name not in features_group:
+                            features_group.create_dataset(name, shape=(B, *feature.shape[1:]), dtype=feature.numpy().dtype,
+                                                          chunks=(min(chunk_size, B), *feature.shape[1:]))
+                        features_group[name][start:start + batch_size] = feature.numpy()
+        self.close()
+        return self
+
     def close(self):
         """ Close the HDF5 file if it was opened """
         if self.h5f is not None:
             self.h5f.close()
             self.h5f = None
+        self._X, self._angles, self._ranges = None, None, None
+        self._features = None
 
     def __del__(self):
         """ Ensure file is closed when the object is deleted """
         self.close()
 
+def compute_features(x: torch.Tensor, tau: int) -> dict:
+    """
+    Computes the deterministic features of a batch of samples, which the feature store saves next to X:
+    the lag tensor which is the input of SubspaceNet, the sample covariance and the spatially smoothed covariance
+    used by the classical methods.
+
+    Args:
+    -----
+        x (torch.Tensor): The complex samples of size [B, N, T].
+        tau (int): The number of lags of the lag tensor.
+
+    Returns:
+    --------
+        dict: The features, "lag_tensor" [B, tau, 2N, N], "sample_covariance" [B, N, N] and
+            "sps_covariance" [B, N // 2 + 1, N // 2 + 1], on the cpu.
+    """
+    x = x.to(device=device, dtype=torch.complex128)
+    return {
+        "lag_tensor": autocorrelation_lags(x, tau).cpu(),
+        "sample_covariance": sample_covariance(x).cpu(),
+        "sps_covariance": spatial_smoothing_covariance(x).cpu(),
+    }
+
+
+def convert_legacy_dataset(path: Path, new_path: Path = None, chunk_size: int = 256, compression: str = None):
+    """
+    Converts a dataset saved in the legacy per-sample HDF5 layout (X/tensor_i, Y/label_i) to the contiguous layout.
+
+    Args:
+    -----
+        path (Path): The path of the legacy dataset.
+        new_path (Path, optional): The path of the converted dataset. If None, the legacy file is replaced.
+            Defaults to None.
+        chunk_size (int, optional): The number of samples in each HDF5 chunk. Defaults to 256.
+        compression (str, optional): HDF5 compression filter, "gzip" or "lzf". Defaults to None.
+
+    Returns:
+    --------
+        Path: The path of the converted dataset.
+    """
+    legacy_dataset = TimeSeriesDataset(None, None, None).load(path)
+    if not legacy_dataset.is_legacy:
+        legacy_dataset.close()
+        raise ValueError(f"convert_legacy_dataset: {path} is already in the contiguous layout")
+    samples = [legacy_dataset[i] for i in range(len(legacy_dataset))]
+    legacy_dataset.close()
+    X, M, Y = (list(item) for item in zip(*samples))
+    target_path = Path(new_path) if new_path is not None else Path(path).with_suffix(".tmp.h5")
+    TimeSeriesDataset(X, Y, M).save(target_path, chunk_size=chunk_size, compression=compression)
+    if new_path is None:
+        os.replace(target_path, path)
+        target_path = Path(path)
+    return target_path
+
+
 def worker_init_fn(worker_id):
     """ Ensure each worker has its own HDF5 file connection. """
     worker_info = torch.utils.data.get_worker_info()
@@ -280,92 +744,402 @@ def worker_init_fn(worker_id):
     if isinstance(dataset, torch.utils.data.Subset):
         dataset = dataset.dataset
 
-    # Ensure the dataset has a path and open the HDF5 file
-    if dataset.path is not None:
+    # Ensure the dataset has a path and open the HDF5 file,
+    # memory mapped datasets share the page cache and don't need a handle of their own
+    if dataset.path is not None and dataset.backend == "h5":
         dataset._open_h5_file()
 
 def collate_fn(batch):
     """
     Collate function for the dataset loader.
+    The labels are padded with zeros to the largest number of sources in the batch, in the near field case the
+    angles and the distances are padded separately, i.e. [angles, 0, ..., distances, 0, ...].
+
     Args:
-        batch:  list of tuples, each tuple contains the time series, the number of sources and the labels.
+        batch:  list of tuples, each tuple contains the time series, the number of sources and the labels,
+            and optionally a dict of the precomputed features,
+            or a batch which was already collated by TimeSeriesDataset.__getitems__.
 
     Returns:
-
+        tuple: the time series [B, N, T], the number of sources [B] and the padded labels [B, max_length],
+            followed by the stacked features when the samples have them.
 
     """
+    if isinstance(batch, tuple):
+        # already collated by TimeSeriesDataset.__getitems__
+        return batch
+    features = None
+    if len(batch[0]) > 3:
+        features = {name: torch.stack([sample[3][name] for sample in batch]) for name in batch[0][3].keys()}
+        batch = [sample[:3] for sample in batch]
     time_series, source_num, labels = zip(*batch)
-
-    # Find the maximum length in this batch
-    max_length = max([lb.size(0) for lb in labels])
-
-    # Pad labels and create masks
-    padded_labels = torch.zeros(len(batch), max_length, dtype=torch.float32)
-
-    for i, lb in enumerate(labels):
-        length = lb.size(0)
-        if source_num[i] != length:
-            # this is a near field dataset
-            angles, distances = torch.split(lb, source_num[i], dim=0)
-            lb = torch.cat((angles, torch.zeros(max_length // 2 - source_num[i], dtype=torch.float32)))
-            lb = torch.cat((lb, distances, torch.zeros(max_length // 2 - source_num[i], dtype=torch.float32)))
-        else:
-            lb = torch.cat((lb, torch.zeros(max_length - length, dtype=torch.long)))
-        padded_labels[i] = lb
-
-    # Stack labels
-    time_series = torch.stack(time_series).squeeze()
     sources_num = torch.tensor(source_num)
-
-
+    max_m = int(sources_num.max())
+    # each label holds either M angles, or M angles followed by M distances in the near field case
+    is_near_field = labels[0].size(0) != source_num[0]
+    # mask[i, j] is True for the j-th source of the i-th sample
+    mask = torch.arange(max_m)[None, :] < sources_num[:, None]
+    if is_near_field:
+        mask = torch.cat((mask, mask), dim=1)
+    padded_labels = torch.zeros(mask.shape, dtype=torch.float32)
+    # the True entries of the mask are ordered as the concatenated labels
+    padded_labels[mask] = torch.cat(labels).to(torch.float32)
+
+    time_series = torch.stack(time_series)
+
+    if features is not None:
+        return time_series, sources_num, padded_labels, features
     return time_series, sources_num, padded_labels
 
 
 class SameLengthBatchSampler(Sampler):
     """
     A class for creating batches contains samples with the same number of sources to allow batch wise operations.
+    The number of sources of each sample is read from the dataset metadata, without loading the samples.
+    The batches are reshuffled at every epoch, and can be partitioned between distributed ranks.
 
     """
-    def __init__(self, dataset, batch_size, shuffle=True):
-        super().__init__(dataset)
+    def __init__(self, dataset, batch_size, shuffle=True, num_replicas: int = None, rank: int = None,
+                 seed: int = None):
+        super().__init__()
         self.batch_size = batch_size
         self.shuffle = shuffle
-
-        # **Preload M values efficiently**
-        self.indices = np.arange(len(dataset))
-        self.source_nums = np.array([dataset[i][1] for i in self.indices], dtype=int)  # Extract M values **once**
-
-        # **Group by M values**
-        self.batches = self._create_batches()
-
-    def _create_batches(self):
-        # **Sort indices by M to ensure similar-length grouping**
-        grouped_by_sources = defaultdict(list)
-        for idx, source_num in enumerate(self.source_nums):
-            grouped_by_sources[source_num].append(idx)
-
-        # Now, split the grouped indices into batches of batch_size
+        if num_replicas is None:
+            is_distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+            num_replicas = torch.distributed.get_world_size() if is_distributed else 1
+        if rank is None:
+            is_distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+            rank = torch.distributed.get_rank() if is_distributed else 0
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"SameLengthBatchSampler: rank {rank} is out of range for {num_replicas} replicas")
+        self.num_replicas = num_replicas
+        self.rank = rank
+        # all the ranks must share the same seed to agree on the batches, drawn from the global state by default
+        self.seed = np.random.randint(0, 2 ** 31 - 1) if seed is None else seed
+        self.epoch = 0
+        self.source_nums = get_sources_num(dataset)
+        # the number of batches doesn't depend on the shuffling, only on the size of each group
+        _, group_sizes = np.unique(self.source_nums, return_counts=True)
+        self.num_batches = int(np.sum(np.ceil(group_sizes / batch_size)))
+
+    def set_epoch(self, epoch: int):
+        """Sets the epoch of the next iteration, the batches of each epoch are shuffled differently."""
+        self.epoch = epoch
+
+    def _create_batches(self, rng: np.random.Generator = None):
+        # **Group the indices by M values**
         batches = []
-        for source_num, indices in grouped_by_sources.items():
-            # Split indices for each source_num into batches
+        for source_num in np.unique(self.source_nums):
+            indices = np.flatnonzero(self.source_nums == source_num)
+            if rng is not None:
+                indices = rng.permutation(indices)
+            # Now, split the grouped indices into batches of batch_size
             for i in range(0, len(indices), self.batch_size):
-                batches.append(indices[i:i + self.batch_size])
+                batches.append(indices[i:i + self.batch_size].tolist())
 
         # **Shuffle batches (not individual samples)**
-        if self.shuffle:
-            np.random.shuffle(batches)
+        if rng is not None:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
 
         return batches
 
     def __iter__(self):
-        for batch in self.batches:
-            yield batch # Convert to Python list
+        rng = np.random.default_rng([self.seed, self.epoch]) if self.shuffle else None
+        batches = self._create_batches(rng)
+        # reshuffle at the next epoch, unless set_epoch is called
+        self.epoch += 1
+        if self.num_replicas > 1:
+            # pad with the first batches, so all the ranks have the same number of batches
+            batches += batches[:len(self) * self.num_replicas - len(batches)]
+            batches = batches[self.rank::self.num_replicas]
+        for batch in batches:
+            yield batch
 
     def __len__(self):
-        return len(self.batches)
+        return -(-self.num_batches // self.num_replicas)
 
     def get_data_source_length(self):
-        return len(self.data_source)
+        return len(self.source_nums)
 
     def get_max_batch_length(self):
-        return max([len(batch) for batch in self.batches])
+        _, group_sizes = np.unique(self.source_nums, return_counts=True)
+        return int(min(self.batch_size, group_sizes.max()))
+
+
+def get_sources_num(dataset) -> np.ndarray:
+    """
+    Returns the number of sources of each sample in the dataset, read from the stored M array.
+    Nested Subsets are resolved to the indices of the underlying dataset.
+
+    Args:
+    -----
+        dataset (Dataset): A TimeSeriesDataset, or a (nested) Subset of a TimeSeriesDataset.
+
+    Returns:
+    --------
+        np.ndarray: The number of sources of each sample.
+    """
+    if isinstance(dataset, Subset):
+        return get_sources_num(dataset.dataset)[np.asarray(dataset.indices, dtype=int)]
+    if isinstance(dataset, TimeSeriesDataset):
+        return np.asarray(dataset.M, dtype=int)
+    # unknown datasets, fall back to loading each sample
+    return np.array([dataset[i][1] for i in range(len(dataset))], dtype=int)
+
+
+class SamplesStream(IterableDataset):
+    """
+    A dataset which generates fresh batches on the fly from a Samples model, instead of storing them.
+    Each batch holds samples with the same number of sources, as the batches of SameLengthBatchSampler, and is
+    yielded already collated, i.e. (time_series [B, N, T], sources_num [B], labels [B, L]).
+    The batches of each epoch are reproducible given (seed, epoch), regardless of the number of workers,
+    which generate interleaved subsets of the batches.
+
+    Example:
+        stream = SamplesStream(Samples(system_model_params), epoch_length=100_000, batch_size=256)
+        trainer.train(stream, valid_dataloader)
+    """
+    def __init__(self, samples_model: Samples, epoch_length: int, batch_size: int, seed: int = None,
+                 true_doa: list = None, true_range: list = None, num_workers: int = 0, pin_memory: bool = False,
+                 prefetch_factor: int = 2):
+        """
+        Args:
+        -----
+            samples_model (Samples): The samples model.
+            epoch_length (int): The number of samples generated in each epoch.
+            batch_size (int): The maximal number of samples in a batch.
+            seed (int, optional): The seed of the stream. If None, it is drawn from the numpy global random state,
+                hence set by set_unified_seed. Defaults to None.
+            true_doa (list, optional): Predefined angles. Defaults to None.
+            true_range (list, optional): Predefined ranges. Defaults to None.
+            num_workers (int, optional): The number of DataLoader workers used by get_dataloader. Defaults to 0.
+            pin_memory (bool, optional): Whether get_dataloader copies the batches into pinned memory.
+                Defaults to False.
+            prefetch_factor (int, optional): The number of batches prefetched by each worker. Defaults to 2.
+        """
+        super().__init__()
+        self.samples_model = samples_model
+        self.epoch_length = int(epoch_length)
+        self.batch_size = batch_size
+        self.seed = np.random.randint(0, 2 ** 31 - 1) if seed is None else seed
+        self.true_doa = true_doa
+        self.true_range = true_range
+        self.num_workers = num_workers
+        self.pin_memory = pin_memory
+        self.prefetch_factor = prefetch_factor
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        """Sets the epoch of the next iteration, each epoch generates different samples."""
+        self.epoch = epoch
+
+    def _plan_batches(self) -> list:
+        """Returns the number of sources and the size of each batch of the current epoch."""
+        with _seeded_random_state(_get_shard_seed(self.seed, self.epoch)):
+            sources_num = _draw_sources_num(self.samples_model, self.epoch_length)
+            batches = []
+            for M, group_size in zip(*np.unique(sources_num, return_counts=True)):
+                batches += [(int(M), min(self.batch_size, group_size - start))
+                            for start in range(0, group_size, self.batch_size)]
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return batches
+
+    def _create_batch(self, batch_id: int, M: int, batch_size: int) -> tuple:
+        """Generates a single batch, seeded by (seed, epoch, batch_id)."""
+        with _seeded_random_state(_get_shard_seed(self.seed, self.epoch, batch_id)):
+            self.samples_model.set_labels_batch(batch_size, M, self.true_doa, self.true_range)
+            time_series = self.samples_model.samples_creation_batch(
+                noise_mean=0, noise_variance=1, signal_mean=0, signal_variance=1, source_number=M
+            )[0]
+            labels = self.samples_model.get_labels_batch()
+        return time_series, torch.full((batch_size,), M, dtype=torch.int64), labels
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        batches = self._plan_batches()
+        for batch_id in range(worker_id, len(batches), num_workers):
+            yield self._create_batch(batch_id, *batches[batch_id])
+        if worker_info is None:
+            # reshuffle at the next epoch, unless set_epoch is called. Workers hold a copy of the stream,
+            # so with workers the epoch is set by the Trainer.
+            self.epoch += 1
+
+    def __len__(self):
+        return len(self._plan_batches())
+
+    def get_dataloader(self) -> torch.utils.data.DataLoader:
+        """Wraps the stream with a DataLoader, which generates the batches in workers and prefetches them."""
+        return torch.utils.data.DataLoader(
+            self, batch_size=None, num_workers=self.num_workers, pin_memory=self.pin_memory,
+            prefetch_factor=self.prefetch_factor if self.num_workers > 0 else None,
+            persistent_workers=False
+        )
+
+
+class DatasetCache:
+    """
+    A content addressed cache of generated datasets.
+    Each dataset is keyed by a hash of the full SystemModelParams, the dataset size, the labels overrides,
+    the seed and the generator version, so a dataset is never reused for different parameters and never
+    regenerated for the same ones. A manifest file records the parameters, size and last access of each entry,
+    and the least recently used entries are evicted when the cache exceeds its disk budget.
+
+    Example:
+        cache = DatasetCache(datasets_path / "cache", max_bytes=50 * 1024 ** 3)
+        train_dataset = cache.get_or_create(system_model_params, samples_size=100_000, seed=0)
+    """
+    MANIFEST_NAME = "manifest.json"
+
+    def __init__(self, cache_dir: Path, max_bytes: int = None):
+        """
+        Args:
+        -----
+            cache_dir (Path): The directory of the cache, created if it doesn't exist.
+            max_bytes (int, optional): The disk budget of the cache, in bytes. If None, nothing is evicted.
+                Defaults to None.
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.manifest = self.__load_manifest()
+
+    @staticmethod
+    def describe(system_model_params: SystemModelParams, samples_size: int, seed: int, true_doa: list = None,
+                 true_range: list = None) -> dict:
+        """Returns all the settings which determine the content of a generated dataset."""
+        params = {name: getattr(system_model_params, name) for name in vars(SystemModelParams)
+                  if not name.startswith("_") and not callable(getattr(SystemModelParams, name))}
+        return {
+            "system_model_params": params,
+            "samples_size": int(samples_size),
+            "seed": int(seed),
+            "true_doa": true_doa,
+            "true_range": true_range,
+            "generator_version": GENERATOR_VERSION,
+        }
+
+    @classmethod
+    def get_key(cls, system_model_params: SystemModelParams, samples_size: int, seed: int, true_doa: list = None,
+                true_range: list = None) -> str:
+        """Returns the key of a dataset, a hash of its settings."""
+        description = cls.describe(system_model_params, samples_size, seed, true_doa, true_range)
+        # tuples (e.g. a random M range) and lists are serialized alike
+        encoded = json.dumps(description, sort_keys=True, default=str)
+        return hashlib.sha256(encoded.encode()).hexdigest()[:32]
+
+    def get(self, key: str):
+        """Returns the cached dataset of the given key, or None if it isn't cached."""
+        entry = self.manifest.get(key)
+        if entry is None:
+            return None
+        path = self.cache_dir / entry["file_name"]
+        if not path.exists():
+            # the file was removed externally
+            del self.manifest[key]
+            self.__save_manifest()
+            return None
+        entry["last_access"] = time.time()
+        self.__save_manifest()
+        return TimeSeriesDataset(None, None, None).load(path)
+
+    def get_or_create(self, system_model_params: SystemModelParams, samples_size: int, seed: int = 42,
+                      true_doa: list = None, true_range: list = None, storage_format: str = "h5",
+                      num_workers: int = 1):
+        """
+        Returns the dataset of the given settings from the cache, generates and caches it if needed.
+
+        Args:
+        -----
+            system_model_params (SystemModelParams): an instance of SystemModelParams.
+            samples_size (int): The size of the dataset.
+            seed (int, optional): The seed of the dataset, which also sets the sensors location noise.
+                Defaults to 42.
+            true_doa (list, optional): Predefined angles. Defaults to None.
+            true_range (list, optional): Predefined ranges. Defaults to None.
+            storage_format (str, optional): The format of a generated dataset, "h5" or "npy". Defaults to "h5".
+            num_workers (int, optional): The number of processes used for a generation. Defaults to 1.
+
+        Returns:
+        --------
+            TimeSeriesDataset: The dataset, read lazily from the cache.
+        """
+        key = self.get_key(system_model_params, samples_size, seed, true_doa, true_range)
+        dataset = self.get(key)
+        if dataset is not None:
+            return dataset
+        # the samples model draws the sensors location noise, seed it as well
+        with _seeded_random_state(seed):
+            samples_model = Samples(system_model_params)
+        dataset, _ = create_dataset(samples_model, samples_size, true_doa=true_doa, true_range=true_range,
+                                    num_workers=num_workers, seed=seed)
+        file_name = key + (".npy" if storage_format == "npy" else ".h5")
+        path = self.cache_dir / file_name
+        if storage_format == "npy":
+            dataset.save_memmap(path)
+        elif storage_format == "h5":
+            dataset.save(path)
+        else:
+            raise ValueError(f"DatasetCache.get_or_create: storage format {storage_format} is not defined")
+        self.manifest[key] = {
+            **self.describe(system_model_params, samples_size, seed, true_doa, true_range),
+            "file_name": file_name,
+            "size_bytes": self.__get_size(path),
+            "created": time.time(),
+            "last_access": time.time(),
+        }
+        self.evict(keep=key)
+        return TimeSeriesDataset(None, None, None).load(path)
+
+    def evict(self, keep: str = None):
+        """Removes the least recently used entries until the cache fits its disk budget, except for keep."""
+        if self.max_bytes is None:
+            self.__save_manifest()
+            return
+        by_last_access = sorted(self.manifest, key=lambda k: self.manifest[k]["last_access"])
+        total_bytes = sum(entry["size_bytes"] for entry in self.manifest.values())
+        for key in by_last_access:
+            if total_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total_bytes -= self.manifest[key]["size_bytes"]
+            self.remove(key, save_manifest=False)
+        self.__save_manifest()
+
+    def remove(self, key: str, save_manifest: bool = True):
+        """Removes an entry and its file from the cache."""
+        entry = self.manifest.pop(key, None)
+        if entry is not None:
+            path = self.cache_dir / entry["file_name"]
+            if path.is_dir():
+                shutil.rmtree(path)
+            elif path.exists():
+                path.unlink()
+        if save_manifest:
+            self.__save_manifest()
+
+    def get_size(self) -> int:
+        """Returns the total size of the cached datasets, in bytes."""
+        return sum(entry["size_bytes"] for entry in self.manifest.values())
+
+    @staticmethod
+    def __get_size(path: Path) -> int:
+        if path.is_dir():
+            return sum(f.stat().st_size for f in path.iterdir())
+        return path.stat().st_size
+
+    def __load_manifest(self) -> dict:
+        manifest_path = self.cache_dir / self.MANIFEST_NAME
+        if not manifest_path.exists():
+            return {}
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+
+    def __save_manifest(self):
+        # write to a temporary file first, so an interrupted write never corrupts the manifest
+        manifest_path = self.cache_dir / self.MANIFEST_NAME
+        tmp_path = manifest_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=2, default=str)
+        os.replace(tmp_path, manifest_path)
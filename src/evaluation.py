@@ -21,6 +21,8 @@ Functions:
 evaluate_dnn_model: Evaluate the DNN model on a given dataset.
 evaluate_augmented_model: Evaluate an augmented model that combines a SubspaceNet model.
 evaluate_model_based: Evaluate different model-based algorithms on a given dataset.
+shared_covariances: Calculates the covariances of a batch once, for all the model-based methods.
+evaluate_model_based_methods: Evaluate several model-based algorithms in a single pass over the dataset.
 add_random_predictions: Add random predictions if the number of predictions
     is less than the number of sources.
 evaluate: Wrapper function for model and algorithm evaluations.
@@ -39,14 +41,16 @@ from pathlib import Path
 
 # Internal imports
 from src.config import device
-from src.methods_pack.music import MUSIC
-from src.methods_pack.root_music import RootMusic, root_music
-from src.methods_pack.esprit import ESPRIT
+from src.methods_pack.music import MUSIC, UnitaryMUSIC
+from src.methods_pack.root_music import RootMusic, UnitaryRootMusic, root_music
+from src.methods_pack.esprit import ESPRIT, UnitaryESPRIT
 from src.methods_pack.beamformer import Beamformer
 from src.methods_pack.csestimator import CsEstimator
+from src.methods_pack.subspace_method import eigen_cache
 from src.models import (ModelGenerator, SubspaceNet, DCDMUSIC, DeepAugmentedMUSIC,
                         DeepCNN, DeepRootMUSIC, TransMUSIC)
 from src.system_model import SystemModel, SystemModelParams
+from src.utils import sample_covariance, spatial_smoothing_covariance
 
 
 def get_model_based_method(method_name: str, system_model_params: SystemModelParams):
@@ -55,6 +59,7 @@ def get_model_based_method(method_name: str, system_model_params: SystemModelPar
     Parameters
     ----------
     method_name(str): the method to use - music_1d, music_2d, root_music, esprit...
+        The "unitary-" variants of 1d-music, root-music and esprit use the real-valued processing of a far field ULA.
     system_model(SystemModel) : the system model to use as an argument to the method class.
 
     Returns
@@ -62,7 +67,13 @@ def get_model_based_method(method_name: str, system_model_params: SystemModelPar
     an instance of the method.
     """
     system_model = SystemModel(system_model_params, nominal=True)
-    if method_name.lower().endswith("1d-music"):
+    if method_name.lower() == "unitary-1d-music":
+        method = UnitaryMUSIC(system_model)
+    elif method_name.lower() == "unitary-root-music":
+        method = UnitaryRootMusic(system_model)
+    elif method_name.lower() == "unitary-esprit":
+        method = UnitaryESPRIT(system_model)
+    elif method_name.lower().endswith("1d-music"):
         method = MUSIC(system_model=system_model, estimation_parameter="angle")
     elif method_name.lower().endswith("2d-music"):
         method = MUSIC(system_model=system_model, estimation_parameter="angle, range", model_order_estimation="aic")
@@ -220,7 +231,8 @@ def evaluate_augmented_model(augmented_method: tuple[str, str],
     # Gradients calculation isn't required for evaluation
     with torch.no_grad():
         for i, data in enumerate(dataset):
-            if algorithm.lower() in ["1d-music", "2d-music", "esprit", "root-music", "beamformer", "tops"]:
+            if algorithm.lower() in ["1d-music", "2d-music", "esprit", "root-music", "beamformer", "tops",
+                                     "unitary-1d-music", "unitary-esprit", "unitary-root-music"]:
                 tmp_rmspe, tmp_acc, tmp_length = method.test_step(data, i, model)
                 if isinstance(tmp_rmspe, tuple):
                     tmp_rmspe, tmp_rmspe_angle, tmp_rmspe_range = tmp_rmspe
@@ -262,51 +274,97 @@ def evaluate_model_based(dataset: DataLoader, system_model_params: SystemModelPa
     Raises:
         Exception: If the algorithm is not supported.
     """
-    # Initialize parameters for evaluation
-    over_all_loss = 0.0
-    angle_loss, distance_loss, acc = None, None, None
-    test_length = 0
-    if algorithm.lower() == "ccrb":
-        if system_model_params.signal_nature.lower() == "non-coherent":
-            crb = evaluate_crb(dataset, system_model_params, mode="cartesian")
-            return crb
+    return evaluate_model_based_methods(dataset, system_model_params, [algorithm])[algorithm]
+
+
+def shared_covariances(x: torch.Tensor, signal_nature: str, features: dict = None) -> dict:
+    """
+    Calculates the covariances of a batch once, for all the model-based methods, in the layout of the precomputed
+    features, which SubspaceMethod.pre_processing takes as is. The precomputed covariances, if any, are kept.
+
+    Args:
+        x (torch.Tensor): The input signal with dim BxNxT, on the device.
+        signal_nature (str): "coherent" to calculate the spatially smoothed covariance as well.
+        features (dict, optional): The precomputed features of the batch. Defaults to None.
+
+    Returns:
+        dict: The features of the batch, with "sample_covariance", and "sps_covariance" for coherent sources.
+    """
+    features = dict(features) if features is not None else {}
+    if "sample_covariance" not in features:
+        features["sample_covariance"] = sample_covariance(x)
+    if signal_nature == "coherent" and "sps_covariance" not in features:
+        features["sps_covariance"] = spatial_smoothing_covariance(x)
+    return features
+
+
+def evaluate_model_based_methods(dataset: DataLoader, system_model_params: SystemModelParams, algorithms: list,
+                                  inference_times: dict = None):
+    """
+    Evaluate several model-based algorithms in a single pass over the dataset.
+    Each batch is read and moved to the device once, its covariances are calculated once by shared_covariances,
+    and the batch is passed to the test_step of every algorithm, which accumulates its own losses. The subspace
+    methods decompose each covariance once, through the shared eigen_cache.
+
+    Args:
+        dataset (DataLoader): The evaluation dataset.
+        system_model_params (SystemModelParams): The system model parameters of the algorithms.
+        algorithms (list): The algorithms to evaluate, as named by get_model_based_method, and "ccrb".
+        inference_times (dict, optional): If given, filled with the inference time, in seconds, of each algorithm
+            over the whole dataset. Defaults to None.
+
+    Returns:
+        dict: The losses of each algorithm, as returned by evaluate_model_based, and None for the CCRB of coherent
+            sources.
+    """
+    results = {}
+    methods = {}
+    for algorithm in algorithms:
+        if algorithm.lower() == "ccrb":
+            if system_model_params.signal_nature.lower() == "non-coherent":
+                results[algorithm] = evaluate_crb(dataset, system_model_params, mode="cartesian")
+            else:
+                results[algorithm] = None
         else:
-            return None
-    model_based = get_model_based_method(algorithm, system_model_params)
-    if isinstance(model_based, nn.Module):
-        model_based = model_based.to(device)
-        # Set model to eval mode
-        model_based.eval()
+            methods[algorithm] = get_model_based_method(algorithm, system_model_params)
+    if not methods:
+        return {algorithm: results[algorithm] for algorithm in algorithms}
+    losses = {algorithm: {"Overall": 0.0, "Angle": None, "Distance": None, "Accuracy": None} for algorithm in methods}
+    times = dict.fromkeys(methods, 0.0)
+    test_length = 0
     # Gradients calculation isn't required for evaluation
     with torch.no_grad():
         for i, data in enumerate(dataset):
-            tmp_rmspe, tmp_acc, tmp_length = model_based.test_step(data, i)
-            if isinstance(tmp_rmspe, tuple):
-                tmp_rmspe, tmp_rmspe_angle, tmp_rmspe_range = tmp_rmspe
-                if angle_loss is None:
-                    angle_loss = 0.0
-                if distance_loss is None:
-                    distance_loss = 0.0
-                angle_loss += tmp_rmspe_angle
-                distance_loss += tmp_rmspe_range
-            over_all_loss += tmp_rmspe
-            if acc is None:
-                acc = 0.0
-
-            acc += tmp_acc
-            test_length += tmp_length
+            x, sources_num, label = data[:3]
+            if x.dim() == 2:
+                x = x.unsqueeze(0)
+            x = x.to(device)
+            features = shared_covariances(x, system_model_params.signal_nature, data[3] if len(data) > 3 else None)
+            batch = (x, sources_num, label, features)
+            for algorithm, method in methods.items():
+                start = time.time()
+                tmp_rmspe, tmp_acc, tmp_length = method.test_step(batch, i)
+                times[algorithm] += time.time() - start
+                loss = losses[algorithm]
+                if isinstance(tmp_rmspe, tuple):
+                    tmp_rmspe, tmp_rmspe_angle, tmp_rmspe_range = tmp_rmspe
+                    loss["Angle"] = (loss["Angle"] or 0.0) + tmp_rmspe_angle
+                    loss["Distance"] = (loss["Distance"] or 0.0) + tmp_rmspe_range
+                loss["Overall"] += tmp_rmspe
+                loss["Accuracy"] = (loss["Accuracy"] or 0.0) + tmp_acc
+            test_length += x.shape[0]
+        # release the covariances of the last batch held by the eigen cache
+        eigen_cache.clear()
         # clear cache
         try:
             torch.cuda.empty_cache()
         except AttributeError:
             pass
-        result = {"Overall": over_all_loss / test_length}
-        if distance_loss is not None and angle_loss is not None:
-            result["Angle"] = angle_loss / test_length
-            result["Distance"] = distance_loss / test_length
-        if acc is not None:
-            result["Accuracy"] = acc / test_length
-    return result
+    if inference_times is not None:
+        inference_times.update(times)
+    for algorithm, loss in losses.items():
+        results[algorithm] = {name: value / test_length for name, value in loss.items() if value is not None}
+    return {algorithm: results[algorithm] for algorithm in algorithms}
 
 
 def add_random_predictions(M: int, predictions: np.ndarray, algorithm: str):
@@ -345,7 +403,7 @@ def evaluate_crb(dataset: DataLoader,
         system_model = SystemModel(params, nominal=True)
         if params.signal_nature.lower() == "non-coherent":
             for i, data in enumerate(dataset):
-                _, _, angles = data
+                _, _, angles = data[:3]
                 angles = angles.to(device)
                 derivative_mat = system_model.steering_derivative(angles)
                 steering_mat = system_model.steering_vec_far_field(angles, nominal=True)
@@ -370,7 +428,7 @@ def evaluate_crb(dataset: DataLoader,
             ccrb_distance = 0.0
             ccrb_cartesian = 0.0
             for i, data in enumerate(dataset):
-                _, _, labels = data
+                _, _, labels = data[:3]
                 angles = labels[:, :labels.shape[1] // 2]
                 distances = labels[:, labels.shape[1] // 2:]
                 angles = angles.to(device)
@@ -511,14 +569,19 @@ def evaluate(
             system_model_params=system_model_params,
         )
         res["augmented" + f"_{algorithm[0]}_{algorithm[1]}"] = loss
-    # Evaluate classical subspace methods
+    # Evaluate classical subspace methods, in a single pass over the dataset
     # system_model.create_array()
-    for algorithm in subspace_methods:
-        start = time.time()
-        loss = evaluate_model_based(generic_test_dataset, system_model_params, algorithm=algorithm)
-        if system_model_params.signal_nature == "coherent" and algorithm.lower() in ["1d-music", "2d-music", "root-music", "esprit"]:
+    start = time.time()
+    inference_times = {}
+    losses = evaluate_model_based_methods(generic_test_dataset, system_model_params, subspace_methods,
+                                          inference_times=inference_times)
+    for algorithm, inference_time in inference_times.items():
+        print(f"{algorithm} inference time: {inference_time}")
+    print(f"subspace methods evaluation time: {time.time() - start}")
+    for algorithm, loss in losses.items():
+        if system_model_params.signal_nature == "coherent" and algorithm.lower() in [
+                "1d-music", "2d-music", "root-music", "esprit", "unitary-1d-music", "unitary-root-music", "unitary-esprit"]:
             algorithm += "(SPS)"
-        print(f"{algorithm} evaluation time: {time.time() - start}")
         if loss is not None:
             res[algorithm] = loss
     # MLE
@@ -3,14 +3,16 @@ This file contain an implementation for a Beamformer to use for Far field(DOA) a
 """
 import torch
 from torch.nn import Module
-from scipy.signal import find_peaks
 import matplotlib.pyplot as plt
 import numpy as np
 import warnings
 
 
 from src.system_model import SystemModel
-from src.utils import sample_covariance, keep_far_enough_points
+from src.methods_pack.grid_search import CoarseToFineSearch, refine_peaks
+from src.methods_pack.peak_finder import find_peaks_1d, find_peaks_2d
+from src.methods_pack.fft_spectrum import FFTSpectrum, NearFieldFFTSpectrum
+from src.utils import sample_covariance
 from src.metrics import CartesianLoss, RMSPELoss
 from src.config import device
 
@@ -22,18 +24,90 @@ class Beamformer(Module):
         self.system_model = system_model
         self.angles_dict = None
         self.ranges_dict = None
-        self.steering_dict = None
+        # built on its first use, see steering_dict
+        self.__steering_dict = None
+        # "dense" scans the whole grid, "coarse_to_fine" refines the peaks of a coarse grid, see set_search_mode
+        self.search_mode = "dense"
+        self.coarse_to_fine = None
+        # the iterations of the off-grid refinement of the peaks, 0 for the grid peaks, see set_peak_refinement
+        self.refinement_iterations = 0
+        # "direct" evaluates the spectrum with the steering dictionary, "fft" by an FFT of the covariance, see
+        # set_spectrum_mode
+        self.spectrum_mode = "direct"
+        self.fft_spectrum = None
         self.__init_grid_params()
-        self.__init_steering_dict()
         self.__init_criteria()
         self.eval()  # This a torch based model without any trainable parameters.
 
+    @property
+    def steering_dict(self) -> torch.Tensor:
+        """
+        The steering dictionary of the search grid, built on its first use, so the fft spectrum mode, which doesn't
+        use it, never builds it.
+        """
+        if self.__steering_dict is None:
+            self.__init_steering_dict()
+        return self.__steering_dict
+
     def forward(self, cov: torch.Tensor, sources_num: int):
-        spectrum = self.get_spectrum(cov)
-        peaks = self.find_peaks(spectrum, sources_num)
-        labels = self.get_labels(peaks)
+        if self.search_mode == "coarse_to_fine":
+            labels = self.__coarse_to_fine_labels(cov, sources_num)
+        else:
+            spectrum = self.get_spectrum(cov)
+            peaks = self.find_peaks(spectrum, sources_num)
+            labels = self.get_labels(peaks)
+        if self.refinement_iterations > 0:
+            labels = self.__refine_labels(labels, cov)
         return labels
 
+    def set_search_mode(self, mode: str, coarse_step=4, candidates_factor: int = 2):
+        """
+        Sets the peak search of the beamformer.
+        "dense" computes the spectrum over the whole grid, "coarse_to_fine" computes it over a grid decimated by
+        coarse_step and refines candidates_factor candidates for each source locally, see CoarseToFineSearch.
+        The coarse to fine search is for the far field only. The near field peaks are the highest range maxima of
+        angles at least 10 grid points apart, often on the slope of a stronger source, which a search of the local
+        peaks can't keep even at a coarse step of 1.
+        """
+        if mode == "dense":
+            self.coarse_to_fine = None
+        elif mode == "coarse_to_fine":
+            if self.ranges_dict is not None:
+                raise ValueError("Beamformer.set_search_mode: the coarse to fine search doesn't support the near "
+                                 "field")
+            self.coarse_to_fine = CoarseToFineSearch(self.system_model, self.angles_dict, self.ranges_dict,
+                                                     coarse_step=coarse_step, candidates_factor=candidates_factor)
+        else:
+            raise ValueError(f"Beamformer.set_search_mode: unknown search mode {mode}")
+        self.search_mode = mode
+
+    def set_spectrum_mode(self, mode: str, oversampling: int = 4):
+        """
+        Sets the evaluation of the spectrum. "direct" multiplies the covariance by the steering dictionary,
+        "fft" evaluates the far field spectrum a^H R a of a ULA over the whole grid by a single FFT of the diagonal
+        sums of the covariance, interpolated onto the angles grid, see FFTSpectrum. In the near field, it evaluates
+        the angle and range spectrum by an FFT of the chirp modulated covariance per node of the cos(theta)^2 / r
+        axis, see NearFieldFFTSpectrum.
+        oversampling is the ratio of the FFT size to the grid size of "fft".
+        """
+        if mode == "direct":
+            self.fft_spectrum = None
+        elif mode == "fft":
+            if self.system_model.params.field_type.lower() == "far":
+                self.fft_spectrum = FFTSpectrum(self.system_model, self.angles_dict, oversampling=oversampling)
+            else:
+                self.fft_spectrum = NearFieldFFTSpectrum(self.system_model, self.angles_dict, self.ranges_dict,
+                                                         oversampling=oversampling)
+        else:
+            raise ValueError(f"Beamformer.set_spectrum_mode: unknown spectrum mode {mode}")
+        self.spectrum_mode = mode
+
+    def set_peak_refinement(self, iterations: int = 10):
+        """Sets the number of iterations of the off-grid refinement of the peaks, see refine_peaks, 0 disables it."""
+        if iterations < 0:
+            raise ValueError(f"Beamformer.set_peak_refinement: iterations must be non-negative, got {iterations}")
+        self.refinement_iterations = iterations
+
     def beam_pattern(self, cov: torch.Tensor):
         """
         The MVDR beamformer implementation. it will return the optimal weights for the given input signal.
@@ -157,6 +231,8 @@ class Beamformer(Module):
         Returns:
             torch.Tensor: the outcome of the beamformer for Far or Near field cases.
         """
+        if self.spectrum_mode == "fft":
+            return self.fft_spectrum(cov)
         if self.system_model.params.field_type.lower() == "far":
             # in this case, the steering search space is 2D -> NxA, whereas A is the size of the search grid.
             v1 = torch.einsum("an, bnm -> bam", self.steering_dict.conj().transpose(0, 1), cov)
@@ -206,17 +282,20 @@ class Beamformer(Module):
         return labels
 
     @staticmethod
-    def pre_processing(x: torch.Tensor, mode: str = "sample"):
+    def pre_processing(x: torch.Tensor, mode: str = "sample", features: dict = None):
         """
         The pre-processing stage of the beamformer is the calculation of the sample covariance.
 
         Args:
             x: The input signal with dim BxNxT, for B the batch size, N the number of sensors,
                 and T the number of snapshots.
+            features: The precomputed features of the batch, if any, holding the sample covariance.
 
         Returns:
             tensor: a Tensor of size BxNxN represent the sample covariance for each element in the batch.
         """
+        if mode == "sample" and features is not None and "sample_covariance" in features:
+            return features["sample_covariance"].to(x.device)
         if mode == "sample":
             cov = sample_covariance(x)
         else:
@@ -224,7 +303,9 @@ class Beamformer(Module):
         return cov
 
     def test_step(self, batch, batch_idx: int, model: Module=None):
-        x, sources_num, label = batch
+        x, sources_num, label = batch[:3]
+        # precomputed covariances from the feature store, if any
+        features = batch[3] if len(batch) > 3 else None
         if x.dim() == 2:
             x = x.unsqueeze(0)
         test_length = x.shape[0]
@@ -246,7 +327,7 @@ class Beamformer(Module):
         if model is not None:
             Rx = model.get_surrogate_covariance(x)
         else:
-            Rx = self.pre_processing(x)
+            Rx = self.pre_processing(x, features=features)
         predictions = self(Rx, sources_num)
         # self.plot_beam_pattern(self.beam_pattern(Rx)[0], angles[0], ranges[0])
         if isinstance(predictions, tuple):
@@ -255,57 +336,51 @@ class Beamformer(Module):
             _, rmspe_angle, rmspe_range = self.separated_criterion(angles_prediction, angles, ranges_prediction, ranges)
             rmspe = (rmspe, rmspe_angle.sum().item(), rmspe_range.sum().item())
         else:
-            rmspe = self.criterion(predictions, angles).item()
+            rmspe = self.criterion(predictions, angles).sum().item()
 
         return rmspe, 0, test_length
 
+    def __coarse_to_fine_labels(self, cov: torch.Tensor, sources_num: int):
+        """Finds the peaks of the spectrum by the coarse to fine search, and returns the labels as get_labels."""
+        cov = cov.to(torch.complex128)
+
+        def spectrum_fn(steering: torch.Tensor, samples: torch.Tensor = None) -> torch.Tensor:
+            steering = steering.to(cov.dtype)
+            samples_cov = cov if samples is None else cov[samples.to(cov.device)]
+            return torch.real(torch.sum(steering.conj() * torch.matmul(samples_cov, steering), dim=1))
+
+        angle_idx, range_idx, _ = self.coarse_to_fine.search(spectrum_fn, sources_num, cov.shape[0],
+                                                             device=self.device)
+        angle_idx, range_idx = angle_idx.to(self.device), range_idx.to(self.device)
+        if self.ranges_dict is None:
+            return self.get_labels(angle_idx)
+        return self.get_labels(torch.cat((angle_idx, range_idx), dim=1))
+
+    def __refine_labels(self, labels, cov: torch.Tensor):
+        """Refines the grid peaks off the grid, by maximizing the beamformer output."""
+        angle_step = (self.angles_dict[1] - self.angles_dict[0]).item()
+        if not isinstance(labels, tuple):
+            return refine_peaks(self.system_model, -cov, labels, angle_step=angle_step,
+                                iterations=self.refinement_iterations)
+        range_step = (self.ranges_dict[1] - self.ranges_dict[0]).item()
+        return refine_peaks(self.system_model, -cov, *labels, angle_step=angle_step, range_step=range_step,
+                            iterations=self.refinement_iterations)
+
     def __find_peaks_far_field(self, spectrum: torch.Tensor, known_number_of_sources):
         source_number = self.system_model.params.M
         if isinstance(source_number, tuple):
             source_number = known_number_of_sources
-        batch_size = spectrum.shape[0]
-
-        peaks = torch.zeros(batch_size, source_number, dtype=torch.int64, device=self.device)
-        for batch in range(batch_size):
-            elem_spectrum = spectrum[batch].cpu().detach().numpy().squeeze()
-            # Find spectrum peaks
-            peaks_tmp = find_peaks(elem_spectrum, threshold=0.0)[0]
-            if len(peaks_tmp) < source_number:
-                warnings.warn(f"Beamformer.__find_peaks_far_field: No peaks were found! taking max values instead.")
-                # random_peaks = np.random.randint(0, search_space.shape[0], (source_number - peaks_tmp.shape[0],))
-                random_peaks = torch.topk(self.angles_dict, source_number - peaks_tmp.shape[0],
-                                          largest=True).indices.cpu().detach().numpy()
-                peaks_tmp = np.concatenate((peaks_tmp, random_peaks))
-            # Sort the peak by their amplitude
-            sorted_peaks = peaks_tmp[np.argsort(elem_spectrum[peaks_tmp])[::-1]]
-            peaks[batch] = torch.from_numpy(sorted_peaks[0:source_number]).to(self.device)
-        # if the model is not in training mode, return the peaks
+        # the peaks of the whole batch at once, sorted by their amplitude
+        peaks = find_peaks_1d(spectrum.reshape(spectrum.shape[0], -1), source_number,
+                              caller="Beamformer.__find_peaks_far_field").to(self.device)
         return peaks
 
     def __find_peaks_near_field(self, spectrum: torch.Tensor, known_number_of_sources: int):
-        batch_size = spectrum.shape[0]
-
-        max_row = torch.zeros((batch_size, known_number_of_sources)
-                              , dtype=torch.int64, device=self.device)
-        max_col = torch.zeros((batch_size, known_number_of_sources)
-                              , dtype=torch.int64, device=self.device)
-        for batch in range(batch_size):
-            elem_spectrum = spectrum[batch].detach().cpu().numpy().squeeze()
-            # Flatten the spectrum
-            spectrum_flatten = elem_spectrum.flatten()
-            # Find spectrum peaks
-            peaks = find_peaks(spectrum_flatten)[0]
-            # Sort the peak by their amplitude
-            sorted_peaks = peaks[np.argsort(spectrum_flatten[peaks])[::-1]]
-            # convert the peaks to 2d indices
-            original_idx = torch.from_numpy(np.column_stack(np.unravel_index(sorted_peaks, elem_spectrum.shape))).T
-            if known_number_of_sources > 1:
-                # pass
-                original_idx = keep_far_enough_points(original_idx, known_number_of_sources, 10)
-            max_row[batch] = original_idx[0][0: known_number_of_sources]
-            max_col[batch] = original_idx[1][0: known_number_of_sources]
-        # if the model is not in training mode, return the peaks.
-        peaks = torch.cat((max_row, max_col), dim=1)
+        # the local maxima along the ranges, at least 10 angles apart from each other
+        max_row, max_col = find_peaks_2d(spectrum, known_number_of_sources, neighborhood=(1, 3),
+                                         separation=(10, spectrum.shape[-1]),
+                                         caller="Beamformer.__find_peaks_near_field")
+        peaks = torch.cat((max_row, max_col), dim=1).to(self.device)
         return peaks
 
     def __init_grid_params(self):
@@ -338,11 +413,7 @@ class Beamformer(Module):
         Returns:
             None.
         """
-        if self.ranges_dict is None:
-            self.steering_dict = self.system_model.steering_vec_far_field(self.angles_dict, nominal=True)
-        else:
-            self.steering_dict = self.system_model.steering_vec_near_field(self.angles_dict, self.ranges_dict,
-                                                                nominal=True, generate_search_grid=True)
+        self.__steering_dict = self.system_model.get_steering_dict(self.angles_dict, self.ranges_dict)
 
     def __init_criteria(self):
         if self.system_model.params.field_type.lower() == "far":
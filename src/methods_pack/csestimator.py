@@ -10,9 +10,9 @@ import numpy as np
 from src.system_model import SystemModel
 from src.metrics import CartesianLoss, RMSPELoss
 from src.config import device
+from src.methods_pack.peak_finder import find_peaks_2d
 
 from sklearn.linear_model import Lasso
-from scipy.signal import find_peaks
 import matplotlib.pyplot as plt
 
 
@@ -53,12 +53,12 @@ class CsEstimator(nn.Module):
             estimated_signal_norm = torch.mean(estimated_signal_norm, dim=-1)
 
         if estimated_signal_norm.dim() == 2:
-            max_indices = torch.zeros(estimated_signal_norm.size(0), self.system_model.params.M, device=self.device)
-            for i in range(estimated_signal_norm.size(0)):
-                flatten_signal = estimated_signal_norm[i].cpu().numpy()
-                peaks = find_peaks(flatten_signal, distance=int(len(self.ranges_dict)*2))[0]
-                sorted_peaks = peaks[np.argsort(flatten_signal[peaks])[::-1]]
-                max_indices[i] = torch.tensor(sorted_peaks[:self.system_model.params.M], device=self.device)
+            # the local maxima along the ranges, at least 2 angles apart from each other
+            max_row, max_col = find_peaks_2d(estimated_signal_norm.reshape(-1, *self.steering_matrix_dict.shape[1:]),
+                                             self.system_model.params.M, neighborhood=(1, 3),
+                                             separation=(2, self.steering_matrix_dict.size(2)),
+                                             caller="CsEstimator.estimate_doa_range")
+            max_indices = (max_row * self.steering_matrix_dict.size(2) + max_col).to(self.device)
             # max_indices = torch.topk(estimated_signal_norm, self.system_model.params.M, dim=1).indices
         elif estimated_signal_norm.size(-1) > self.system_model.params.M:
             estimated_signal_norm = torch.mean(estimated_signal_norm, dim=-1)
@@ -151,7 +151,8 @@ class CsEstimator(nn.Module):
 
 
     def test_step(self, batch, batch_idx: int, model: nn.Module=None):
-        x, sources_num, label, masks = batch
+        # the estimator works on the samples, the precomputed covariances of the batch, if any, are not used
+        x, sources_num, label = batch[:3]
         if x.dim() == 2:
             x = x.unsqueeze(0)
         test_length = x.shape[0]
@@ -160,7 +161,6 @@ class CsEstimator(nn.Module):
             angles, ranges = torch.split(label, max(sources_num), dim=1)
             angles = angles.to(self.device)
             ranges = ranges.to(self.device)
-            masks, _ = torch.split(masks, max(sources_num), dim=1)  # TODO
         else:
             angles = label.to(self.device)  # only angles
 
@@ -175,11 +175,11 @@ class CsEstimator(nn.Module):
         predictions, estimated_signal = self(x)
         if isinstance(predictions, tuple):
             angles_prediction, ranges_prediction = predictions
-            rmspe = self.criterion(angles_prediction, angles, ranges_prediction, ranges).item()
+            rmspe = self.criterion(angles_prediction, angles, ranges_prediction, ranges).sum().item()
             _, rmspe_angle, rmspe_range = self.separated_criterion(angles_prediction, angles, ranges_prediction, ranges)
-            rmspe = (rmspe, rmspe_angle.item(), rmspe_range.item())
+            rmspe = (rmspe, rmspe_angle.sum().item(), rmspe_range.sum().item())
         else:
-            rmspe = self.criterion(predictions, angles).item()
+            rmspe = self.criterion(predictions, angles).sum().item()
 
         return rmspe, 0, test_length
 
@@ -207,8 +207,7 @@ class CsEstimator(nn.Module):
                                             device="cpu", dtype=torch.float64).requires_grad_(False)
 
     def __init_steering_matrix_dict(self):
-        self.steering_matrix_dict = self.system_model.steering_vec_near_field(self.angles_dict, self.ranges_dict,
-                                                                              nominal=True, generate_search_grid=True)
+        self.steering_matrix_dict = self.system_model.get_steering_dict(self.angles_dict, self.ranges_dict)
 
     def __init_criteria(self):
         self.criterion = CartesianLoss()
@@ -4,6 +4,7 @@ import torch.nn as nn
 from src.metrics import RMSPELoss
 from src.methods_pack.subspace_method import SubspaceMethod
 from src.system_model import SystemModel
+from src.utils import unitary_matrix, real_valued_subspace
 
 
 class ESPRIT(SubspaceMethod):
@@ -32,7 +33,9 @@ class ESPRIT(SubspaceMethod):
         return prediction, sources_estimation, regularization
 
     def test_step(self, batch, batch_idx, model: nn.Module=None):
-        x, sources_num, label = batch
+        x, sources_num, label = batch[:3]
+        # precomputed covariances from the feature store, if any
+        features = batch[3] if len(batch) > 3 else None
         if x.dim() == 2:
             x = x.unsqueeze(0)
         test_length = x.shape[0]
@@ -54,10 +57,10 @@ class ESPRIT(SubspaceMethod):
         else:
             if self.system_model.params.signal_nature == "coherent":
                 # Spatial smoothing
-                Rx = self.pre_processing(x, mode="sps")
+                Rx = self.pre_processing(x, mode="sps", features=features)
             else:
                 # Conventional
-                Rx = self.pre_processing(x, mode="sample")
+                Rx = self.pre_processing(x, mode="sample", features=features)
         angles_prediction, sources_num_estimation, _ = self(Rx, sources_num=sources_num)
         rmspe = self.criterion(angles_prediction, angles).sum().item()
         acc = self.source_estimation_accuracy(sources_num, sources_num_estimation)
@@ -70,6 +73,61 @@ class ESPRIT(SubspaceMethod):
     def __init_criteria(self):
         self.criterion = RMSPELoss(balance_factor=1.0)
 
+
+class UnitaryESPRIT(ESPRIT):
+    """
+    Unitary ESPRIT, the ESPRIT of a ULA in the real domain of the unitary transform.
+    The signal subspace is separated by the real-valued processing, see SubspaceMethod.set_processing, and mapped to
+    the real E_r = Re(Q^H E_s). The shift invariance K1 E_r Y = K2 E_r, for K1 + jK2 = 2 Q_{N-1}^H J_2 Q_N and J_2
+    the selection of the last N - 1 sensors, is solved by a real total least squares, and the eigenvalues of Y are
+    tan(mu / 2) of the spatial frequencies mu. It is equivalent to the total least squares ESPRIT of the
+    forward-backward averaged covariance. A least squares would weigh the errors by tan(mu / 2), and lose accuracy
+    towards the endfire.
+    """
+
+    def __init__(self, system_model: SystemModel, model_order_estimation: str = None):
+        super().__init__(system_model, model_order_estimation)
+        self.set_processing("real-valued")
+        # the real selection matrices K1 and K2, of size (N-1)xN, by the number of sensors
+        self.selection_matrices = {}
+
+    def forward(self, cov: torch.Tensor, sources_num: torch.tensor = None):
+        if sources_num is None:
+            M = self.system_model.params.M
+        else:
+            M = sources_num
+        signal_subspace, _, sources_estimation, regularization = self.subspace_separation(
+            cov,
+            number_of_sources=M
+        )
+        real_subspace = real_valued_subspace(signal_subspace)
+        rank = real_subspace.shape[-1]
+        first_selection, second_selection = self.get_selection_matrices(real_subspace.shape[1], real_subspace.device)
+        # the total least squares, by the right singular vectors V of [K1 E_r, K2 E_r], phi = -V_12 V_22^-1
+        stacked = torch.cat([torch.matmul(first_selection, real_subspace),
+                             torch.matmul(second_selection, real_subspace)], dim=-1)
+        right_vectors = torch.linalg.svd(stacked, full_matrices=False)[2].transpose(-2, -1)
+        phi = -torch.linalg.solve(right_vectors[..., rank:, rank:].transpose(-2, -1),
+                                  right_vectors[..., :rank, rank:].transpose(-2, -1)).transpose(-2, -1)
+        # the eigenvalues of the real phi are real, up to the estimation errors
+        eigvalues = torch.real(torch.linalg.eigvals(phi))
+        eigvals_phase = 2 * torch.arctan(eigvalues)
+        prediction = -1 * torch.arcsin((1 / torch.pi) * eigvals_phase)
+
+        return prediction, sources_estimation, regularization
+
+    def get_selection_matrices(self, number_of_sensors: int, device=None) -> (torch.Tensor, torch.Tensor):
+        """The real selection matrices K1 = Re(2 Q_{N-1}^H J_2 Q_N) and K2 = Im(2 Q_{N-1}^H J_2 Q_N)."""
+        if number_of_sensors not in self.selection_matrices:
+            selection = 2 * torch.matmul(unitary_matrix(number_of_sensors - 1).conj().T,
+                                         unitary_matrix(number_of_sensors)[1:])
+            self.selection_matrices[number_of_sensors] = torch.real(selection), torch.imag(selection)
+        first_selection, second_selection = self.selection_matrices[number_of_sensors]
+        return first_selection.to(device), second_selection.to(device)
+
+    def __str__(self):
+        return "unitary_esprit"
+
 # LEGACY CODE
 
 # def esprit(Rz: torch.Tensor, M: int, batch_size: int):
@@ -0,0 +1,191 @@
+"""
+This file contains the FFT evaluation of the spectra of a uniform linear array, shared by MUSIC and the Beamformer.
+For a ULA with elements at n * d, the far field quadratic form a(theta)^H Q a(theta) is a trigonometric polynomial
+in omega = 2 * pi * d * sin(theta) / wavelength, whose coefficients are the sums of the diagonals of Q.
+A single zero-padded Hermitian FFT of the diagonal sums evaluates it over a uniform omega grid, which is then linearly
+interpolated onto the omega of each point of the angles grid.
+In the near field, the Fresnel steering vector is the far field one times the chirp exp(j * pi * (n * d)^2 * kappa /
+wavelength), for kappa = cos(theta)^2 / r. For a fixed kappa, the quadratic form is the far field one of the chirp
+modulated Q, so the near field spectrum is evaluated by an FFT per node of a uniform kappa grid, and interpolated onto
+the (omega, kappa) of each point of the angles and ranges grid.
+"""
+import numpy as np
+import torch
+
+from src.system_model import SystemModel
+from src.utils import sum_of_diags_torch
+
+# default memory budget of the FFT of a batch tile
+FFT_MEMORY_BYTES = 512 * 1024 ** 2
+
+
+class FFTSpectrum:
+    """
+    Evaluates the far field quadratic form a^H Q a over an angles grid, in O(N^2 + L log L) per sample instead of
+    O(G * N^2), for L the FFT size and G the grid size.
+    The FFT size is oversampling times the grid size, rounded up to a power of 2, so the FFT grid is finer than the
+    angles grid around the broadside, and the interpolation error is small compared to the grid resolution.
+
+    Args:
+        system_model: the system model of a narrowband uniform linear array.
+        angles_dict: the angles grid, in radians, of size G.
+        oversampling: the ratio of the FFT size to the grid size. Defaults to 4.
+        memory_bytes: the memory budget of the FFT of a batch tile. Defaults to FFT_MEMORY_BYTES.
+    """
+    def __init__(self, system_model: SystemModel, angles_dict: torch.Tensor, oversampling: int = 4,
+                 memory_bytes: int = FFT_MEMORY_BYTES):
+        _check_params(system_model, oversampling, "FFTSpectrum")
+        self.system_model = system_model
+        self.angles_dict = angles_dict
+        self.oversampling = oversampling
+        self.memory_bytes = memory_bytes
+        self.fft_size = _fft_size(system_model.params.N, oversampling * len(angles_dict))
+        self.lower_bin, self.upper_bin, self.upper_weight = _angle_bins(system_model, angles_dict, self.fft_size)
+
+    def __call__(self, matrix: torch.Tensor) -> torch.Tensor:
+        """
+        Args:
+            matrix: the Hermitian matrices Q of the quadratic form, of size BxNxN, e.g. the noise projector of MUSIC
+                or the covariance of the Beamformer.
+
+        Returns:
+            torch.Tensor: the real quadratic form over the angles grid, of size BxG, on the device of the matrix.
+        """
+        device, N = matrix.device, matrix.shape[-1]
+        if 2 * N - 1 > self.fft_size:
+            raise ValueError(f"FFTSpectrum: the FFT size {self.fft_size} is too small for {N} sensors")
+        coefficients = _polynomial_coefficients(matrix.to(torch.complex128))
+        lower_bin, upper_bin = self.lower_bin.to(device), self.upper_bin.to(device)
+        upper_weight = self.upper_weight.to(device)
+        batch_tile = int(max(1, self.memory_bytes // (self.fft_size * 16)))
+        spectrum = []
+        for batch_start in range(0, coefficients.shape[0], batch_tile):
+            polynomial = torch.fft.hfft(coefficients[batch_start:batch_start + batch_tile], n=self.fft_size, dim=-1)
+            spectrum.append(torch.lerp(polynomial[:, lower_bin], polynomial[:, upper_bin], upper_weight))
+        return torch.cat(spectrum, dim=0)
+
+
+class NearFieldFFTSpectrum:
+    """
+    Evaluates the near field quadratic form a^H Q a over an angles and ranges grid, without the NxAxR steering
+    dictionary, in O(K * (N^2 + L log L) + A * R) per sample instead of O(A * R * N^2), for K the number of kappa
+    nodes and L the FFT size.
+    The FFT size is set as in FFTSpectrum. The kappa nodes are spaced such that the largest chirp phase,
+    pi * ((N - 1) * d)^2 * kappa / wavelength, changes by pi / (4 * oversampling) between two nodes, so K depends on
+    the array and the span of the ranges grid, not on its resolution, and fine range grids only add interpolations.
+    The near field spectrum is evaluated at the minima of MUSIC, so both interpolations are cubic, for an error small
+    compared to the depth of the minima.
+
+    Args:
+        system_model: the system model of a narrowband uniform linear array.
+        angles_dict: the angles grid, in radians, of size A.
+        ranges_dict: the ranges grid, of size R.
+        oversampling: the ratio of the FFT size to the angles grid size, and the density of the kappa nodes.
+            Defaults to 4.
+        memory_bytes: the memory budget of the FFTs of a batch tile. Defaults to FFT_MEMORY_BYTES.
+    """
+    def __init__(self, system_model: SystemModel, angles_dict: torch.Tensor, ranges_dict: torch.Tensor,
+                 oversampling: int = 4, memory_bytes: int = FFT_MEMORY_BYTES):
+        _check_params(system_model, oversampling, "NearFieldFFTSpectrum")
+        self.system_model = system_model
+        self.angles_dict = angles_dict
+        self.ranges_dict = ranges_dict
+        self.oversampling = oversampling
+        self.memory_bytes = memory_bytes
+        N = system_model.params.N
+        self.fft_size = _fft_size(N, oversampling * len(angles_dict))
+        self.lower_bin, _, upper_weight = _angle_bins(system_model, angles_dict, self.fft_size)
+        self.bin_weights = _cubic_weights(upper_weight)
+        angles = angles_dict.detach().cpu().to(torch.float64)
+        ranges = ranges_dict.detach().cpu().to(torch.float64)
+        kappa = torch.cos(angles)[:, None] ** 2 / ranges[None, :]
+        # the chirp rate of each sensor, kappa times it is the phase of its chirp
+        positions = torch.from_numpy(system_model.array[:N]).to(torch.float64) * system_model.dist_array_elems[
+            "narrowband"]
+        self.chirp_rates = np.pi * positions ** 2 / system_model.params.wavelength
+        kappa_min, kappa_max = kappa.min().item(), kappa.max().item()
+        max_step = np.pi / (4 * oversampling) / self.chirp_rates.max().item()
+        intervals_num = max(1, int(np.ceil((kappa_max - kappa_min) / max_step)))
+        step = max(kappa_max - kappa_min, np.finfo(np.float64).tiny) / intervals_num
+        # a node is added on each side of the span, for the cubic interpolation of its first and last intervals
+        self.kappa_nodes = kappa_min + step * torch.arange(-1, intervals_num + 2, dtype=torch.float64)
+        # the position of each grid point between the kappa nodes, AxR, the nodes of all the angles are flattened
+        position = (kappa - kappa_min) / step
+        lower_node = torch.floor(position).clamp(max=intervals_num - 1)
+        angles_offset = len(self.kappa_nodes) * torch.arange(len(angles_dict))[:, None]
+        self.lower_node = (lower_node.to(torch.long) + 1 + angles_offset).flatten()
+        self.node_weights = _cubic_weights(position - lower_node).flatten(1)
+
+    def __call__(self, matrix: torch.Tensor) -> torch.Tensor:
+        """
+        Args:
+            matrix: the Hermitian matrices Q of the quadratic form, of size BxNxN, e.g. the noise projector of MUSIC
+                or the covariance of the Beamformer.
+
+        Returns:
+            torch.Tensor: the real quadratic form over the grid, of size BxAxR, on the device of the matrix.
+        """
+        device, N = matrix.device, matrix.shape[-1]
+        if N != len(self.chirp_rates):
+            raise ValueError(f"NearFieldFFTSpectrum: expected {len(self.chirp_rates)} sensors, got {N}")
+        if 2 * N - 1 > self.fft_size:
+            raise ValueError(f"NearFieldFFTSpectrum: the FFT size {self.fft_size} is too small for {N} sensors")
+        # the chirp of each sensor at each kappa node, KxN, the chirp modulated Q is diag(c) Q diag(c)^H
+        chirp = torch.exp(-1j * self.kappa_nodes[:, None] * self.chirp_rates[None, :]).to(device)
+        chirp_outer = chirp[:, :, None] * chirp[:, None, :].conj()
+        lower_bin, bin_weights = self.lower_bin.to(device), self.bin_weights.to(device)
+        lower_node, node_weights = self.lower_node.to(device), self.node_weights.to(device)
+        nodes_num = len(self.kappa_nodes)
+        batch_tile = int(max(1, self.memory_bytes // ((nodes_num * self.fft_size + len(lower_node)) * 16)))
+        matrix = matrix.to(torch.complex128)
+        spectrum = []
+        for batch_start in range(0, matrix.shape[0], batch_tile):
+            modulated = matrix[batch_start:batch_start + batch_tile, None] * chirp_outer
+            polynomial = torch.fft.hfft(_polynomial_coefficients(modulated), n=self.fft_size, dim=-1)
+            # along omega, to the angles grid, and then along kappa, to the ranges of each angle, Shape: [b, A, K]
+            nodes_spectrum = sum(polynomial[..., (lower_bin + shift) % self.fft_size] * bin_weights[shift + 1]
+                                 for shift in range(-1, 3)).transpose(1, 2)
+            nodes_spectrum = nodes_spectrum.reshape(nodes_spectrum.shape[0], -1)
+            tile_spectrum = torch.zeros(nodes_spectrum.shape[0], len(lower_node), dtype=torch.float64, device=device)
+            for shift in range(-1, 3):
+                tile_spectrum.addcmul_(nodes_spectrum.index_select(1, lower_node + shift), node_weights[shift + 1])
+            spectrum.append(tile_spectrum)
+        return torch.cat(spectrum, dim=0).view(matrix.shape[0], len(self.angles_dict), len(self.ranges_dict))
+
+
+def _check_params(system_model: SystemModel, oversampling: int, caller: str):
+    if not system_model.params.signal_type.startswith("narrowband"):
+        raise ValueError(f"{caller}: signal type {system_model.params.signal_type} is not supported")
+    if oversampling < 1:
+        raise ValueError(f"{caller}: oversampling must be positive, got {oversampling}")
+
+
+def _fft_size(N: int, grid_size: int) -> int:
+    """The smallest power of 2 not smaller than the grid size and the 2N - 1 coefficients of the polynomial."""
+    return int(2 ** np.ceil(np.log2(max(grid_size, 2 * N - 1))))
+
+
+def _angle_bins(system_model: SystemModel, angles_dict: torch.Tensor, fft_size: int) -> tuple:
+    """The FFT bins around the omega of each angle, and the weight of the upper one."""
+    spacing = system_model.dist_array_elems["narrowband"] / system_model.params.wavelength
+    omega = 2 * np.pi * spacing * torch.sin(angles_dict.detach().cpu().to(torch.float64))
+    # the position of each angle on the FFT grid, whose bins are 2 * pi / L apart, starting at omega = 0
+    position = torch.remainder(omega, 2 * np.pi) * fft_size / (2 * np.pi)
+    lower_bin = torch.floor(position).to(torch.long) % fft_size
+    return lower_bin, (lower_bin + 1) % fft_size, position - torch.floor(position)
+
+
+def _cubic_weights(t: torch.Tensor) -> torch.Tensor:
+    """The weights of the 4 nodes -1, 0, 1, 2 of the cubic Lagrange interpolation at t in [0, 1], 4x(t shape)."""
+    return torch.stack([-t * (t - 1) * (t - 2) / 6, (t + 1) * (t - 1) * (t - 2) / 2,
+                        -(t + 1) * t * (t - 2) / 2, (t + 1) * t * (t - 1) / 6])
+
+
+def _polynomial_coefficients(matrix: torch.Tensor) -> torch.Tensor:
+    """
+    The coefficients c_k of the powers e^{j k omega}, k = 0, ..., N - 1, the sums of the diagonals below the main one
+    of each matrix, of size ...xN. Q is Hermitian, so c_{-k} = conj(c_k) and the polynomial is real, a single
+    Hermitian FFT of the conjugated coefficients evaluates it.
+    """
+    N = matrix.shape[-1]
+    return sum_of_diags_torch(matrix)[..., :N].flip(-1).conj()
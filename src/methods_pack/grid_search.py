@@ -0,0 +1,327 @@
+"""
+This file contains the grid searches shared by MUSIC and the Beamformer.
+The coarse-to-fine search: instead of scanning the whole dense grid, the spectrum is evaluated on a decimated grid,
+and each of the highest candidate peaks climbs the dense grid: the dense grid is scanned around it, up to the
+neighbouring points of the coarse grid, and it moves to the highest point, until it stays at a local maximum of the
+dense peak finder. The samples whose candidates climbed to too few separated peaks refine the next candidates.
+The steering vectors of the refined points are computed on demand.
+The off-grid refinement: the peaks found on the grid are moved to the optimum of the continuous spectrum by a
+safeguarded Newton method, using the analytic derivatives of the steering vectors.
+"""
+import torch
+import torch.nn.functional as F
+
+from src.system_model import SystemModel
+
+
+class CoarseToFineSearch:
+    """
+    Finds the peaks of a spectrum over the dense grid of (angles, ranges), or of angles only, by a hierarchical search.
+    The results are indices in the dense grid, as the dense peak finders return.
+    The candidates of the coarse grid are refined by levels, whose strides are halved from the coarse step down to
+    the dense grid. At each level, a candidate climbs: the points up to the stride of the previous level around it
+    are scanned, and it moves to the highest one, until it stays. The narrow peaks of the near field lie on ridges,
+    which the candidates climb at the coarse strides first, in a few steps. A candidate which stays on the dense grid
+    is checked over the window of the local maxima of the dense peak finder, and climbs again if it isn't one.
+    The candidates of a strong peak may all climb to it, so the samples with fewer separated peaks than sources
+    refine their next coarse candidates, by rounds.
+
+    Args:
+        system_model: the system model, used for computing the steering vectors.
+        angles_dict: the dense angles grid, of size A.
+        ranges_dict: the dense ranges grid, of size R, or None for a search over the angles only.
+        coarse_step: the decimation of the dense grid in the coarse stage, in grid points, or a tuple of the
+            decimations of the angles and of the ranges. Defaults to 4.
+        candidates_factor: the number of refined candidates for each source. Defaults to 2.
+        neighborhood: the size of the window of the local maxima of the dense peak finder, an odd int or a tuple of
+            the sizes along the angles and the ranges, see find_peaks_2d. Defaults to 3.
+        separation: the minimal distance between the peaks, in grid points, an int or a tuple of the distances along
+            the angles and the ranges, see find_peaks_2d. Defaults to None, for a coarse step and one.
+        max_iterations: the maximal number of climbing steps of a candidate at each level, and of rounds of
+            candidates. Defaults to 10.
+    """
+    def __init__(self, system_model: SystemModel, angles_dict: torch.Tensor, ranges_dict: torch.Tensor = None,
+                 coarse_step=4, candidates_factor: int = 2, neighborhood=3, separation=None,
+                 max_iterations: int = 10):
+        if not system_model.params.signal_type.startswith("narrowband"):
+            raise ValueError(f"CoarseToFineSearch: signal type {system_model.params.signal_type} is not supported")
+        coarse_step = tuple(coarse_step) if isinstance(coarse_step, (tuple, list)) else (coarse_step, coarse_step)
+        if min(coarse_step) < 1:
+            raise ValueError(f"CoarseToFineSearch: coarse step must be positive, got {coarse_step}")
+        if max_iterations < 1:
+            raise ValueError(f"CoarseToFineSearch: max iterations must be positive, got {max_iterations}")
+        neighborhood = tuple(neighborhood) if isinstance(neighborhood, (tuple, list)) else (neighborhood, neighborhood)
+        if separation is None:
+            separation = tuple(step + 1 for step in coarse_step)
+        separation = tuple(separation) if isinstance(separation, (tuple, list)) else (separation, separation)
+        self.system_model = system_model
+        self.angles_dict = angles_dict.cpu()
+        self.ranges_dict = ranges_dict.cpu() if ranges_dict is not None else None
+        self.coarse_step = coarse_step
+        self.candidates_factor = candidates_factor
+        self.separation = separation
+        self.max_iterations = max_iterations
+        self.grid_shape = (len(self.angles_dict), len(self.ranges_dict) if self.ranges_dict is not None else 1)
+        # the coarse grid always holds the last points of the dense grid, so the edges are covered
+        self.coarse_idx = [self.__get_coarse_idx(size, step) for size, step in zip(self.grid_shape, self.coarse_step)]
+        # the ranges are not searched over in the far field
+        searched = (1, 1) if self.ranges_dict is not None else (1, 0)
+        self.levels = self.__get_levels(coarse_step, searched)
+        self.peak_half_width = tuple(max(size // 2, 1) * axis for size, axis in zip(neighborhood, searched))
+        self.__init_steering_phases()
+
+    @staticmethod
+    def __get_coarse_idx(size: int, step: int) -> torch.Tensor:
+        coarse_idx = torch.arange(0, size, step)
+        if coarse_idx[-1] != size - 1:
+            coarse_idx = torch.cat((coarse_idx, torch.tensor([size - 1])))
+        return coarse_idx
+
+    @staticmethod
+    def __get_levels(coarse_step: tuple, searched: tuple) -> list:
+        """The (stride, reach) of each refinement level, the stride halved from the coarse step down to 1."""
+        levels, stride = [], coarse_step
+        while True:
+            reach = tuple(step * axis for step, axis in zip(stride, searched))
+            stride = tuple(max(step // 2, 1) for step in stride)
+            levels.append((stride, reach))
+            if max(stride) == 1:
+                return levels
+
+    def __init_steering_phases(self):
+        """
+        The phases of the nominal steering vectors of the dense grid, as steering_vec_batch computes them: the far
+        field phase of each angle, and the near field phase of each angle, to divide by the range. Shape: [A, N].
+        """
+        positions = torch.from_numpy(self.system_model.array).to(torch.float64).reshape(-1) \
+            * self.system_model.dist_array_elems["narrowband"]
+        wavenumber = 2 * torch.pi / self.system_model.params.wavelength
+        angles = self.angles_dict.to(torch.float64)[:, None]
+        self.far_phases = -wavenumber * positions * torch.sin(angles)
+        self.near_phases = 0.5 * wavenumber * torch.pow(positions * torch.cos(angles), 2)
+
+    def get_steering_vectors(self, angle_idx: torch.Tensor, range_idx: torch.Tensor) -> torch.Tensor:
+        """
+        Computes the steering vectors of grid points, given by their dense grid indices.
+
+        Args:
+            angle_idx: the angle indices of the points, of size BxP.
+            range_idx: the range indices of the points, of size BxP.
+
+        Returns:
+            torch.Tensor: the steering vectors, of size BxNxP.
+        """
+        phases = self.far_phases[angle_idx]
+        if self.ranges_dict is not None:
+            phases = torch.addcmul(phases, self.near_phases[angle_idx], 1 / self.ranges_dict[range_idx][..., None])
+        return torch.polar(torch.ones((), dtype=torch.float64).expand_as(phases), phases).transpose(1, 2)
+
+    def search(self, spectrum_fn, number_of_sources: int, batch_size: int, device=None):
+        """
+        Finds the number_of_sources highest peaks of the spectrum of each sample.
+
+        Args:
+            spectrum_fn: a function which gets steering vectors of size SxNxP, or 1xNxP for points shared by the
+                samples, and the indices of the S samples in the batch, or None for the whole batch, and returns the
+                spectrum of each of these samples at these points, of size SxP.
+            number_of_sources: the number of peaks to find.
+            batch_size: the batch size B.
+            device: the device of the spectrum computation.
+
+        Returns:
+            tuple: the angle indices and the range indices of the peaks in the dense grid, each of size
+                Bxnumber_of_sources, and the coarse spectrum of size Bx(coarse angles)x(coarse ranges),
+                or Bx(coarse angles) for a search over the angles only.
+        """
+        device = self.system_model.device if device is None else device
+        # coarse stage, the grid is shared by the whole batch
+        coarse_angle_idx, coarse_range_idx = torch.meshgrid(*self.coarse_idx, indexing="ij")
+        steering = self.get_steering_vectors(coarse_angle_idx.reshape(1, -1), coarse_range_idx.reshape(1, -1))
+        coarse_spectrum = spectrum_fn(steering.to(device), None).real.cpu().view(batch_size, *coarse_angle_idx.shape)
+        ranked = self.__rank_candidates(coarse_spectrum)
+        candidates_num = min(number_of_sources * self.candidates_factor, ranked.shape[1])
+
+        # refinement stage, by rounds of candidates: the candidates of the narrow ridges of a strong peak may all
+        # climb to it, so the samples with fewer separated peaks than sources refine their next candidates
+        angle_idx = range_idx = torch.zeros(batch_size, 0, dtype=torch.long)
+        values = torch.zeros(batch_size, 0, dtype=torch.float64)
+        pending = torch.ones(batch_size, dtype=torch.bool)
+        for first in range(0, ranked.shape[1], candidates_num)[:self.max_iterations]:
+            samples = pending.nonzero().squeeze(1)
+            candidates = ranked[samples, first:first + candidates_num]
+            round_angle_idx, round_range_idx, round_values = self.__refine_candidates(
+                spectrum_fn, self.coarse_idx[0][candidates // coarse_angle_idx.shape[1]],
+                self.coarse_idx[1][candidates % coarse_angle_idx.shape[1]], samples, device)
+            # the samples out of the round take candidates of no value
+            padding = (batch_size, candidates.shape[1])
+            angle_idx = torch.cat((angle_idx, torch.zeros(padding, dtype=torch.long).index_copy(
+                0, samples, round_angle_idx)), dim=1)
+            range_idx = torch.cat((range_idx, torch.zeros(padding, dtype=torch.long).index_copy(
+                0, samples, round_range_idx)), dim=1)
+            values = torch.cat((values, torch.full(padding, -torch.inf, dtype=torch.float64).index_copy(
+                0, samples, round_values)), dim=1)
+            peaks_angle_idx, peaks_range_idx, peaks_num = self.__select_peaks(angle_idx, range_idx, values,
+                                                                               number_of_sources)
+            pending = peaks_num < number_of_sources
+            if not pending.any():
+                break
+        if self.ranges_dict is None:
+            coarse_spectrum = coarse_spectrum.squeeze(-1)
+        return peaks_angle_idx, peaks_range_idx, coarse_spectrum
+
+    @staticmethod
+    def __rank_candidates(spectrum: torch.Tensor) -> torch.Tensor:
+        """Returns the flat indices of the points of the coarse spectrum, its local maxima first, each by value."""
+        padded = F.pad(spectrum[:, None], (1, 1, 1, 1), value=-torch.inf)
+        is_peak = (F.max_pool2d(padded, kernel_size=3, stride=1)[:, 0] == spectrum).flatten(1)
+        # sort by value, then stable sort by being a local maximum, so the local maxima come first
+        order = torch.argsort(spectrum.flatten(1), dim=1, descending=True, stable=True)
+        return torch.gather(order, 1, torch.argsort(torch.gather(is_peak, 1, order).to(torch.int8), dim=1,
+                                                    descending=True, stable=True))
+
+    def __refine_candidates(self, spectrum_fn, angle_idx: torch.Tensor, range_idx: torch.Tensor,
+                            samples: torch.Tensor, device):
+        """
+        Refines the candidates of the given samples by the levels, then checks them over the window of the local
+        maxima of the dense peak finder, where the candidates which aren't local maxima climb again.
+        """
+        batch_size, candidates_num = angle_idx.shape
+        # each candidate is refined as a sample of its own, Shape: [S * K, 1]
+        angle_idx, range_idx = angle_idx.reshape(-1, 1), range_idx.reshape(-1, 1)
+        samples = samples.repeat_interleave(candidates_num)
+        for stride, reach in self.levels:
+            angle_idx, range_idx, values = self.__climb(spectrum_fn, angle_idx, range_idx, samples, stride, reach,
+                                                        device)
+        rows = torch.arange(len(samples))
+        while len(rows) > 0 and max(self.peak_half_width) > 1:
+            checked_angle_idx, checked_range_idx, _ = self.__refine(spectrum_fn, angle_idx[rows], range_idx[rows],
+                                                                    samples[rows], (1, 1), self.peak_half_width,
+                                                                    device)
+            moved = ((checked_angle_idx != angle_idx[rows]) | (checked_range_idx != range_idx[rows])).squeeze(1)
+            rows = rows[moved]
+            if len(rows) > 0:
+                angle_idx[rows], range_idx[rows], values[rows] = self.__climb(
+                    spectrum_fn, checked_angle_idx[moved], checked_range_idx[moved], samples[rows], *self.levels[-1],
+                    device)
+        return (angle_idx.view(batch_size, candidates_num), range_idx.view(batch_size, candidates_num),
+                values.view(batch_size, candidates_num))
+
+    def __climb(self, spectrum_fn, angle_idx: torch.Tensor, range_idx: torch.Tensor, samples: torch.Tensor,
+                stride: tuple, reach: tuple, device):
+        """Moves the candidates up by the refinement steps of a level, repeated for the candidates which moved."""
+        angle_idx, range_idx = angle_idx.clone(), range_idx.clone()
+        values = torch.empty(angle_idx.shape, dtype=torch.float64)
+        rows = torch.arange(len(samples))
+        for _ in range(self.max_iterations):
+            refined_angle_idx, refined_range_idx, values[rows] = self.__refine(
+                spectrum_fn, angle_idx[rows], range_idx[rows], samples[rows], stride, reach, device)
+            moved = ((refined_angle_idx != angle_idx[rows]) | (refined_range_idx != range_idx[rows])).squeeze(1)
+            angle_idx[rows], range_idx[rows] = refined_angle_idx, refined_range_idx
+            rows = rows[moved]
+            if len(rows) == 0:
+                break
+        return angle_idx, range_idx, values
+
+    def __refine(self, spectrum_fn, angle_idx: torch.Tensor, range_idx: torch.Tensor, samples: torch.Tensor,
+                 stride: tuple, reach: tuple, device):
+        """
+        Evaluates the dense grid points up to reach points, of the angles and of the ranges, around each candidate
+        of the given samples, every stride points, and moves it to the highest point, if it is higher than the
+        candidate.
+        """
+        batch_size, candidates_num = angle_idx.shape
+        angle_offsets, range_offsets = torch.meshgrid(torch.arange(-reach[0], reach[0] + 1, stride[0]),
+                                                      torch.arange(-reach[1], reach[1] + 1, stride[1]),
+                                                      indexing="ij")
+        # Shape: [B, K, P]
+        pattern_angle_idx = (angle_idx[:, :, None] + angle_offsets.flatten()).clamp(0, self.grid_shape[0] - 1)
+        pattern_range_idx = (range_idx[:, :, None] + range_offsets.flatten()).clamp(0, self.grid_shape[1] - 1)
+        steering = self.get_steering_vectors(pattern_angle_idx.flatten(1), pattern_range_idx.flatten(1))
+        spectrum = spectrum_fn(steering.to(device), samples).real.cpu().view(batch_size, candidates_num, -1)
+        best = torch.argmax(spectrum, dim=-1, keepdim=True)
+        # the candidate stays on ties, the middle point of the pattern, so the climb ends
+        center = torch.full_like(best, angle_offsets.numel() // 2)
+        best = torch.where(torch.gather(spectrum, 2, best) > torch.gather(spectrum, 2, center), best, center)
+        return (torch.gather(pattern_angle_idx, 2, best).squeeze(-1), torch.gather(pattern_range_idx, 2, best).squeeze(-1),
+                torch.gather(spectrum, 2, best).squeeze(-1))
+
+    def __select_peaks(self, angle_idx: torch.Tensor, range_idx: torch.Tensor, values: torch.Tensor,
+                       number_of_sources: int):
+        """
+        Keeps the number_of_sources highest refined candidates. A candidate closer than the separation to a higher
+        one is taken as the same peak, and is kept only if there are not enough separated peaks. Returns the
+        indices of the peaks and the number of separated peaks of each sample.
+        """
+        order = torch.argsort(values, dim=1, descending=True, stable=True)
+        angle_idx, range_idx = torch.gather(angle_idx, 1, order), torch.gather(range_idx, 1, order)
+        # Shape: [B, K, K], close[b, i, j] for a candidate i close to a higher candidate j
+        close = ((angle_idx[:, :, None] - angle_idx[:, None, :]).abs() < self.separation[0]) & \
+                ((range_idx[:, :, None] - range_idx[:, None, :]).abs() < self.separation[1])
+        close = close.tril(diagonal=-1)
+        # the candidates of no value are never peaks
+        suppressed = torch.gather(values, 1, order) == -torch.inf
+        for i in range(1, angle_idx.shape[1]):
+            suppressed[:, i] |= (close[:, i] & ~suppressed).any(dim=1)
+        order = torch.argsort(suppressed.to(torch.int8), dim=1, stable=True)[:, :number_of_sources]
+        return torch.gather(angle_idx, 1, order), torch.gather(range_idx, 1, order), (~suppressed).sum(dim=1)
+
+
+def _quadratic_form(matrix: torch.Tensor, steering: torch.Tensor) -> torch.Tensor:
+    """Re(a^H Q a) for each steering vector a, of size BxNxM, and the matrix Q of its sample, of size BxNxN."""
+    return torch.real(torch.sum(steering.conj() * torch.bmm(matrix, steering), dim=1))
+
+
+def refine_peaks(system_model: SystemModel, matrix: torch.Tensor, angles: torch.Tensor, ranges: torch.Tensor = None,
+                 angle_step: float = None, range_step: float = None, iterations: int = 10):
+    """
+    Refines the grid peaks off the grid, by minimizing the quadratic form Re(a^H Q a) of the steering vector a over
+    the continuous angles, or angles and ranges, around each peak.
+    For MUSIC, Q is the projection on the noise subspace; for the Beamformer, Q is the negative covariance.
+    Each iteration takes a Newton step where the Hessian is positive definite, and a scaled gradient step otherwise.
+    A step is kept only if it decreases the quadratic form, else it is halved at the next iteration.
+    The peaks are kept within a grid step of the grid peaks, where the optimum of the continuous spectrum lies.
+
+    Args:
+        system_model: the system model, used for computing the steering vectors and their derivatives.
+        matrix: the matrix Q of each sample, of size BxNxN.
+        angles: the angles of the grid peaks, of size BxM.
+        ranges: the ranges of the grid peaks, of size BxM, or None for the far field.
+        angle_step: the resolution of the angles grid.
+        range_step: the resolution of the ranges grid.
+        iterations: the number of iterations. Defaults to 10.
+
+    Returns:
+        torch.Tensor or tuple: the refined angles, or the refined angles and ranges, as the grid peaks.
+    """
+    params = angles[..., None] if ranges is None else torch.stack((angles, ranges), dim=-1)
+    params = params.to(torch.float64)
+    steps = torch.tensor([angle_step] if ranges is None else [angle_step, range_step], dtype=torch.float64,
+                         device=params.device)
+    lower, upper = params - steps, params + steps
+    matrix = matrix.to(torch.complex128)
+    batch_size, sources_num, _ = params.shape
+    scale = torch.ones(batch_size, sources_num, 1, dtype=torch.float64, device=params.device)
+    for _ in range(iterations):
+        steering, first, second = system_model.steering_vec_derivatives(*params.unbind(-1))
+        # Shape: [B, N, M]
+        matrix_steering = torch.bmm(matrix, steering)
+        value = torch.real(torch.sum(steering.conj() * matrix_steering, dim=1))
+        # Shape: [B, M, D]
+        grad = 2 * torch.real(torch.sum(first.conj() * matrix_steering[..., None], dim=1))
+        # Shape: [B, N, M, D]
+        matrix_first = torch.bmm(matrix, first.flatten(2)).view_as(first)
+        # Shape: [B, M, D, D]
+        hess = 2 * torch.real(torch.sum(second.conj() * matrix_steering[..., None, None], dim=1)
+                              + torch.sum(first.conj()[..., :, None] * matrix_first[..., None, :], dim=1))
+        cholesky, info = torch.linalg.cholesky_ex(hess)
+        newton_step = -torch.cholesky_solve(grad[..., None], cholesky).squeeze(-1)
+        gradient_step = -grad / (torch.diagonal(hess, dim1=-2, dim2=-1).abs() + 1e-12)
+        step = torch.where((info == 0)[..., None], newton_step, gradient_step)
+        candidate = torch.maximum(torch.minimum(params + scale * step, upper), lower)
+        candidate_value = _quadratic_form(matrix, system_model.steering_vec_derivatives(*candidate.unbind(-1))[0])
+        improved = (candidate_value < value)[..., None]
+        params = torch.where(improved, candidate, params)
+        scale = torch.where(improved, torch.ones_like(scale), scale / 2)
+    if ranges is None:
+        return params[..., 0]
+    return params[..., 0], params[..., 1]
@@ -141,29 +141,8 @@ class MLE(nn.Module):
             self.__define_search_grid_near()
 
     def __define_search_grid_near(self):
-        dist_array_elems = self.system_model.dist_array_elems["NarrowBand"]
-        angels = self.angles[:, None].to(device)
-        distances = self.distances[:, None].to(device)
-        #
-        array = torch.Tensor(self.system_model.array[:, None]).to(torch.float32).to(device)
-        array_square = torch.pow(array, 2).to(torch.float64)
-
-        first_order = torch.einsum("nm, na -> na",
-                                   array,
-                                   torch.sin(angels).repeat(1, self.system_model.params.N).T * dist_array_elems)
-
-        second_order = -0.5 * torch.div(torch.pow(torch.cos(angels) * dist_array_elems, 2), distances.T)
-        second_order = second_order[:, :, None].repeat(1, 1, self.system_model.params.N)
-        second_order = torch.einsum("nm, nda -> nda",
-                                    array_square,
-                                    torch.transpose(second_order, 2, 0)).transpose(1, 2)
-
-        first_order = first_order[:, :, None].repeat(1, 1, second_order.shape[-1])
-
-        time_delay = first_order + second_order
-
-        steering_matrix = torch.exp(2 * -1j * torch.pi * time_delay)
-        self.search_grid = steering_matrix
+        self.search_grid = self.system_model.get_steering_dict(self.angles.to(torch.float64),
+                                                               self.distances.to(torch.float64))
 
     def __define_search_grid_far(self):
         pass
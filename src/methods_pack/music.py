@@ -8,58 +8,111 @@ import scipy as sc
 
 from src.system_model import SystemModel
 from src.methods_pack.subspace_method import SubspaceMethod
+from src.methods_pack.grid_search import CoarseToFineSearch, refine_peaks
+from src.methods_pack.peak_finder import find_peaks_1d, find_peaks_2d
+from src.methods_pack.fft_spectrum import FFTSpectrum, NearFieldFFTSpectrum
 from src.utils import *
 from src.metrics import RMSPELoss, CartesianLoss
 
+# default memory budget of the intermediate tensors of the tiled 2D spectrum
+SPECTRUM_MEMORY_BYTES = 512 * 1024 ** 2
+SPECTRUM_FORMULATIONS = ("noise", "signal")
 
-from scipy.ndimage import maximum_filter
-from scipy.ndimage import label
-from scipy.ndimage import find_objects
 
-def find_k_highest_peaks(matrix, k):
+def select_spectrum_formulation(N: int, M: int, grid_size: int, has_signal_subspace: bool = True) -> str:
     """
-    Find the k highest peaks in a 2D matrix using SciPy tools. A peak is defined as a
-    local maximum surrounded by smaller values.
+    Selects the cheapest formulation of the MUSIC inverse spectrum ||E_n^H a||^2 over a grid, by the number of
+    multiplications per sample:
+        * "noise": ||E_n^H a||^2 directly, G * N * (N - M).
+        * "signal": ||a||^2 - ||E_s^H a||^2, G * N * (M + 1). Requires the signal subspace.
+    The quadratic form a^H (E_n E_n^H) a over the grid is cheaper only through the FFT of the diagonal sums of the
+    noise projector, the "fft" formulation of MUSIC, see FFTSpectrum.
+
+    Args:
+        N: the number of sensors.
+        M: the number of sources.
+        grid_size: the number of grid points G.
+        has_signal_subspace: whether the signal subspace is available.
 
-    Parameters:
-    - matrix (2D array-like): Input matrix.
-    - k (int): Number of highest peaks to extract.
+    Returns:
+        str: the name of the formulation, "noise" on ties.
+    """
+    costs = {"noise": grid_size * N * (N - M)}
+    if has_signal_subspace:
+        costs["signal"] = grid_size * N * (M + 1)
+    return min(costs, key=lambda formulation: (costs[formulation], formulation != "noise"))
+
+
+def _squared_norm(x: torch.Tensor) -> torch.Tensor:
+    """The squared norm of the complex vectors in the last dimension, without the square root of torch.norm."""
+    if not x.is_complex():
+        # the real vectors of the unitary transform
+        return torch.sum(x ** 2, dim=-1)
+    return torch.sum(torch.real(x) ** 2 + torch.imag(x) ** 2, dim=-1)
+
+
+def _grid_inverse_spectrum(steering_dict_h: torch.Tensor, subspace: torch.Tensor, formulation: str) -> torch.Tensor:
+    """
+    Calculates the inverse spectrum over grid points for a batch.
+
+    Args:
+        steering_dict_h: the conjugated steering vectors, of size Gx N, or BatchSizexGxN.
+        subspace: the noise subspace for "noise", or the signal subspace for "signal", of size BatchSizexNxK.
+        formulation: the formulation of the inverse spectrum, see select_spectrum_formulation.
 
     Returns:
-    - peaks (list): List of tuples (row, col, value) representing the positions and values of the k highest peaks.
+        torch.Tensor: the inverse spectrum, of size BatchSizexG.
+    """
+    projection = torch.matmul(steering_dict_h, subspace)  # Shape: [b, g, K]
+    if formulation == "noise":
+        return _squared_norm(projection)
+    if formulation == "signal":
+        return torch.clamp(_squared_norm(steering_dict_h) - _squared_norm(projection), min=0)
+    raise ValueError(f"_grid_inverse_spectrum: unknown formulation {formulation}")
+
+
+def tiled_inverse_spectrum(steering_dict: torch.Tensor, subspace: torch.Tensor,
+                           memory_bytes: int = SPECTRUM_MEMORY_BYTES, device=None,
+                           formulation: str = "noise") -> torch.Tensor:
     """
-    # Apply maximum filter to find local maxima
-    neighborhood = maximum_filter(matrix, size=21, mode='constant', cval=-np.inf)
-    local_max = (matrix == neighborhood)
-
-    # Label the connected components of local maxima
-    labeled, num_features = label(local_max)
-    slices = find_objects(labeled)
-
-    # Extract peak positions and values
-    peaks = []
-    try:
-        for sl in slices:
-            row = int((sl[0].start + sl[0].stop - 1) / 2)
-            col = int((sl[1].start + sl[1].stop - 1) / 2)
-            value = matrix[row, col]
-            peaks.append((row, col, value))
-    except Exception as e:
-        pass
-
-    # Sort peaks by value (descending) and select the top k
-    peaks = sorted(peaks, key=lambda x: x[2], reverse=True)[:k]
-    if len(peaks) < k:
-        warnings.warn(f"find_k_highest_peaks: Less than {k} peaks found.")
-        # add random peaks
-        x_random = np.random.randint(0, matrix.shape[0], (k - len(peaks),))
-        y_random = np.random.randint(0, matrix.shape[1], (k - len(peaks),))
-        for i in range(k - len(peaks)):
-            peaks.append((x_random[i], y_random[i], matrix[x_random[i], y_random[i]]))
-
-
-    return peaks
+    Calculates the MUSIC inverse spectrum ||E_n^H a||^2 over a grid, without materializing the
+    [B, *grid, K] projections. The flattened grid and the batch are split into tiles whose intermediate tensors
+    fit in memory_bytes, and each tile is a single matmul followed by the squared norm.
+    The tiling only depends on the shapes and the budget, so the result is deterministic.
+
+    Args:
+        steering_dict: the steering dictionary of the grid, of size Nx(length_angles)[x(length_ranges)].
+        subspace: the noise subspace of size BatchSizexNx(N-M), or the signal subspace of size BatchSizexNxM
+            for the "signal" formulation.
+        memory_bytes: the memory budget of the intermediate tensors of a tile.
+        device: the device of the computation, the steering dictionary is moved to it tile by tile.
+            Defaults to the device of the subspace.
+        formulation: "noise" or "signal", see select_spectrum_formulation. Defaults to "noise".
 
+    Returns:
+        torch.Tensor: the inverse spectrum, of size BatchSizex(length_angles)[x(length_ranges)].
+    """
+    device = subspace.device if device is None else device
+    subspace = subspace.to(device)
+    batch_size, N, K = subspace.shape
+    grid_shape = steering_dict.shape[1:]
+    grid_size = steering_dict[0].numel()
+    # the complex projections and their squared magnitudes of a single grid point and a single sample
+    point_bytes = K * (subspace.element_size() + subspace.element_size() // 2)
+    batch_tile = int(min(batch_size, max(1, memory_bytes // (point_bytes * min(grid_size, grid_shape[-1])))))
+    grid_tile = int(min(grid_size, max(1, memory_bytes // (point_bytes * batch_tile))))
+    # Shape: [G, N]
+    steering_dict_h = steering_dict.reshape(N, grid_size).transpose(0, 1).conj()
+
+    inverse_spectrum = []
+    for batch_start in range(0, batch_size, batch_tile):
+        subspace_tile = subspace[batch_start:batch_start + batch_tile]
+        tiles = []
+        for grid_start in range(0, grid_size, grid_tile):
+            steering_tile = steering_dict_h[grid_start:grid_start + grid_tile].to(device)
+            tiles.append(_grid_inverse_spectrum(steering_tile, subspace_tile, formulation))
+        inverse_spectrum.append(torch.cat(tiles, dim=1))
+    return torch.cat(inverse_spectrum, dim=0).view(batch_size, *grid_shape)
 
 class MUSIC(SubspaceMethod):
     """
@@ -79,6 +132,8 @@ class MUSIC(SubspaceMethod):
         self.estimation_params = estimation_parameter
         self.angles_dict = None
         self.ranges_dict = None
+        # the builder of the steering dictionary of the whole grid, which is built on its first use, see steering_dict
+        self.__steering_builder = None
         self.steering_dict = None
         self.music_spectrum = None
         self.cell_size = None
@@ -87,6 +142,17 @@ class MUSIC(SubspaceMethod):
         self.noise_subspace = None
         self.criterion = None
         self.separated_criterion = None
+        # the memory budget of the 2D spectrum computation
+        self.spectrum_memory_bytes = SPECTRUM_MEMORY_BYTES
+        # "auto" selects the cheapest formulation of the spectrum, one of SPECTRUM_FORMULATIONS, or "fft" for the far
+        # field, and the near field angle and range, spectrum of a ULA, see set_spectrum_formulation
+        self.spectrum_formulation = "auto"
+        self.fft_spectrum = None
+        # "dense" scans the whole grid, "coarse_to_fine" refines the peaks of a coarse grid, see set_search_mode
+        self.search_mode = "dense"
+        self.coarse_to_fine = None
+        # the iterations of the off-grid refinement of the peaks, 0 for the grid peaks, see set_peak_refinement
+        self.refinement_iterations = 0
 
         self.__init_grid_params()
         self.__init_cells(0.2)
@@ -116,17 +182,40 @@ class MUSIC(SubspaceMethod):
                                                        known_angles=known_angles[:, source][:, None])
                     params[:, source] = params_source.squeeze()
                 return params
-        _, noise_subspace, source_estimation, eigen_regularization = self.subspace_separation(cov.to(torch.complex128), number_of_sources)
-        inverse_spectrum = self.get_inverse_spectrum(noise_subspace.to(self.device)).to(self.device)
-        if self._get_name() == "TOPS":
-            self.music_spectrum = torch.sum(1 / (inverse_spectrum + 1e-10), dim=-1)
+        signal_subspace, noise_subspace, source_estimation, eigen_regularization = self.subspace_separation(cov.to(torch.complex128), number_of_sources)
+        if self.__use_coarse_to_fine():
+            params = self.__coarse_to_fine_peaks(noise_subspace.to(self.device), number_of_sources)
         else:
-            self.music_spectrum = 1 / (inverse_spectrum + 1e-10)
-        params = self.peak_finder(number_of_sources)
+            inverse_spectrum = self.get_inverse_spectrum(noise_subspace.to(self.device),
+                                                         signal_subspace.to(self.device)).to(self.device)
+            if self._get_name() == "TOPS":
+                self.music_spectrum = torch.sum(1 / (inverse_spectrum + 1e-10), dim=-1)
+            else:
+                self.music_spectrum = 1 / (inverse_spectrum + 1e-10)
+            params = self.peak_finder(number_of_sources)
+        if self.__use_peak_refinement():
+            params = self.__refine_peaks(params, noise_subspace.to(self.device))
         return params, source_estimation, eigen_regularization
 
-    def get_music_spectrum_from_noise_subspace(self, noise_subspace: torch.Tensor) -> torch.Tensor:
-        inverse_spectrum = self.get_inverse_spectrum(noise_subspace.to(torch.complex128))
+    @property
+    def steering_dict(self) -> torch.Tensor:
+        """
+        The steering dictionary of the search grid. The dictionary of the whole grid is built on its first use, so the
+        fft formulation, which doesn't use it, never builds it.
+        """
+        if self.__steering_dict is None and self.__steering_builder is not None:
+            self.__steering_dict = self.__steering_builder()
+        return self.__steering_dict
+
+    @steering_dict.setter
+    def steering_dict(self, steering_dict: torch.Tensor):
+        self.__steering_dict, self.__steering_builder = steering_dict, None
+
+    def get_music_spectrum_from_noise_subspace(self, noise_subspace: torch.Tensor,
+                                               signal_subspace: torch.Tensor = None) -> torch.Tensor:
+        if signal_subspace is not None:
+            signal_subspace = signal_subspace.to(torch.complex128)
+        inverse_spectrum = self.get_inverse_spectrum(noise_subspace.to(torch.complex128), signal_subspace)
         self.music_spectrum = 1 / inverse_spectrum
         return self.music_spectrum
 
@@ -134,6 +223,89 @@ class MUSIC(SubspaceMethod):
         self.system_model.create_array(number_of_sensors)
         self.set_search_grid()
 
+    def get_spectrum_formulation(self, noise_subspace: torch.Tensor, signal_subspace: torch.Tensor = None) -> str:
+        """
+        Returns the formulation of the inverse spectrum used for the given subspaces: self.spectrum_formulation if
+        it was set, otherwise the cheapest one for (N, M, grid size), see select_spectrum_formulation.
+        """
+        if self.spectrum_formulation != "auto":
+            if self.spectrum_formulation == "signal" and signal_subspace is None:
+                raise ValueError("MUSIC.get_spectrum_formulation: the signal formulation requires the signal subspace")
+            return self.spectrum_formulation
+        N, L = noise_subspace.shape[1], noise_subspace.shape[2]
+        grid_size = self.steering_dict[0].numel()
+        if self.system_model.params.field_type in ["near", "full"] and self.estimation_params.startswith("range"):
+            grid_size = self.steering_dict.shape[-1]
+        return select_spectrum_formulation(N, N - L, grid_size, has_signal_subspace=signal_subspace is not None)
+
+    def set_spectrum_formulation(self, formulation: str, oversampling: int = 4):
+        """
+        Sets the formulation of the inverse spectrum, "auto", one of SPECTRUM_FORMULATIONS, or "fft".
+        "fft" evaluates the far field inverse spectrum a^H (E_n E_n^H) a of a ULA over the whole grid by a single
+        FFT of the diagonal sums of the noise projector, interpolated onto the angles grid, see FFTSpectrum.
+        In the near field, it evaluates the angle and range spectrum by an FFT of the chirp modulated noise projector
+        per node of the cos(theta)^2 / r axis, interpolated onto the angles and ranges grid, see NearFieldFFTSpectrum.
+        oversampling is the ratio of the FFT size to the grid size of "fft".
+        """
+        if formulation == "fft":
+            if (not self.system_model.params.field_type.startswith("far")
+                    and self.estimation_params != "angle, range"):
+                raise ValueError("MUSIC.set_spectrum_formulation: the fft formulation is for the far field, and the "
+                                 "near field angle and range estimation only")
+            self.fft_spectrum = self.__init_fft_spectrum(oversampling)
+        elif formulation != "auto" and formulation not in SPECTRUM_FORMULATIONS:
+            raise ValueError(f"MUSIC.set_spectrum_formulation: unknown formulation {formulation}")
+        self.spectrum_formulation = formulation
+
+    def __fft_ranges_dict(self):
+        """The ranges grid of the FFT spectrum, None in the far field."""
+        return None if self.system_model.params.field_type.startswith("far") else self.ranges_dict
+
+    def __init_fft_spectrum(self, oversampling: int):
+        if self.__fft_ranges_dict() is None:
+            return FFTSpectrum(self.system_model, self.angles_dict, oversampling=oversampling,
+                               memory_bytes=self.spectrum_memory_bytes)
+        return NearFieldFFTSpectrum(self.system_model, self.angles_dict, self.ranges_dict, oversampling=oversampling,
+                                    memory_bytes=self.spectrum_memory_bytes)
+
+    def set_search_mode(self, mode: str, coarse_step=None, candidates_factor: int = 2):
+        """
+        Sets the peak search of the inference.
+        "dense" computes the spectrum over the whole grid, "coarse_to_fine" computes it over a grid decimated by
+        coarse_step and refines candidates_factor candidates for each source locally, see CoarseToFineSearch.
+        The coarse to fine search is used for the angle, and the angle and range, estimation in evaluation mode.
+        In training, the spectrum over the whole grid is required, so the dense search is used.
+        The peaks of the near field spectrum are narrow ridges, so the angle and range search refines the
+        candidates by levels of decreasing steps, with the neighborhood and the separation of the dense peak finder.
+        coarse_step, an int or an (angle, range) pair, defaults to 4 for the angle search and to (8, 2) for the angle
+        and range search.
+        """
+        if mode == "dense":
+            self.coarse_to_fine = None
+        elif mode == "coarse_to_fine":
+            if self.system_model.params.field_type in ["near", "full"] and self.estimation_params == "angle, range":
+                self.coarse_to_fine = CoarseToFineSearch(self.system_model, self.angles_dict, self.ranges_dict,
+                                                         coarse_step=(8, 2) if coarse_step is None else coarse_step,
+                                                         candidates_factor=candidates_factor, neighborhood=21,
+                                                         separation=11)
+            else:
+                self.coarse_to_fine = CoarseToFineSearch(self.system_model, self.angles_dict,
+                                                         coarse_step=4 if coarse_step is None else coarse_step,
+                                                         candidates_factor=candidates_factor)
+        else:
+            raise ValueError(f"MUSIC.set_search_mode: unknown search mode {mode}")
+        self.search_mode = mode
+
+    def set_peak_refinement(self, iterations: int = 10):
+        """
+        Sets the number of iterations of the off-grid refinement of the peaks, see refine_peaks, 0 disables it.
+        As the coarse to fine search, the refinement is used for the angle, and the angle and range, estimation
+        in evaluation mode.
+        """
+        if iterations < 0:
+            raise ValueError(f"MUSIC.set_peak_refinement: iterations must be non-negative, got {iterations}")
+        self.refinement_iterations = iterations
+
     def adjust_cell_size(self):
         if self.estimation_params == "range":
             if self.cell_size > 1:
@@ -155,12 +327,14 @@ class MUSIC(SubspaceMethod):
                 if self.cell_size % 2 == 0:
                     self.cell_size -= 1
 
-    def get_inverse_spectrum(self, noise_subspace: torch.Tensor):
+    def get_inverse_spectrum(self, noise_subspace: torch.Tensor, signal_subspace: torch.Tensor = None):
         """
 
         Parameters
         ----------
         noise_subspace - the noise related subspace vectors of size BatchSizex#SENSORSx(#SENSORS-#SOURCES)
+        signal_subspace - the orthonormal signal subspace vectors of size BatchSizex#SENSORSx#SOURCES, optional.
+            When given, the spectrum may be computed from it, see get_spectrum_formulation.
 
         Returns
         -------
@@ -169,46 +343,30 @@ class MUSIC(SubspaceMethod):
         in case of dual param estimation it will be 2D inverse spectrum:
                                                     BatchSizex(length_search_grid_angle)x(length_search_grid_distance)
         """
-        # steering_dict = self.steering_dict.to(device)
-        if self.system_model.params.field_type.startswith("far"):
-            steering_dict = self.steering_dict[:noise_subspace.shape[1]].to(self.device)
-            var1 = torch.einsum("an, bnm -> bam", steering_dict.conj().transpose(0, 1)[:, :noise_subspace.shape[1]],
-                                noise_subspace)
-            inverse_spectrum = torch.norm(var1, dim=2) ** 2
+        is_far_field = self.system_model.params.field_type.startswith("far")
+        if not is_far_field and not self.estimation_params.startswith(("angle", "range")):
+            raise ValueError(f"MUSIC.get_inverse_spectrum: unknown estimation param {self.estimation_params}")
+        formulation = self.get_spectrum_formulation(noise_subspace, signal_subspace)
+        steering_dict = None if formulation == "fft" else self.steering_dict[:noise_subspace.shape[1]]
+        subspace = signal_subspace if formulation == "signal" else noise_subspace
+        if formulation == "fft":
+            if (self.fft_spectrum is None or self.fft_spectrum.angles_dict is not self.angles_dict
+                    or getattr(self.fft_spectrum, "ranges_dict", None) is not self.__fft_ranges_dict()):
+                # the formulation was set directly, or the search grid was set again
+                oversampling = 4 if self.fft_spectrum is None else self.fft_spectrum.oversampling
+                self.fft_spectrum = self.__init_fft_spectrum(oversampling)
+            subspace = subspace.to(self.device)
+            inverse_spectrum = self.fft_spectrum(torch.bmm(subspace, subspace.conj().transpose(1, 2)))
+        elif is_far_field or not self.estimation_params.startswith("range"):
+            # a grid shared by the whole batch
+            inverse_spectrum = tiled_inverse_spectrum(steering_dict, subspace, memory_bytes=self.spectrum_memory_bytes,
+                                                      device=self.device, formulation=formulation)
         else:
-            if self.estimation_params.startswith("angle, range"):
-                steering_dict = self.steering_dict[:noise_subspace.shape[1]].conj().transpose(0, 2).transpose(0, 1).to(self.device)
-                try:
-                    var1 = torch.einsum("adk, bkl -> badl",
-                                        steering_dict,
-                                        noise_subspace)
-                    # get the norm value for each element in the batch.
-                    inverse_spectrum = torch.norm(var1, dim=-1) ** 2
-                except RuntimeError:
-                    warnings.warn("MUSIC.get_inverse_spectrum: Out of memory error, trying to free some memory and convert the batch operation to for loop.")
-                    torch.cuda.empty_cache()
-                    inverse_spectrum = torch.zeros((noise_subspace.shape[0], self.angles_dict.shape[0], self.ranges_dict.shape[0]), dtype=torch.float64, device=self.device)
-                    for batch in range(noise_subspace.shape[0]):
-                        var1 = torch.einsum("adk, kl -> adl",
-                                        steering_dict,
-                                        noise_subspace[batch])
-                        inverse_spectrum[batch] = torch.norm(var1, dim=-1) ** 2
-
-                        del var1
-                
-            elif self.estimation_params.endswith("angle"):
-                steering_dict = self.steering_dict[:noise_subspace.shape[1]].to(self.device)
-                var1 = torch.einsum("an, nbm -> abm", steering_dict.conj().transpose(0, 1),
-                                    noise_subspace.transpose(0, 1))
-                inverse_spectrum = torch.norm(var1, dim=-1).T ** 2
-            elif self.estimation_params.startswith("range"):
-                steering_dict = self.steering_dict[:noise_subspace.shape[1]].to(device)
-                var1 = torch.bmm(steering_dict.conj().transpose(0, 2).transpose(0, 1), noise_subspace)
-                inverse_spectrum = torch.norm(var1, dim=-1) ** 2
-                if torch.isnan(inverse_spectrum).any():
-                    raise ValueError("Nan values in inverse spectrum")
-            else:
-                raise ValueError(f"MUSIC.get_inverse_spectrum: unknown estimation param {self.estimation_params}")
+            # the range grid of each sample is set by its known angle, Shape: [B, R, N]
+            steering_dict = steering_dict.to(self.device).conj().transpose(0, 2).transpose(0, 1)
+            inverse_spectrum = _grid_inverse_spectrum(steering_dict, subspace, formulation)
+            if torch.isnan(inverse_spectrum).any():
+                raise ValueError("Nan values in inverse spectrum")
         del steering_dict
         try:
             torch.cuda.empty_cache()
@@ -238,6 +396,44 @@ class MUSIC(SubspaceMethod):
             elif self.estimation_params.startswith("range"):
                 return self._peak_finder_1d(self.ranges_dict, source_number)
 
+    def __use_coarse_to_fine(self) -> bool:
+        return (self.search_mode == "coarse_to_fine" and not self.training and self._get_name() != "TOPS"
+                and not self.estimation_params.startswith("range"))
+
+    def __use_peak_refinement(self) -> bool:
+        return (self.refinement_iterations > 0 and not self.training and self._get_name() != "TOPS"
+                and not self.estimation_params.startswith("range"))
+
+    def __refine_peaks(self, params, noise_subspace: torch.Tensor):
+        """Refines the grid peaks off the grid, by minimizing the projection on the noise subspace."""
+        projector = torch.bmm(noise_subspace, noise_subspace.conj().transpose(1, 2))
+        angle_step = (self.angles_dict[1] - self.angles_dict[0]).item()
+        if not isinstance(params, tuple):
+            return refine_peaks(self.system_model, projector, params, angle_step=angle_step,
+                                iterations=self.refinement_iterations)
+        range_step = (self.ranges_dict[1] - self.ranges_dict[0]).item()
+        return refine_peaks(self.system_model, projector, *params, angle_step=angle_step, range_step=range_step,
+                            iterations=self.refinement_iterations)
+
+    def __coarse_to_fine_peaks(self, noise_subspace: torch.Tensor, number_of_sources: int):
+        """
+        Finds the peaks of the spectrum by the coarse to fine search.
+        self.music_spectrum holds the spectrum over the coarse grid only.
+        """
+        noise_subspace_h = noise_subspace.conj().transpose(1, 2)
+
+        def spectrum_fn(steering: torch.Tensor, samples: torch.Tensor = None) -> torch.Tensor:
+            steering = steering.to(noise_subspace.dtype)
+            subspace_h = noise_subspace_h if samples is None else noise_subspace_h[samples.to(noise_subspace.device)]
+            return 1 / (_squared_norm(torch.matmul(subspace_h, steering).transpose(1, 2)) + 1e-10)
+
+        angle_idx, range_idx, self.music_spectrum = self.coarse_to_fine.search(
+            spectrum_fn, number_of_sources, noise_subspace.shape[0], device=self.device)
+        angles_pred = self.angles_dict[angle_idx].to(self.device)
+        if self.coarse_to_fine.ranges_dict is None:
+            return angles_pred
+        return angles_pred, self.ranges_dict[range_idx].to(self.device)
+
     def set_search_grid(self, known_angles: torch.Tensor = None, known_distances: torch.Tensor = None):
         if self.system_model.params.field_type.startswith("far"):
             self.__set_search_grid_far_field()
@@ -255,7 +451,9 @@ class MUSIC(SubspaceMethod):
             self._plot_1d_spectrum(highlight_corrdinates, batch, add_title=add_title, save=save)
 
     def test_step(self, batch, batch_idx, model: nn.Module=None):
-        x, sources_num, label = batch
+        x, sources_num, label = batch[:3]
+        # precomputed covariances from the feature store, if any
+        features = batch[3] if len(batch) > 3 else None
         if x.dim() == 2:
             x = x.unsqueeze(0)
         test_length = x.shape[0]
@@ -280,10 +478,10 @@ class MUSIC(SubspaceMethod):
                 raise e
         else:
             if self.system_model.params.signal_nature == "non-coherent":
-                Rx = self.pre_processing(x, mode="sample")
+                Rx = self.pre_processing(x, mode="sample", features=features)
             else:
-                # Rx = self.pre_processing(x, mode="sps")
-                Rx = self.pre_processing(x, mode="sample")
+                # Rx = self.pre_processing(x, mode="sps", features=features)
+                Rx = self.pre_processing(x, mode="sample", features=features)
         predictions, sources_num_estimation, _ = self(Rx, number_of_sources=sources_num)
         if self.estimation_params == "angle, range":
             angles_prediction, ranges_prediction = predictions
@@ -302,21 +500,9 @@ class MUSIC(SubspaceMethod):
             source_number = 1  # for the range estimation, only one source is expected.
 
         batch_size = self.music_spectrum.shape[0]
-
-        peaks = torch.zeros(batch_size, source_number, dtype=torch.int64, device=self.device)
-        for batch in range(batch_size):
-            music_spectrum = self.music_spectrum[batch].cpu().detach().numpy().squeeze()
-            # Find spectrum peaks
-            peaks_tmp = sc.signal.find_peaks(music_spectrum, threshold=0.0)[0]
-            if len(peaks_tmp) < source_number:
-                warnings.warn(f"MUSIC._peak_finder_1d: No peaks were found! taking max values instead.")
-                # random_peaks = np.random.randint(0, search_space.shape[0], (source_number - peaks_tmp.shape[0],))
-                random_peaks = torch.topk(torch.from_numpy(music_spectrum), source_number - peaks_tmp.shape[0],
-                                          largest=True).indices.cpu().detach().numpy()
-                peaks_tmp = np.concatenate((peaks_tmp, random_peaks))
-            # Sort the peak by their amplitude
-            sorted_peaks = peaks_tmp[np.argsort(music_spectrum[peaks_tmp])[::-1]]
-            peaks[batch] = torch.from_numpy(sorted_peaks[0:source_number]).to(self.device)
+        # the peaks of the whole batch at once, sorted by their amplitude
+        peaks = find_peaks_1d(self.music_spectrum.reshape(batch_size, -1), source_number,
+                              caller="MUSIC._peak_finder_1d").to(self.device)
         if not self.training:
             # if the model is not in training mode, return the peaks
             if peaks.dim() == 1:
@@ -328,34 +514,10 @@ class MUSIC(SubspaceMethod):
             return self.__maskpeak_1d(peaks, search_space, source_number)
 
     def _peak_finder_2d(self, source_number: int):
-        batch_size = self.music_spectrum.shape[0]
-
-        max_row = torch.zeros((batch_size, source_number)
-                              , dtype=torch.int64, device=self.device)
-        max_col = torch.zeros((batch_size, source_number)
-                              , dtype=torch.int64, device=self.device)
-        for batch in range(batch_size):
-            music_spectrum = self.music_spectrum[batch].detach().cpu().numpy().squeeze()
-            # # Flatten the spectrum
-            # spectrum_flatten = music_spectrum.flatten()
-            # # Find spectrum peaks
-            # peaks = sc.signal.find_peaks(spectrum_flatten)[0]
-            # # Sort the peak by their amplitude
-            # sorted_peaks = peaks[np.argsort(spectrum_flatten[peaks])[::-1]]
-            # if len(sorted_peaks) < source_number:
-            #     warnings.warn(f"MUSIC._peak_finder_2d: No peaks were found! taking max values instead.")
-            #     max_peaks = torch.topk(torch.from_numpy(spectrum_flatten), source_number - sorted_peaks.shape[0],
-            #                               largest=True).indices.cpu().detach().numpy()
-            #     sorted_peaks = np.concatenate((sorted_peaks, max_peaks))
-            # # convert the peaks to 2d indices
-            # original_idx = torch.from_numpy(np.column_stack(np.unravel_index(sorted_peaks, music_spectrum.shape))).T
-            # if source_number > 1:
-            #     # pass
-            #     original_idx = keep_far_enough_points(original_idx, source_number, 10)
-            peaks = find_k_highest_peaks(music_spectrum, source_number)
-            original_idx = torch.from_numpy(np.array(peaks)[:, :2]).T
-            max_row[batch] = original_idx[0][0: source_number]
-            max_col[batch] = original_idx[1][0: source_number]
+        # the highest local maxima in a 21x21 window, as a single peak for a flat maximum
+        max_row, max_col = find_peaks_2d(self.music_spectrum, source_number, neighborhood=21, separation=11,
+                                         caller="MUSIC._peak_finder_2d")
+        max_row, max_col = max_row.to(self.device), max_col.to(self.device)
         if not self.training:
             # if the model is not in training mode, return the peaks.
             angle_dict = self.angles_dict.to(self.device)
@@ -622,7 +784,9 @@ class MUSIC(SubspaceMethod):
             plt.show()
 
     def __set_search_grid_far_field(self):
-        self.steering_dict = self.system_model.steering_vec_far_field(self.angles_dict, f_c=None, nominal=True, fix_sv_noise=True).squeeze(-1)
+        angles_dict = self.angles_dict
+        self.__steering_dict = None
+        self.__steering_builder = lambda: self.system_model.get_steering_dict(angles_dict).squeeze(-1)
 
     def __set_search_grid_near_field(self, known_angles: torch.Tensor = None, known_distances: torch.Tensor = None):
         """
@@ -630,6 +794,13 @@ class MUSIC(SubspaceMethod):
         Returns:
 
         """
+        if known_angles is None and known_distances is None:
+            # the full grid is shared with the other estimators, and is built on its first use, see steering_dict
+            angles_dict, ranges_dict = self.angles_dict, self.ranges_dict
+            self.__steering_dict = None
+            self.__steering_builder = lambda: self.system_model.get_steering_dict(angles_dict, ranges_dict,
+                                                                                  device="cpu")
+            return
         if known_angles is None:
             known_angles = self.angles_dict
         if known_distances is None:
@@ -660,7 +831,54 @@ class MUSIC(SubspaceMethod):
             raise ValueError(f"MUSIC.__init_criteria: Unrecognized estimation param {self.estimation_params}")
 
 
+class UnitaryMUSIC(MUSIC):
+    """
+    Unitary MUSIC, the far field angle MUSIC of a ULA in the real domain of the unitary transform.
+    The subspaces are separated by the real-valued processing, see SubspaceMethod.set_processing, and the inverse
+    spectrum ||E_n^H a||^2 is evaluated as ||E_r^T d||^2, for the real noise subspace E_r = Re(Q^H E_n) and the real
+    steering dictionary d = Q^H a_c, a_c the steering vectors with the phase reference at the center of the array,
+    so the grid is evaluated by real matmuls.
+    """
+
+    def __init__(self, system_model: SystemModel, model_order_estimation: str = None):
+        super().__init__(system_model, "angle", model_order_estimation=model_order_estimation)
+        self.set_processing("real-valued")
+        # the real steering dictionary, and the steering dictionary it was computed from
+        self.real_steering_dict = None
+        self.__real_steering_source = None
 
+    def get_inverse_spectrum(self, noise_subspace: torch.Tensor, signal_subspace: torch.Tensor = None):
+        """
+        The inverse spectrum over the angles grid, of size BatchSizex(length_search_grid), see
+        MUSIC.get_inverse_spectrum. The subspaces are these of the forward-backward averaged covariance.
+        """
+        formulation = self.get_spectrum_formulation(noise_subspace, signal_subspace)
+        if formulation == "fft":
+            return super().get_inverse_spectrum(noise_subspace, signal_subspace)
+        subspace = signal_subspace if formulation == "signal" else noise_subspace
+        real_steering_dict = self.get_real_steering_dict(subspace.shape[1])
+        return tiled_inverse_spectrum(real_steering_dict, real_valued_subspace(subspace),
+                                      memory_bytes=self.spectrum_memory_bytes, device=self.device,
+                                      formulation=formulation)
+
+    def get_real_steering_dict(self, number_of_sensors: int) -> torch.Tensor:
+        """
+        The real steering dictionary Q^H a_c of the first number_of_sensors sensors, of size NxA, computed again when
+        the search grid is set again.
+        """
+        if (self.real_steering_dict is None or self.__real_steering_source is not self.steering_dict
+                or self.real_steering_dict.shape[0] != number_of_sensors):
+            steering_dict = self.steering_dict[:number_of_sensors].to(torch.complex128)
+            # the phase of the center of the array, a_c is conjugate centro-symmetric
+            center = (number_of_sensors - 1) / 2 * self.system_model.dist_array_elems["narrowband"]
+            center_phase = torch.exp(2j * torch.pi * center * torch.sin(self.angles_dict.to(steering_dict.device))
+                                     / self.system_model.params.wavelength)
+            self.real_steering_dict = real_valued_subspace(steering_dict * center_phase)
+            self.__real_steering_source = self.steering_dict
+        return self.real_steering_dict
+
+    def __str__(self):
+        return "unitary_music_angle"
 
 
 class Filter(nn.Module):
@@ -0,0 +1,159 @@
+"""
+This file contains the batched peak finders of the spectra, shared by MUSIC, the Beamformer and the CsEstimator.
+The peaks of the whole batch are found by tensor operations, on the device of the spectrum, instead of a loop over
+the samples with scipy.
+"""
+import warnings
+
+import torch
+import torch.nn.functional as F
+
+
+def local_maxima_1d(spectrum: torch.Tensor) -> torch.Tensor:
+    """
+    Finds the local maxima of each spectrum, as scipy.signal.find_peaks: a point higher than its two neighbours,
+    or the middle point, rounded down, of a flat run higher than the points on its two sides.
+    The first and the last points are never peaks.
+
+    Args:
+        spectrum: the spectra, of size BxL.
+
+    Returns:
+        torch.Tensor: a boolean mask of the peaks, of size BxL.
+    """
+    is_peak = torch.zeros_like(spectrum, dtype=torch.bool)
+    is_peak[:, 1:-1] = (spectrum[:, 1:-1] > spectrum[:, :-2]) & (spectrum[:, 1:-1] > spectrum[:, 2:])
+    # the flat runs are rare in a continuous spectrum, so only their rows take the run search
+    has_runs = (spectrum[:, 1:] == spectrum[:, :-1]).any(dim=1)
+    if has_runs.any():
+        is_peak[has_runs] = _local_maxima_runs(spectrum[has_runs])
+    return is_peak
+
+
+def _local_maxima_runs(spectrum: torch.Tensor) -> torch.Tensor:
+    """local_maxima_1d for spectra with flat runs, each run is taken as a single point at its middle."""
+    batch_size, length = spectrum.shape
+    positions = torch.arange(length, device=spectrum.device).expand(batch_size, length)
+    # the first and the last points of each run of equal values
+    is_start = torch.ones_like(spectrum, dtype=torch.bool)
+    is_start[:, 1:] = spectrum[:, 1:] != spectrum[:, :-1]
+    is_end = torch.ones_like(spectrum, dtype=torch.bool)
+    is_end[:, :-1] = is_start[:, 1:]
+    run_start = torch.cummax(torch.where(is_start, positions, 0), dim=1).values
+    run_end = length - 1 - torch.cummax(torch.where(is_end, length - 1 - positions, 0).flip(1), dim=1).values.flip(1)
+    is_inner = (run_start > 0) & (run_end < length - 1)
+    left = torch.gather(spectrum, 1, (run_start - 1).clamp(min=0))
+    right = torch.gather(spectrum, 1, (run_end + 1).clamp(max=length - 1))
+    return is_inner & (positions == (run_start + run_end) // 2) & (spectrum > left) & (spectrum > right)
+
+
+def find_peaks_1d(spectrum: torch.Tensor, number_of_peaks: int, caller: str = "find_peaks_1d") -> torch.Tensor:
+    """
+    Finds the number_of_peaks highest local maxima of each spectrum, sorted by their height.
+    A spectrum with fewer local maxima is completed by its highest points, which may repeat the peaks found,
+    and the whole selection is sorted by height, as the former per sample search.
+
+    Args:
+        spectrum: the spectra, of size BxL.
+        number_of_peaks: the number of peaks M.
+        caller: the name used in the warning, when a spectrum has fewer peaks than requested.
+
+    Returns:
+        torch.Tensor: the indices of the peaks, of size BxM, on the device of the spectrum.
+    """
+    spectrum = spectrum.detach()
+    is_peak = local_maxima_1d(spectrum)
+    peaks_num = is_peak.sum(dim=1, keepdim=True)
+    # the peaks come first, by height, as the masked points are lower than any value
+    masked = torch.where(is_peak, spectrum, -torch.inf)
+    peaks = torch.topk(masked, number_of_peaks, dim=1).indices
+    if (peaks_num < number_of_peaks).any():
+        warnings.warn(f"{caller}: No peaks were found! taking max values instead.")
+        # the missing peaks are taken from the highest points of the whole spectrum
+        highest = torch.topk(spectrum, number_of_peaks, dim=1).indices
+        slots = torch.arange(number_of_peaks, device=spectrum.device).expand_as(peaks)
+        fallback = torch.gather(highest, 1, (slots - peaks_num).clamp(min=0))
+        peaks = torch.where(slots < peaks_num, peaks, fallback)
+        order = torch.argsort(torch.gather(spectrum, 1, peaks), dim=1, descending=True, stable=True)
+        peaks = torch.gather(peaks, 1, order)
+    return peaks
+
+
+def find_peaks_2d(spectrum: torch.Tensor, number_of_peaks: int, neighborhood=3, separation=0,
+                  caller: str = "find_peaks_2d") -> tuple:
+    """
+    Finds the number_of_peaks highest local maxima of each 2D spectrum, with a non-maximum suppression.
+    A local maximum is a point not lower than any point of the neighborhood window around it. The peaks are
+    taken by height, and the points closer than the separation to a taken peak, along both axes, are suppressed.
+    A spectrum with fewer peaks is completed by its highest points that are not suppressed.
+
+    Args:
+        spectrum: the spectra, of size BxAxR.
+        number_of_peaks: the number of peaks M.
+        neighborhood: the size of the window of the local maxima, an odd int or a tuple of the sizes along the
+            rows and the columns. Defaults to 3.
+        separation: the minimal distance between the peaks, in grid points, an int or a tuple of the distances
+            along the rows and the columns. Defaults to 0, for no suppression.
+        caller: the name used in the warning, when a spectrum has fewer peaks than requested.
+
+    Returns:
+        tuple: the row and the column indices of the peaks, each of size BxM, sorted by height, on the device of
+            the spectrum.
+    """
+    neighborhood = tuple(neighborhood) if isinstance(neighborhood, (tuple, list)) else (neighborhood, neighborhood)
+    separation = tuple(separation) if isinstance(separation, (tuple, list)) else (separation, separation)
+    spectrum = spectrum.detach()
+    batch_size, rows_num, cols_num = spectrum.shape
+    window_max = _window_max(_window_max(spectrum, neighborhood[0], dim=1), neighborhood[1], dim=2)
+    flat_spectrum = spectrum.reshape(batch_size, -1)
+    is_peak = (spectrum == window_max).reshape(batch_size, -1)
+    # the suppression runs over the local maxima only, gathered into BxK, the missing ones padded by -inf
+    peaks_num = is_peak.sum(dim=1, keepdim=True)
+    candidates_num = max(int(peaks_num.max()), 1)
+    slots = torch.where(is_peak, torch.cumsum(is_peak, dim=1) - 1, candidates_num)
+    points = torch.arange(flat_spectrum.shape[1], device=spectrum.device).expand_as(flat_spectrum)
+    candidates = torch.zeros(batch_size, candidates_num + 1, dtype=torch.long, device=spectrum.device)
+    candidates = candidates.scatter_(1, slots, points)[:, :-1]
+    candidates_score = torch.where(torch.arange(candidates_num, device=spectrum.device) < peaks_num,
+                                   torch.gather(flat_spectrum, 1, candidates), -torch.inf)
+    peaks, is_fallback = [], torch.zeros(batch_size, dtype=torch.bool, device=spectrum.device)
+    for _ in range(number_of_peaks):
+        peak_score, peak = torch.max(candidates_score, dim=1)
+        peak = torch.gather(candidates, 1, peak[:, None])[:, 0]
+        no_peak = peak_score == -torch.inf
+        if no_peak.any():
+            is_fallback |= no_peak
+            taken = [prev_peak[no_peak] for prev_peak in peaks]
+            peak[no_peak] = _highest_available(flat_spectrum[no_peak], taken, cols_num, separation)
+        peaks.append(peak)
+        candidates_score.masked_fill_(_is_close(candidates, peak, cols_num, separation), -torch.inf)
+    if is_fallback.any():
+        warnings.warn(f"{caller}: Less than {number_of_peaks} peaks found, taking max values instead.")
+    peaks = torch.stack(peaks, dim=1)
+    return torch.div(peaks, cols_num, rounding_mode="floor"), peaks % cols_num
+
+
+def _window_max(spectrum: torch.Tensor, size: int, dim: int) -> torch.Tensor:
+    """The maximum over a centered window of the given odd size along dim, cut at the borders."""
+    if size <= 1:
+        return spectrum
+    pad = [0, 0] * (spectrum.dim() - 1 - dim) + [size // 2, size // 2]
+    return F.pad(spectrum, pad, value=-torch.inf).unfold(dim, size, 1).amax(dim=-1)
+
+
+def _is_close(points: torch.Tensor, peak: torch.Tensor, cols_num: int, separation: tuple) -> torch.Tensor:
+    """Whether the flat indices points, of size BxK, are the peak or closer than the separation to it."""
+    rows_distance = (torch.div(points, cols_num, rounding_mode="floor")
+                     - torch.div(peak, cols_num, rounding_mode="floor")[:, None]).abs()
+    cols_distance = (points % cols_num - (peak % cols_num)[:, None]).abs()
+    return (points == peak[:, None]) | ((rows_distance < separation[0]) & (cols_distance < separation[1]))
+
+
+def _highest_available(flat_spectrum: torch.Tensor, taken: list, cols_num: int, separation: tuple) -> torch.Tensor:
+    """The highest point not suppressed by the peaks taken, or the highest point at all if none is left."""
+    points = torch.arange(flat_spectrum.shape[1], device=flat_spectrum.device).expand_as(flat_spectrum)
+    available = torch.ones_like(flat_spectrum, dtype=torch.bool)
+    for peak in taken:
+        available &= ~_is_close(points, peak, cols_num, separation)
+    highest = torch.argmax(torch.where(available, flat_spectrum, -torch.inf), dim=1)
+    return torch.where(available.any(dim=1), highest, torch.argmax(flat_spectrum, dim=1))
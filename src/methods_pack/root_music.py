@@ -6,6 +6,7 @@ import numpy as np
 from src.methods_pack.subspace_method import SubspaceMethod
 from src.system_model import SystemModel
 from src.metrics import RMSPELoss
+from src.utils import sum_of_diags_torch, find_roots_torch, roots_closest_unit_circle
 
 
 class RootMusic(SubspaceMethod):
@@ -36,35 +37,20 @@ class RootMusic(SubspaceMethod):
         return angle_predicted
 
     def extract_roots_closest_unit_circle(self, roots, k: int):
-        distances = torch.abs(torch.abs(roots) - 1)
-        sorted_indcies = torch.argsort(distances, dim=1)
-        roots_sorted = roots.gather(1, sorted_indcies)
-        # consider only the roots inside the unit circle
-        closest_roots = torch.zeros(roots.shape[0], k).to(torch.complex128)
-        for i in range(roots_sorted.shape[0]):
-            filter_roots = roots_sorted[i, torch.abs(roots_sorted[i]) < 1]
-            closest_roots[i] = filter_roots[:k]
-        # get the k closest roots
-        return closest_roots
+        # the k roots inside the unit circle closest to it, for the whole batch at once
+        return roots_closest_unit_circle(roots, int(k))
 
     def sum_of_diag(self, tensor: torch.Tensor):
         tensor = self.__check_diag_sums_dim(tensor)
-        N = tensor.shape[-1]
-        diag_indcies = torch.linspace(-N + 1, N - 1, 2 * N - 1)
-        sum_of_diags = torch.zeros(tensor.shape[0], 2 * N - 1).to(torch.complex128)
-        for idx, diag_idx in enumerate(diag_indcies):
-            sum_of_diags[:, idx] = torch.sum(torch.diagonal(tensor, dim1=1, dim2=2, offset=diag_idx.to(int)), dim=-1)
-        return sum_of_diags
+        return sum_of_diags_torch(tensor)
 
     def find_roots(self, coeffs: torch.Tensor):
-        A = torch.diag(torch.ones(coeffs.shape[-1] - 2, dtype=coeffs.dtype), -1)
-        A = A.repeat(coeffs.shape[0], 1, 1)  # repeat for all elements in the batch
-        A[:, 0, :] = -torch.div(coeffs[:, 1:], coeffs[:, 0][:, None])
-        roots = torch.linalg.eigvals(A)
-        return roots
+        return find_roots_torch(coeffs)
 
     def test_step(self, batch, batch_idx):
-        x, sources_num, label = batch
+        x, sources_num, label = batch[:3]
+        # precomputed covariances from the feature store, if any
+        features = batch[3] if len(batch) > 3 else None
         if x.dim() == 2:
             x = x.unsqueeze(0)
         test_length = x.shape[0]
@@ -84,10 +70,10 @@ class RootMusic(SubspaceMethod):
 
         if self.system_model.params.signal_nature == "coherent":
             # Spatial smoothing
-            Rx = self.pre_processing(x, mode="sps")
+            Rx = self.pre_processing(x, mode="sps", features=features)
         else:
             # Conventional
-            Rx = self.pre_processing(x, mode="sample")
+            Rx = self.pre_processing(x, mode="sample", features=features)
         angles_prediction, sources_num_estimation = self(Rx, sources_num=sources_num)
         rmspe = self.criterion(angles_prediction, angles).sum().item()
         acc = self.source_estimation_accuracy(sources_num, sources_num_estimation)
@@ -132,6 +118,18 @@ class RootMusic(SubspaceMethod):
         plt.show()
 
 
+class UnitaryRootMusic(RootMusic):
+    """
+    Unitary Root-MUSIC, the Root-MUSIC of the noise subspace separated by the real-valued processing, see
+    SubspaceMethod.set_processing. The polynomial is built from the noise projector of the forward-backward averaged
+    covariance, mapped back to the sensors domain, and rooted as in RootMusic.
+    """
+
+    def __init__(self, system_model: SystemModel, model_order_estimation: str = "threshold"):
+        super(UnitaryRootMusic, self).__init__(system_model, model_order_estimation)
+        self.set_processing("real-valued")
+
+
 def root_music(Rz: torch.Tensor, M: int, batch_size: int):
     """Implementation of the model-based Root-MUSIC algorithm, support Pytorch, intended for
         MB-DL models. the model sets for nominal and ideal condition (Narrow-band, ULA, non-coherent)
@@ -153,41 +151,24 @@ def root_music(Rz: torch.Tensor, M: int, batch_size: int):
 
     dist = 0.5
     f = 1
-    doa_batches = []
-    doa_all_batches = []
-    Bs_Rz = Rz
-    for iter in range(batch_size):
-        R = Bs_Rz[iter]
-        # Extract eigenvalues and eigenvectors using EVD
-        eigenvalues, eigenvectors = torch.linalg.eig(R)
-        # Assign noise subspace as the eigenvectors associated with M greatest eigenvalues
-        Un = eigenvectors[:, torch.argsort(torch.abs(eigenvalues)).flip(0)][:, M:]
-        # Generate hermitian noise subspace matrix
-        F = torch.matmul(Un, torch.t(torch.conj(Un)))
-        # Calculates the sum of F matrix diagonals
-        diag_sum = sum_of_diags_torch(F)
-        # Calculates the roots of the polynomial defined by F matrix diagonals
-        roots = find_roots_torch(diag_sum)
-        # Calculate the phase component of the roots
-        roots_angels_all = torch.angle(roots)
-        # Calculate doa
-        doa_pred_all = torch.arcsin((1 / (2 * np.pi * dist * f)) * roots_angels_all)
-        doa_all_batches.append(doa_pred_all)
-        roots_to_return = roots
-        # Take only roots which inside the unit circle
-        roots = roots[
-            sorted(range(roots.shape[0]), key=lambda k: abs(abs(roots[k]) - 1))
-        ]
-        mask = (torch.abs(roots) - 1) < 0
-        roots = roots[mask][:M]
-        # Calculate the phase component of the roots
-        roots_angels = torch.angle(roots)
-        # Calculate doa
-        doa_pred = torch.arcsin((1 / (2 * np.pi * dist * f)) * roots_angels)
-        doa_batches.append(doa_pred)
-
-    return (
-        torch.stack(doa_batches, dim=0),
-        torch.stack(doa_all_batches, dim=0),
-        roots_to_return,
-    )
+    Bs_Rz = Rz[:batch_size]
+    # Extract eigenvalues and eigenvectors using EVD
+    eigenvalues, eigenvectors = torch.linalg.eig(Bs_Rz)
+    # Assign noise subspace as the eigenvectors associated with M greatest eigenvalues
+    order = torch.argsort(torch.abs(eigenvalues), dim=-1, descending=True)
+    Un = torch.gather(eigenvectors, 2, order[:, None, :].expand_as(eigenvectors))[:, :, M:]
+    # Generate hermitian noise subspace matrix
+    F = torch.bmm(Un, Un.conj().transpose(1, 2))
+    # Calculates the sum of F matrix diagonals
+    diag_sum = sum_of_diags_torch(F)
+    # Calculates the roots of the polynomial defined by F matrix diagonals
+    roots = find_roots_torch(diag_sum)
+    # Calculate doa
+    doa_all_batches = torch.arcsin((1 / (2 * np.pi * dist * f)) * torch.angle(roots))
+    roots_to_return = roots[-1]
+    # Take only roots which inside the unit circle
+    roots = roots_closest_unit_circle(roots, M)
+    # Calculate doa
+    doa_batches = torch.arcsin((1 / (2 * np.pi * dist * f)) * torch.angle(roots))
+
+    return doa_batches, doa_all_batches, roots_to_return
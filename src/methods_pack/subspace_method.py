@@ -6,12 +6,208 @@ import numpy as np
 import warnings
 
 
-from src.utils import sample_covariance, spatial_smoothing_covariance
+from src.utils import sample_covariance, spatial_smoothing_covariance, unitary_transform, unitary_basis, \
+    real_valued_subspace
 from src.system_model import SystemModel
 from src.config import device
 
 
 
+def _sorted_eigh(covariance: torch.Tensor) -> (torch.Tensor, torch.Tensor):
+    """The eigenvalues and the eigenvectors of the covariances, sorted by the magnitude of the eigenvalues,
+    in descending order."""
+    eigenvalues, eigenvectors = torch.linalg.eigh(covariance)
+    sorted_idx = torch.argsort(torch.abs(eigenvalues), descending=True)
+    sorted_eigvectors = torch.gather(eigenvectors, 2,
+                                     sorted_idx.unsqueeze(-1).expand(-1, -1, covariance.shape[-1]).transpose(1, 2))
+    return torch.gather(eigenvalues, 1, sorted_idx), sorted_eigvectors
+
+
+def _sorted_unitary_eigh(covariance: torch.Tensor) -> (torch.Tensor, torch.Tensor):
+    """_sorted_eigh of the forward-backward averaged covariances, by a real eigh of their unitary transform,
+    the eigenvectors are mapped back to the sensors domain."""
+    eigenvalues, eigenvectors = _sorted_eigh(unitary_transform(covariance))
+    return eigenvalues, unitary_basis(eigenvectors)
+
+
+# the stopping tolerance of the partial eigensolver, on the residuals of the Ritz pairs relative to the largest
+# eigenvalue, and its limits on the number of iterations and on the degree of the Chebyshev filter of each iteration
+PARTIAL_EIGH_TOLERANCE = 1e-7
+PARTIAL_EIGH_ITERATIONS = 100
+PARTIAL_EIGH_DEGREE = 8
+
+
+def _partial_eigh(covariance: torch.Tensor, rank: int, initial: torch.Tensor = None) -> (torch.Tensor, torch.Tensor):
+    """
+    The rank leading eigenpairs of positive semi-definite covariances, by a batched Chebyshev filtered subspace
+    iteration, in O(N^2) per filter degree instead of the O(N^3) of a full eigh.
+    The block holds rank + max(rank, 8) vectors, the extra ones speed up the convergence, and each sample leaves the
+    iterations once the residuals of its rank leading Ritz pairs are below the tolerance. The block starts from the
+    initial vectors, e.g. the subspace of the previous batch, completed by fixed random vectors.
+
+    Args:
+        covariance: the covariances, of size BxNxN.
+        rank: the number of leading eigenpairs.
+        initial: the initial vectors, of size BxNxK, K not larger than the block. Defaults to None, for random ones.
+
+    Returns:
+        the rank leading eigenvalues, of size Bxrank, sorted in descending order, and a unitary basis, of size BxNxN,
+        whose first rank columns are the leading eigenvectors and the other ones an orthonormal basis of their
+        complement, which are not eigenvectors. When the block is as large as the array, the full eigh is taken.
+    """
+    batch_size, N = covariance.shape[0], covariance.shape[-1]
+    block = rank + max(rank, 8)
+    if block >= N:
+        eigenvalues, eigenvectors = _sorted_eigh(covariance)
+        return eigenvalues[:, :rank], eigenvectors
+    generator = torch.Generator().manual_seed(0)
+    start = torch.randn(N, block, generator=generator, dtype=torch.float64)
+    start = start.to(covariance.device, covariance.dtype).expand(batch_size, N, block)
+    if initial is not None and initial.shape[:2] == (batch_size, N) and initial.shape[-1] <= block:
+        start = torch.cat([initial.to(covariance.dtype), start[:, :, initial.shape[-1]:]], dim=-1)
+    subspace = torch.linalg.qr(start).Q
+    eigenvalues = torch.empty(batch_size, rank, dtype=covariance.real.dtype, device=covariance.device)
+    eigenvectors = torch.empty(batch_size, N, rank, dtype=covariance.dtype, device=covariance.device)
+    active = torch.arange(batch_size, device=covariance.device)
+    for iteration in range(PARTIAL_EIGH_ITERATIONS):
+        # the Rayleigh-Ritz projection of the block
+        product = torch.bmm(covariance, subspace)
+        ritz_values, ritz_vectors = _sorted_eigh(torch.bmm(subspace.mH, product))
+        subspace, product = torch.bmm(subspace, ritz_vectors), torch.bmm(product, ritz_vectors)
+        residual = torch.linalg.vector_norm(
+            product[:, :, :rank] - subspace[:, :, :rank] * ritz_values[:, None, :rank], dim=1).amax(dim=1)
+        converged = residual <= PARTIAL_EIGH_TOLERANCE * ritz_values[:, 0].abs()
+        if iteration == PARTIAL_EIGH_ITERATIONS - 1:
+            converged[:] = True
+        eigenvalues[active[converged]] = ritz_values[converged, :rank]
+        eigenvectors[active[converged]] = subspace[converged, :, :rank]
+        if converged.all():
+            break
+        # the remaining samples are gathered once at most half of them are left, as the gather copies their
+        # covariances, until then the converged ones are iterated along
+        remaining = ~converged
+        if 2 * remaining.sum() <= len(remaining):
+            active, covariance = active[remaining], covariance[remaining]
+            subspace, product, ritz_values = subspace[remaining], product[remaining], ritz_values[remaining]
+        subspace = torch.linalg.qr(_chebyshev_filter(covariance, subspace, product, ritz_values, rank)).Q
+    # the first columns of the complete QR span the eigenvectors, and are replaced by them
+    basis = torch.linalg.qr(eigenvectors, mode="complete").Q
+    basis[:, :, :rank] = eigenvectors
+    return eigenvalues, basis
+
+
+def _chebyshev_filter(covariance: torch.Tensor, subspace: torch.Tensor, product: torch.Tensor,
+                      ritz_values: torch.Tensor, rank: int) -> torch.Tensor:
+    """
+    Filters the block by the Chebyshev polynomial bounded on [0, b], for b the smallest Ritz value of the block,
+    scaled at the largest one, by the scaled three terms recurrence of Zhou and Saad. The degree of each sample is
+    limited such that its leading Ritz vector is amplified at most 1e8 times more than the rank-th one, so the QR
+    of the filtered block keeps all the leading directions.
+
+    Args:
+        covariance: the covariances, of size BxNxN.
+        subspace: the Ritz vectors of the block, of size BxNxK.
+        product: the covariances times the Ritz vectors, of size BxNxK.
+        ritz_values: the Ritz values, of size BxK, sorted in descending order.
+        rank: the number of leading eigenpairs.
+
+    Returns:
+        the filtered block, of size BxNxK.
+    """
+    largest = ritz_values[:, 0].abs()
+    half_width = torch.maximum(ritz_values[:, -1].abs() / 2, torch.finfo(largest.dtype).eps * largest)
+    # the growth of the polynomial at the leading Ritz values, log(x + sqrt(x^2 - 1)) for x their scaled position
+    position = ((ritz_values[:, :rank].abs() - half_width[:, None]) / half_width[:, None]).clamp(min=1)
+    growth = torch.log(position + torch.sqrt(position ** 2 - 1))
+    degree = torch.floor(np.log(1e8) / (growth[:, 0] - growth[:, -1])).clamp(1, PARTIAL_EIGH_DEGREE).to(torch.long)
+    center, half_width = half_width[:, None, None], half_width[:, None, None]
+    sigma = half_width / (largest[:, None, None] - center)
+    first_sigma = sigma
+    previous, filtered = subspace, (product - center * subspace) * (sigma / half_width)
+    for order in range(2, int(degree.max()) + 1):
+        next_sigma = 1 / (2 / first_sigma - sigma)
+        next_filtered = (2 * next_sigma / half_width) * (torch.bmm(covariance, filtered) - center * filtered) \
+            - (sigma * next_sigma) * previous
+        # the samples whose degree is reached keep their filtered block
+        is_filtered = (order <= degree)[:, None, None]
+        previous = torch.where(is_filtered, filtered, previous)
+        filtered = torch.where(is_filtered, next_filtered, filtered)
+        sigma = torch.where(is_filtered, next_sigma, sigma)
+    return filtered
+
+
+def _unitary_partial_eigh(covariance: torch.Tensor, rank: int, initial: torch.Tensor = None) \
+        -> (torch.Tensor, torch.Tensor):
+    """_partial_eigh of the unitary transform of the covariances, as _sorted_unitary_eigh, the initial vectors are
+    given in the sensors domain."""
+    if initial is not None:
+        initial = real_valued_subspace(initial)
+    eigenvalues, eigenvectors = _partial_eigh(unitary_transform(covariance), rank, initial)
+    return eigenvalues, unitary_basis(eigenvectors)
+
+
+class EigenCache:
+    """
+    Keeps the sorted eigendecompositions of the last covariances, shared by all the subspace methods, so the methods
+    evaluated on the same batch decompose its covariance once. The last size decompositions are kept, four by default,
+    and the oldest is dropped by each new one. The cache holds the covariances of its entries, so it is cleared at the
+    end of an evaluation pass, see clear.
+    An entry is matched by the identity and the version counter of the covariance tensor, so an in-place change of
+    the covariance invalidates it. A covariance which requires grad, while grad is enabled, is never cached, each
+    forward keeps its own graph.
+    """
+
+    def __init__(self, size: int = 4):
+        """
+        Args:
+            size: the number of decompositions kept, e.g. the complex and the real-valued decompositions of the
+                sample and the spatially smoothed covariances of a batch. Defaults to 4.
+        """
+        self.size = size
+        self.enabled = True
+        self.__entries = []
+
+    def eigh(self, covariance: torch.Tensor, real_valued: bool = False, rank: int = None,
+             initial: torch.Tensor = None) -> (torch.Tensor, torch.Tensor):
+        """
+        Args:
+            covariance: the covariances, of size BxNxN.
+            real_valued: whether to decompose the forward-backward averaged covariances by the real eigh of their
+                unitary transform, see SubspaceMethod.set_processing. Defaults to False.
+            rank: the number of leading eigenpairs of the partial eigensolver, see _partial_eigh. Defaults to None,
+                for the full eigh.
+            initial: the initial vectors of the partial eigensolver, in the sensors domain. Defaults to None.
+
+        Returns:
+            the eigenvalues, of size BxN, or Bxrank for the partial eigensolver, and the eigenvectors as columns, of
+            size BxNxN, sorted by the magnitude of the eigenvalues in descending order.
+        """
+        if rank is None:
+            decompose = _sorted_unitary_eigh if real_valued else _sorted_eigh
+        else:
+            partial_eigh = _unitary_partial_eigh if real_valued else _partial_eigh
+            decompose = lambda matrix: partial_eigh(matrix, rank, initial)
+        if not self.enabled or (torch.is_grad_enabled() and covariance.requires_grad):
+            return decompose(covariance)
+        key = (real_valued, rank)
+        for cached, version, cached_key, eigenvalues, eigenvectors in self.__entries:
+            if cached is covariance and version == covariance._version and cached_key == key:
+                return eigenvalues, eigenvectors
+        eigenvalues, eigenvectors = decompose(covariance)
+        # the entry holds the covariance itself, so its identity can't be reused by another tensor
+        entry = (covariance, covariance._version, key, eigenvalues, eigenvectors)
+        self.__entries = [entry] + self.__entries[:self.size - 1]
+        return eigenvalues, eigenvectors
+
+    def clear(self):
+        """Drops all the entries, and the covariances they hold."""
+        self.__entries = []
+
+
+# the cache shared by all the subspace methods
+eigen_cache = EigenCache()
+
+
 class SubspaceMethod(nn.Module):
     """
 
@@ -25,6 +221,49 @@ class SubspaceMethod(nn.Module):
         self.normalized_eigenvals = None
         self.normalized_eigenvals_mean = None
         self.model_order_estimation = model_order_estimation
+        # "complex" decomposes the covariance, "real-valued" its unitary transform, see set_processing
+        self.processing = "complex"
+        # "full" or "partial" eigendecomposition, see set_eigensolver
+        self.eigensolver = "full"
+        self.warm_start = False
+        self.__warm_subspace = None
+
+    def set_processing(self, processing: str):
+        """
+        Sets the eigendecomposition of subspace_separation. "complex" decomposes the covariance by a complex eigh.
+        "real-valued" decomposes the real symmetric unitary transform Q^H R_fb Q of the forward-backward averaged
+        covariance R_fb, by a real eigh, about 4 times cheaper, and maps its eigenvectors back by Q. The subspaces are
+        then these of R_fb, which are the subspaces of R for a ULA, whose steering vectors are conjugate
+        centro-symmetric up to a phase, so the real-valued processing requires the far field narrowband model.
+        """
+        if processing == "real-valued":
+            if (not self.system_model.params.field_type.lower().startswith("far")
+                    or not self.system_model.params.signal_type.lower().startswith("narrowband")):
+                raise ValueError("SubspaceMethod.set_processing: the real-valued processing requires the far field "
+                                 "narrowband model")
+        elif processing != "complex":
+            raise ValueError(f"SubspaceMethod.set_processing: unknown processing {processing}")
+        self.processing = processing
+
+    def set_eigensolver(self, eigensolver: str, warm_start: bool = False):
+        """
+        Sets the eigensolver of subspace_separation. "full" takes all the eigenpairs by eigh. "partial" takes only
+        the leading ones, which span the signal subspace, by the batched subspace iteration of _partial_eigh, and
+        completes them by an orthonormal basis of the noise subspace. It falls back to the full eigh whenever the
+        whole spectrum is needed: when the number of sources isn't given, when a model order estimation is set, or
+        when the covariance requires grad, whose backward is taken through eigh. The partial eigensolver pays off
+        for large arrays, from about 64 sensors, the full eigh is faster for smaller ones.
+
+        Args:
+            eigensolver: "full" or "partial".
+            warm_start: whether the partial eigensolver starts from the signal subspace of the previous call, when
+                its batch has the same size, e.g. for tracking over consecutive batches. Defaults to False.
+        """
+        if eigensolver not in ["full", "partial"]:
+            raise ValueError(f"SubspaceMethod.set_eigensolver: unknown eigensolver {eigensolver}")
+        self.eigensolver = eigensolver
+        self.warm_start = warm_start
+        self.__warm_subspace = None
 
     def subspace_separation(self,
                             covariance: torch.Tensor,
@@ -39,10 +278,17 @@ class SubspaceMethod(nn.Module):
         Returns:
             the signal ana noise subspaces, both as torch.Tensor().
         """
-        eigenvalues, eigenvectors = torch.linalg.eigh(covariance)
-        sorted_idx = torch.argsort(torch.abs(eigenvalues), descending=True)
-        sorted_eigvectors = torch.gather(eigenvectors, 2,
-                                         sorted_idx.unsqueeze(-1).expand(-1, -1, covariance.shape[-1]).transpose(1, 2))
+        # the decomposition is taken from the shared cache, when another method already decomposed this covariance
+        real_valued = self.processing == "real-valued"
+        if self.__is_partial_eigh(covariance, number_of_sources):
+            rank = int(number_of_sources)
+            initial = self.__warm_subspace if self.warm_start else None
+            eigenvalues, sorted_eigvectors = eigen_cache.eigh(covariance, real_valued=real_valued, rank=rank,
+                                                              initial=initial)
+            if self.warm_start:
+                self.__warm_subspace = sorted_eigvectors[:, :, :rank]
+        else:
+            eigenvalues, sorted_eigvectors = eigen_cache.eigh(covariance, real_valued=real_valued)
         # number of sources estimation
         source_estimation, l_eig = self.estimate_number_of_sources(eigenvalues,
                                                                    number_of_sources=number_of_sources)
@@ -58,6 +304,12 @@ class SubspaceMethod(nn.Module):
 
         return signal_subspace.to(self.device), noise_subspace.to(self.device), source_estimation, l_eig
 
+    def __is_partial_eigh(self, covariance: torch.Tensor, number_of_sources) -> bool:
+        """Whether subspace_separation takes the partial eigensolver, see set_eigensolver."""
+        return (self.eigensolver == "partial" and number_of_sources is not None
+                and self.model_order_estimation is None
+                and not (torch.is_grad_enabled() and covariance.requires_grad))
+
     def estimate_number_of_sources(self, eigenvalues, number_of_sources: int = None):
         """
 
@@ -203,7 +455,21 @@ class SubspaceMethod(nn.Module):
         #         return self.eigen_threshold - 0.1
         return self.eigen_threshold
 
-    def pre_processing(self, x: torch.Tensor, mode: str = "sample"):
+    def pre_processing(self, x: torch.Tensor, mode: str = "sample", features: dict = None):
+        """
+        Calculates the covariance of the samples, or takes it from the precomputed features of the batch.
+
+        Args:
+            x: The input signal with dim BxNxT.
+            mode: "sample" for the sample covariance, "sps" for the spatially smoothed covariance.
+            features: The precomputed features of the batch, if any.
+
+        Returns:
+            The covariance of each element in the batch.
+        """
+        feature_name = {"sample": "sample_covariance", "sps": "sps_covariance"}.get(mode)
+        if features is not None and feature_name in features:
+            return features[feature_name].to(self.device)
         if mode == "sample":
             Rx = sample_covariance(x)
         elif mode == "sps":
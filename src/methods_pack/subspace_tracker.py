@@ -0,0 +1,163 @@
+"""
+This file contains the tracking of the covariance and the signal subspace of continuous streams of snapshots, for the
+estimation of the sources by a subspace method at every hop, instead of recomputing the sample covariance of the last
+snapshots and its full eigendecomposition for each estimate.
+The covariance is either exponentially weighted, R <- beta * R + (1 - beta) * x x^H, or the mean of a sliding window
+of the last L snapshots. Each hop updates it by the rank H update of its H new snapshots, and the sliding window
+downdates the snapshots which left it, so a hop costs O(N^2 * H), independent of the window length. The window sum is
+summed again from the window every L hops, so the rounding errors of the updates and downdates don't accumulate.
+The signal subspace is tracked between the hops by the orthonormal PAST recursion (OPAST, Abed-Meraim et al.), in
+O(N * M) per snapshot. At each hop, the tracked subspace warm starts the partial eigensolver of the subspace methods,
+which refines it into the leading eigenvectors of the covariance, so the estimates are these of the method on the
+tracked covariance, and the OPAST recursion restarts from the refined subspace.
+"""
+import torch
+
+from src.methods_pack.subspace_method import SubspaceMethod, eigen_cache
+
+
+class SubspaceTracker:
+    """
+    Estimates the sources of B continuous streams of snapshots by a subspace method, every hop snapshots.
+    The decomposition of the tracked covariance is taken by the shared eigendecomposition cache, which hands it to
+    the method, so the method decomposes it again only when the cache is disabled.
+
+    Args:
+        method: the subspace method of the estimates, created with model_order_estimation=None, since the model
+            order estimation needs the whole spectrum, e.g. MUSIC, ESPRIT, or RootMusic, whose default is
+            "threshold", so model_order_estimation=None is passed explicitly. Its eigensolver is set to "partial".
+        number_of_sources: the number of sources M.
+        hop: the number of snapshots between two estimates.
+        forgetting_factor: the forgetting factor beta of the exponentially weighted covariance, in (0, 1).
+            Defaults to None.
+        window_length: the length L of the sliding window of the covariance, not smaller than the hop. Defaults to
+            None. Exactly one of forgetting_factor and window_length is given.
+    """
+
+    def __init__(self, method: SubspaceMethod, number_of_sources: int, hop: int, forgetting_factor: float = None,
+                 window_length: int = None):
+        if (forgetting_factor is None) == (window_length is None):
+            raise ValueError("SubspaceTracker: exactly one of forgetting_factor and window_length should be given")
+        if forgetting_factor is not None and not 0 < forgetting_factor < 1:
+            raise ValueError(f"SubspaceTracker: the forgetting factor should be in (0, 1), got {forgetting_factor}")
+        if window_length is not None and window_length < hop:
+            raise ValueError(f"SubspaceTracker: the window length {window_length} is shorter than the hop {hop}")
+        if hop < 1:
+            raise ValueError(f"SubspaceTracker: the hop should be positive, got {hop}")
+        if method.model_order_estimation is not None:
+            raise ValueError("SubspaceTracker: the model order estimation of the method needs the whole spectrum, "
+                             "the tracker takes the number of sources instead")
+        self.method = method
+        self.method.set_eigensolver("partial")
+        self.number_of_sources = number_of_sources
+        self.hop = hop
+        self.forgetting_factor = forgetting_factor
+        self.window_length = window_length
+        # the forgetting factor of the OPAST recursion, the sliding window is followed by its equivalent memory
+        self.opast_forgetting_factor = forgetting_factor if window_length is None else 1 - 1 / window_length
+        self.reset()
+
+    def reset(self):
+        """Clears the tracked state, the next snapshots start new streams."""
+        self.covariance = None
+        self.subspace = None
+        self.inverse_correlation = None
+        self.__pending = None
+        self.__window = None
+        self.__window_sum = None
+        self.__window_position = 0
+        self.__window_filled = 0
+        self.__window_hops = 0
+        # the cached decompositions hold the tracked covariances of the previous streams
+        eigen_cache.clear()
+
+    def update(self, snapshots: torch.Tensor) -> list:
+        """
+        Takes the next snapshots of the streams, and estimates the sources at each hop they complete. The snapshots
+        left after the last complete hop wait for the next update.
+
+        Args:
+            snapshots: the next snapshots, of size BxNxT, or NxT for a single stream.
+
+        Returns:
+            list: the predictions of the method at each hop completed, as returned by its forward, e.g. the angles
+                of size BxM.
+        """
+        if snapshots.dim() == 2:
+            snapshots = snapshots[None, :, :]
+        snapshots = snapshots.to(torch.complex128)
+        pending = snapshots if self.__pending is None else torch.cat([self.__pending, snapshots], dim=-1)
+        predictions = []
+        with torch.no_grad():
+            while pending.shape[-1] >= self.hop:
+                predictions.append(self.__step(pending[:, :, :self.hop]))
+                pending = pending[:, :, self.hop:]
+        self.__pending = pending
+        return predictions
+
+    def __step(self, snapshots: torch.Tensor):
+        """Updates the covariance and the subspace by the snapshots of a hop, and estimates the sources."""
+        self.__update_covariance(snapshots)
+        if self.subspace is not None:
+            self.__update_subspace(snapshots)
+        rank = self.number_of_sources
+        real_valued = self.method.processing == "real-valued"
+        eigenvalues, eigenvectors = eigen_cache.eigh(self.covariance, real_valued=real_valued, rank=rank,
+                                                     initial=self.subspace)
+        # the OPAST recursion restarts from the refined subspace, whose correlation is diagonal
+        self.subspace = eigenvectors[:, :, :rank]
+        eigenvalues = eigenvalues[:, :rank].clamp(min=torch.finfo(eigenvalues.dtype).tiny)
+        self.inverse_correlation = torch.diag_embed((1 - self.opast_forgetting_factor) / eigenvalues).to(
+            self.subspace.dtype)
+        return self.method(self.covariance, rank)[0]
+
+    def __update_covariance(self, snapshots: torch.Tensor):
+        """The rank H update of the covariance by the snapshots of a hop, downdating these leaving the window."""
+        if self.window_length is None:
+            beta, hop = self.forgetting_factor, snapshots.shape[-1]
+            # the weight of each snapshot at the end of the hop, (1 - beta) * beta^(H - 1 - t)
+            weights = (1 - beta) * beta ** torch.arange(hop - 1, -1, -1, dtype=torch.float64, device=snapshots.device)
+            update = torch.bmm(snapshots * weights, snapshots.conj().transpose(1, 2))
+            self.covariance = update if self.covariance is None else beta ** hop * self.covariance + update
+            return
+        if self.__window is None:
+            batch_size, N, _ = snapshots.shape
+            self.__window = torch.zeros(batch_size, N, self.window_length, dtype=snapshots.dtype,
+                                        device=snapshots.device)
+            self.__window_sum = torch.zeros(batch_size, N, N, dtype=snapshots.dtype, device=snapshots.device)
+        slots = (self.__window_position + torch.arange(snapshots.shape[-1], device=snapshots.device)) \
+            % self.window_length
+        # the slots not filled yet hold zeros, whose downdate is null
+        leaving = self.__window[:, :, slots]
+        self.__window[:, :, slots] = snapshots
+        self.__window_hops += 1
+        if self.__window_hops == self.window_length:
+            # the sum again, so the rounding errors of the updates and downdates don't accumulate
+            self.__window_sum = torch.bmm(self.__window, self.__window.conj().transpose(1, 2))
+            self.__window_hops = 0
+        else:
+            self.__window_sum += torch.bmm(snapshots, snapshots.conj().transpose(1, 2)) \
+                - torch.bmm(leaving, leaving.conj().transpose(1, 2))
+        self.__window_position = (self.__window_position + snapshots.shape[-1]) % self.window_length
+        self.__window_filled = min(self.__window_filled + snapshots.shape[-1], self.window_length)
+        self.covariance = self.__window_sum / self.__window_filled
+
+    def __update_subspace(self, snapshots: torch.Tensor):
+        """The OPAST recursion of the subspace and of the inverse of its correlation, snapshot by snapshot."""
+        beta = self.opast_forgetting_factor
+        subspace, inverse_correlation = self.subspace, self.inverse_correlation
+        tiny = torch.finfo(torch.float64).tiny
+        for t in range(snapshots.shape[-1]):
+            x = snapshots[:, :, t:t + 1]
+            projection = torch.bmm(subspace.conj().transpose(1, 2), x)
+            gain = torch.bmm(inverse_correlation, projection) / beta
+            gamma = 1 / (1 + torch.bmm(projection.conj().transpose(1, 2), gain).real)
+            residual = gamma * (x - torch.bmm(subspace, projection))
+            inverse_correlation = inverse_correlation / beta - gamma * torch.bmm(gain, gain.conj().transpose(1, 2))
+            gain_norm = torch.sum(torch.abs(gain) ** 2, dim=1, keepdim=True).clamp(min=tiny)
+            residual_norm = torch.sum(torch.abs(residual) ** 2, dim=1, keepdim=True)
+            # the correction which keeps the subspace orthonormal
+            tau = (1 / torch.sqrt(1 + residual_norm * gain_norm) - 1) / gain_norm
+            residual = tau * torch.bmm(subspace, gain) + (1 + tau * gain_norm) * residual
+            subspace = subspace + torch.bmm(residual, gain.conj().transpose(1, 2))
+        self.subspace, self.inverse_correlation = subspace, inverse_correlation
@@ -8,6 +8,7 @@ from src.models_pack.parent_model import ParentModel
 from src.models_pack.subspacenet import SubspaceNet
 from src.system_model import SystemModel
 from src.methods_pack.music import MUSIC
+from src.utils import autocorrelation_lags
 
 
 class DCDMUSIC(ParentModel):
@@ -21,9 +22,11 @@ class DCDMUSIC(ParentModel):
     def __init__(self, system_model: SystemModel, tau: int, diff_method: tuple = ("esprit", "music_1d"),
                  regularization: str = None, variant: str = "small",
                  norm_layer: bool = True, batch_norm: bool = False, psd_epsilon: float = 1e-6,
-                 load_angle_branch: bool = False, angle_extractor: SubspaceNet = None, load_range_branch: bool = False):
+                 load_angle_branch: bool = False, angle_extractor: SubspaceNet = None, load_range_branch: bool = False,
+                 lags_dtype: torch.dtype = torch.complex128):
         super(DCDMUSIC, self).__init__(system_model)
         self.tau = tau
+        self.lags_dtype = lags_dtype
         self.regularization = regularization
         self.psd_epsilon = psd_epsilon
         self.norm_layer = norm_layer
@@ -41,6 +44,8 @@ class DCDMUSIC(ParentModel):
             self.range_branch.diff_method.init_cells(0.05)
 
     def forward(self, x: torch.Tensor, number_of_sources: int = None, ground_truth_angles: torch.Tensor = None):
+        # both branches get the same lag tensor, computed once
+        x = self.pre_processing(x)
         if self.train_mode == "angle":
             angles, sources_estimation, eigen_regularization = self.angle_branch_forward(x, number_of_sources)
             return angles, sources_estimation, eigen_regularization
@@ -56,6 +61,23 @@ class DCDMUSIC(ParentModel):
             distances = self.range_branch_forward(x, number_of_sources, known_angles=angles)
             return angles, distances, sources_estimation, eigen_regularization
 
+    def pre_processing(self, x: torch.Tensor):
+        """
+        Computes the autocorrelation lags of the input once for both branches, each branch takes its first tau lags.
+
+        Args:
+        -----
+            x (torch.Tensor): The complex input tensor of size [batch, N, T], or an already computed lag tensor.
+
+        Returns:
+        --------
+            torch.Tensor: The real lag tensor of size [batch, tau, 2N, N].
+        """
+        if not torch.is_complex(x) and x.dim() == 4:
+            return x
+        tau = max(self.angle_branch.tau, self.range_branch.tau)
+        return autocorrelation_lags(x.to(self.device), tau, dtype=self.lags_dtype)
+
     def angle_branch_forward(self, x: torch.Tensor, number_of_sources: int = None):
         Rz = self.angle_branch.get_surrogate_covariance(x)
         angles_predictions, sources_estimation, eigen_regularization = self.angle_branch.diff_method(Rz, number_of_sources)
@@ -67,7 +89,9 @@ class DCDMUSIC(ParentModel):
         return ranges_predictions
 
     def training_step(self, batch, batch_idx):
-        x, sources_num, labels = batch
+        x, sources_num, labels = batch[:3]
+        # the precomputed lag tensor is shared by both branches
+        x = self.angle_branch.get_model_input(x, batch[3] if len(batch) > 3 else None)
         if x.dim() == 2:
             x = x.unsqueeze(0)
         if (sources_num != sources_num[0]).any():
@@ -98,7 +122,9 @@ class DCDMUSIC(ParentModel):
 
 
     def validation_step(self, batch, batch_idx, is_test: bool=False):
-        x, sources_num, labels = batch
+        x, sources_num, labels = batch[:3]
+        # the precomputed lag tensor is shared by both branches
+        x = self.angle_branch.get_model_input(x, batch[3] if len(batch) > 3 else None)
         if x.dim() == 2:
             x = x.unsqueeze(0)
         if (sources_num != sources_num[0]).any():
@@ -154,14 +180,14 @@ class DCDMUSIC(ParentModel):
         self.angle_branch = SubspaceNet(tau=self.tau, diff_method=diff_method, train_loss_type="rmspe",
                             system_model=self.system_model, field_type="far", regularization=self.regularization,
                             variant=self.variant, norm_layer=self.norm_layer, batch_norm=self.batch_norm,
-                            psd_epsilon=self.psd_epsilon)
+                            psd_epsilon=self.psd_epsilon, lags_dtype=self.lags_dtype)
         self.load_angle_branch(load_state)
 
     def __init_range_branch(self, load_state: bool, diff_method: str):
         self.range_branch = SubspaceNet(tau=self.tau, diff_method=diff_method, train_loss_type="rmspe",
                             system_model=self.system_model, field_type="near", regularization=None,
                             variant=self.variant, norm_layer=self.norm_layer, batch_norm=self.batch_norm,
-                            psd_epsilon=self.psd_epsilon)
+                            psd_epsilon=self.psd_epsilon, lags_dtype=self.lags_dtype)
         self.load_range_branch(load_state)
 
     def load_angle_branch(self, load_state: bool):
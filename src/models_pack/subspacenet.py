@@ -8,7 +8,8 @@ import torch.nn as nn
 from src.metrics import RMSPELoss, CartesianLoss, MusicSpectrumLoss
 from src.models_pack.parent_model import ParentModel
 from src.system_model import SystemModel
-from src.utils import gram_diagonal_overload, validate_constant_sources_number, L2NormLayer, AntiRectifier, TraceNorm
+from src.utils import gram_diagonal_overload, validate_constant_sources_number, L2NormLayer, AntiRectifier, TraceNorm, \
+    autocorrelation_lags
 
 from src.methods_pack.music import MUSIC
 from src.methods_pack.esprit import ESPRIT
@@ -19,7 +20,8 @@ from src.methods_pack.beamformer import Beamformer
 class SubspaceNet(ParentModel):
     def __init__(self, tau: int, diff_method: str = "root_music", train_loss_type: str="rmspe",
                  system_model: SystemModel = None, field_type: str = "far", regularization: str = None, variant: str = "small",
-                  norm_layer: bool=True, psd_epsilon: float=.1, batch_norm: bool=False):
+                  norm_layer: bool=True, psd_epsilon: float=.1, batch_norm: bool=False,
+                 lags_dtype: torch.dtype = torch.complex128):
         """Initializes the SubspaceNet model.
 
         Args:
@@ -34,12 +36,14 @@ class SubspaceNet(ParentModel):
             norm_layer (bool): Normalization layer.
             psd_epsilon (float): PSD epsilon.
             batch_norm (bool): Batch normalization.
+            lags_dtype (torch.dtype): The precision of the autocorrelation lags, torch.complex128 or torch.complex64.
 
         """
         super(SubspaceNet, self).__init__(system_model)
         # set model parameters
         self.field_type = field_type.lower()
         self.tau = tau
+        self.lags_dtype = lags_dtype
         self.diff_method = None # Holder for the differentiable subspace method
         # set model architecture
         self.p = 0.2
@@ -217,27 +221,36 @@ class SubspaceNet(ParentModel):
 
         Args:
         -----
-            x (torch.Tensor): The complex input tensor of size [batch, N, T].
+            x (torch.Tensor): The complex input tensor of size [batch, N, T], or the real lag tensor of
+                size [batch, tau', 2N, N], tau' >= tau, precomputed by the feature store.
 
         Returns:
         --------
             Rx_tau (torch.Tensor): The pre-processed real tensor of size [batch, tau, 2N, N].
         """
-        batch_size, N, T = x.shape
-        Rx_tau = torch.zeros(batch_size, self.tau, 2 * N, N, device=self.device)
-        meu = torch.mean(x, dim=-1, keepdim=True).to(self.device)
-        center_x = x - meu
-        if center_x.dim() == 2:
-            center_x = center_x[None, :, :]
-
-        for i in range(self.tau):
-            x1 = center_x[:, :, :center_x.shape[-1] - i].to(torch.complex128)
-            x2 = torch.conj(center_x[:, :, i:]).transpose(1, 2).to(torch.complex128)
-            Rx_lag = torch.einsum("BNT, BTM -> BNM", x1, x2) / (center_x.shape[-1] - i - 1)
-            Rx_lag = torch.cat((torch.real(Rx_lag), torch.imag(Rx_lag)), dim=1)
-            Rx_tau[:, i, :, :] = Rx_lag
-
-        return Rx_tau
+        if not torch.is_complex(x) and x.dim() == 4:
+            # already pre-processed
+            return x[:, :self.tau].to(self.device)
+        return autocorrelation_lags(x.to(self.device), self.tau, dtype=self.lags_dtype)
+
+    def get_model_input(self, x: torch.Tensor, features: dict = None):
+        """
+        Returns the input of the model for a batch, the precomputed lag tensor if the batch holds one with
+        enough lags, and the raw samples otherwise.
+
+        Args:
+        -----
+            x (torch.Tensor): The complex input tensor of size [batch, N, T].
+            features (dict): The precomputed features of the batch, if any.
+
+        Returns:
+        --------
+            torch.Tensor: The input of the model.
+        """
+        lag_tensor = None if features is None else features.get("lag_tensor")
+        if lag_tensor is not None and lag_tensor.shape[1] >= self.tau:
+            return lag_tensor
+        return x
 
     def __setup_model_variant(self, variant: str):
         if variant in ["big", "V2"]:
@@ -395,7 +408,8 @@ class SubspaceNet(ParentModel):
         return self.__validation_step_far_field(batch, batch_idx)
 
     def __prepare_batch_far_field(self, batch):
-        x, sources_num, angles = batch
+        x, sources_num, angles = batch[:3]
+        x = self.get_model_input(x, batch[3] if len(batch) > 3 else None)
         validate_constant_sources_number(sources_num)
         if x.dim() == 2:
             x = x.unsqueeze(0)
@@ -438,7 +452,8 @@ class SubspaceNet(ParentModel):
         return self.__validation_step_near_field(batch, batch_idx, is_test=True)
 
     def __prepare_batch_near_field(self, batch):
-        x, sources_num, labels = batch
+        x, sources_num, labels = batch[:3]
+        x = self.get_model_input(x, batch[3] if len(batch) > 3 else None)
         validate_constant_sources_number(sources_num)
         if x.dim() == 2:
             x = x.unsqueeze(0)
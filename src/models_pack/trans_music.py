@@ -232,7 +232,7 @@ class TransMUSIC(ParentModel):
         raise NotImplementedError
 
     def __training_step_far_field(self, batch, batch_idx):
-        x, sources_num, angles = batch
+        x, sources_num, angles = batch[:3]
         x = x.to(self.device)
         angles = angles.to(self.device)
         if x.dim() == 2:
@@ -257,7 +257,7 @@ class TransMUSIC(ParentModel):
         return loss, acc, None
 
     def __training_step_near_field(self, batch, batch_idx):
-        x, sources_num, labels = batch
+        x, sources_num, labels = batch[:3]
         if x.dim() == 2:
             x = x.unsqueeze(0)
         if (sources_num != sources_num[0]).any():
@@ -285,7 +285,7 @@ class TransMUSIC(ParentModel):
         return loss, acc, None
 
     def __valid_step_near_field(self, batch, batch_idx, is_test: bool=False):
-        x, sources_num, labels = batch
+        x, sources_num, labels = batch[:3]
         if x.dim() == 2:
             x = x.unsqueeze(0)
         if (sources_num != sources_num[0]).any():
@@ -37,6 +37,8 @@ class Samples(SystemModel):
             signal_variance: float = 1): Creates samples based on the specified mode and parameters.
         noise_creation(noise_mean, noise_variance): Creates noise based on the specified mean and variance.
         signal_creation(signal_mean=0, signal_variance=1, SNR=10): Creates signals based on the specified mode and parameters.
+        set_labels_batch(batch_size, number_of_sources, angles, distances): Sets the labels for a batch of samples.
+        samples_creation_batch(...): Creates a batch of samples at once, the vectorized version of samples_creation.
     """
 
     def __init__(self, system_model_params: SystemModelParams):
@@ -313,3 +315,241 @@ class Samples(SystemModel):
 
         else:
             raise Exception(f"signal type {self.params.signal_type} is not defined")
+
+    def set_labels_batch(self, batch_size: int, number_of_sources: int, angles: list = None, distances: list = None):
+        """
+        Sets the labels for a batch of samples at once, the batched counterpart of set_labels.
+        The angles and distances are stored as arrays of shape [batch_size, number_of_sources].
+
+        Args:
+        -----
+            batch_size (int): The number of samples in the batch.
+            number_of_sources (int): The number of sources in each sample.
+            angles (list, optional): Predefined angles in degrees, shared by all samples. Defaults to None.
+            distances (list, optional): Predefined distances, shared by all samples. Defaults to None.
+
+        """
+        if self.params.field_type.lower() == "far":
+            self.angles = self.__create_angles_batch(batch_size, number_of_sources, angles)
+            self.distances = None
+        elif self.params.field_type.lower() in {"near", "full"}:
+            self.angles = self.__create_angles_batch(batch_size, number_of_sources, angles)
+            self.distances = self.__create_distances_batch(batch_size, number_of_sources, distances)
+        else:
+            raise ValueError(f"Samples.set_labels_batch: Field type {self.params.field_type} is not defined")
+
+    def get_labels_batch(self):
+        """
+        Returns the labels of the batch set by set_labels_batch.
+
+        Returns:
+        --------
+            torch.Tensor: Labels of shape [B, M] in the far field case or [B, 2M] in the near field case.
+        """
+        if self.params.field_type.lower() == "far":
+            return torch.tensor(self.angles, dtype=torch.float32)
+        elif self.params.field_type.lower() in {"near", "full"}:
+            return torch.cat((torch.tensor(self.angles, dtype=torch.float32),
+                              torch.tensor(self.distances, dtype=torch.float32)), dim=1)
+        else:
+            raise ValueError(f"Samples.get_labels_batch: Field type {self.params.field_type} is not defined")
+
+    def samples_creation_batch(
+        self,
+        noise_mean: float = 0,
+        noise_variance: float = 1,
+        signal_mean: float = 0,
+        signal_variance: float = 1,
+        source_number: int = None,
+    ):
+        """Creates a batch of samples for the labels set by set_labels_batch, the batched counterpart of
+        samples_creation. The samples follow the same distribution as the ones created by samples_creation.
+
+        Args:
+        -----
+            noise_mean (float, optional): Mean of the noise. Defaults to 0.
+            noise_variance (float, optional): Variance of the noise. Defaults to 1.
+            signal_mean (float, optional): Mean of the signal. Defaults to 0.
+            signal_variance (float, optional): Variance of the signal. Defaults to 1.
+            source_number (int, optional): The number of sources in each sample.
+
+        Returns:
+        --------
+            tuple: Tuple containing the created samples [B, N, T], signal [B, M, T], steering matrices [B, N, M],
+                and noise [B, N, T].
+
+        Raises:
+        -------
+            Exception: If the signal_type or field_type is not defined.
+
+        """
+        batch_size = self.angles.shape[0]
+        if self.params.signal_type.startswith("broadband"):
+            raise Exception("Samples.samples_creation_batch: Broadband signal type is not defined for far field")
+        # Generate signal matrices
+        signal = self.signal_creation_batch(batch_size, signal_mean, signal_variance, source_number=source_number)
+        signal = torch.from_numpy(signal)
+        # Generate noise matrices
+        noise = self.noise_creation_batch(batch_size, noise_mean, noise_variance)
+        noise = torch.from_numpy(noise)
+        if self.params.field_type.startswith("far"):
+            A = self.steering_vec_batch(self.angles, nominal=True)
+        elif self.params.field_type.startswith("near"):
+            A = self.steering_vec_batch(self.angles, self.distances, nominal=False)
+        elif self.params.field_type.startswith("full"):
+            A = self.steering_vec_batch(self.angles, self.distances)
+        else:
+            raise Exception(f"Samples.params.field_type: Field type {self.params.field_type} is not defined")
+        samples = torch.bmm(A, signal) + noise
+        return samples, signal, A, noise
+
+    def noise_creation_batch(self, batch_size: int, noise_mean, noise_variance):
+        """Creates noise for a batch of samples, the batched counterpart of noise_creation.
+
+        Args:
+        -----
+            batch_size (int): The number of samples in the batch.
+            noise_mean (float): Mean of the noise.
+            noise_variance (float): Variance of the noise.
+
+        Returns:
+        --------
+            np.ndarray: Generated noise of shape [B, N, T].
+
+        """
+        shape = (batch_size, self.params.N, self.params.T)
+        noise = (
+            np.sqrt(noise_variance)
+            * (np.sqrt(2) / 2)
+            * (np.random.randn(*shape) + 1j * np.random.randn(*shape))
+            + noise_mean
+        )
+        return noise
+
+    def signal_creation_batch(self, batch_size: int, signal_mean: float = 0, signal_variance: float = 1,
+                              source_number: int = None):
+        """
+        Creates signals for a batch of samples, the batched counterpart of signal_creation.
+
+        Args:
+        -----
+            batch_size (int): The number of samples in the batch.
+            signal_mean (float, optional): Mean of the signal. Defaults to 0.
+            signal_variance (float, optional): Variance of the signal. Defaults to 1.
+            source_number (int, optional): The number of sources in each sample.
+
+        Returns:
+        --------
+            np.ndarray: Created signals of shape [B, M, T].
+
+        Raises:
+        -------
+            Exception: If the signal type is not defined.
+        """
+        M = source_number
+        if self.params.snr is None:
+            # a different snr for each sample, as in the per-sample creation
+            snr = np.random.uniform(-5, 5, size=(batch_size, 1, 1))
+        else:
+            snr = self.params.snr
+        amplitude = 10 ** (snr / 10)
+        if self.params.signal_type == "narrowband":
+            if self.params.signal_nature == "non-coherent":
+                shape = (batch_size, M, self.params.T)
+            elif self.params.signal_nature == "coherent":
+                # Coherent signals: same amplitude and phase for all signals
+                shape = (batch_size, 1, self.params.T)
+            else:
+                raise Exception(f"signal nature {self.params.signal_nature} is not defined")
+            sig = (
+                amplitude
+                * (np.sqrt(2) / 2)
+                * np.sqrt(signal_variance)
+                * (np.random.randn(*shape) + 1j * np.random.randn(*shape))
+                + signal_mean
+            )
+            if self.params.signal_nature == "coherent":
+                sig = np.repeat(sig, M, axis=1)
+            return sig
+        else:
+            raise Exception(f"signal type {self.params.signal_type} is not defined")
+
+    def __create_angles_batch(self, batch_size: int, M: int, doa: list = None) -> np.ndarray:
+        """
+        Creates the angles for a batch of samples, each set holds M angles with a minimal gap of 10 degrees,
+        drawn uniformly as in set_angles.
+
+        Args:
+        -----
+            batch_size (int): The number of samples in the batch.
+            M (int): The number of sources in each sample.
+            doa (list, optional): Predefined angles in degrees, shared by all samples. Defaults to None.
+
+        Returns:
+        --------
+            np.ndarray: The angles in radians, of shape [B, M].
+        """
+        if doa is not None:
+            return np.tile(np.deg2rad(np.asarray(doa, dtype=np.float64)), (batch_size, 1))
+        gap = 10
+        doa_range = self.params.doa_range
+        doa_resolution = self.params.doa_resolution
+        if doa_resolution <= 0:
+            raise ValueError("DOA resolution must be positive.")
+        if M <= 0:
+            raise ValueError("M (number of elements) must be positive.")
+
+        # Compute the range of possible DOA values, as in set_angles
+        max_offset = (gap - 1) * (M - 1)
+        effective_range = 2 * doa_range - max_offset
+        if effective_range <= 0:
+            raise ValueError(f"Invalid effective range: {effective_range}. Check your parameters.")
+        if doa_resolution >= 1:
+            options_number = len(range(0, effective_range, doa_resolution))
+        else:
+            options_number = int(effective_range // doa_resolution)
+        if options_number < M:
+            raise ValueError(f"Samples.set_labels_batch: can't sample {M} angles out of {options_number} options.")
+
+        # Draw M distinct options for each sample, uniformly over all subsets.
+        if M * M > options_number:
+            sampled_idx = np.argsort(np.random.random((batch_size, options_number)), axis=1)[:, :M]
+            sampled_idx.sort(axis=1)
+        else:
+            # rejection sampling is cheap when collisions are rare
+            sampled_idx = np.sort(np.random.randint(0, options_number, size=(batch_size, M)), axis=1)
+            collisions = (np.diff(sampled_idx, axis=1) == 0).any(axis=1)
+            while collisions.any():
+                sampled_idx[collisions] = np.sort(
+                    np.random.randint(0, options_number, size=(collisions.sum(), M)), axis=1)
+                collisions = (np.diff(sampled_idx, axis=1) == 0).any(axis=1)
+        sampled_values = sampled_idx * doa_resolution
+
+        # Compute DOAs
+        DOA = (gap - 1) * np.arange(M)[None, :] + sampled_values - doa_range
+        if (DOA < -doa_range).any() or (DOA > doa_range).any():
+            raise ValueError("Computed DOAs exceed the valid range. Check your logic.")
+
+        return np.deg2rad(np.round(DOA, 3))
+
+    def __create_distances_batch(self, batch_size: int, M: int, distance: list = None) -> np.ndarray:
+        """
+        Creates the distances for a batch of samples, drawn uniformly as in set_distances.
+
+        Args:
+        -----
+            batch_size (int): The number of samples in the batch.
+            M (int): The number of sources in each sample.
+            distance (list, optional): Predefined distances, shared by all samples. Defaults to None.
+
+        Returns:
+        --------
+            np.ndarray: The distances, of shape [B, M].
+        """
+        if distance is not None:
+            return np.tile(np.asarray(distance, dtype=np.float64), (batch_size, 1))
+        distances_options = np.arange(np.ceil(self.fresnel) + self.params.range_resolution,
+                                      np.floor(self.fraunhofer * self.params.max_range_ratio_to_limit),
+                                      self.params.range_resolution)
+        distances = distances_options[np.random.randint(0, len(distances_options), size=(batch_size, M))]
+        return np.round(distances, 3)
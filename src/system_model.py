@@ -8,18 +8,25 @@ Edited: 02/06/23
 
 Purpose:
 --------
-This script defines the SystemModel class for defining the settings of the DoA estimation system model.
+This script defines the SystemModel class for defining the settings of the DoA estimation system model,
+and the SteeringRegistry class, a process-wide cache of the steering dictionaries of the search grids,
+shared by all the estimators through SystemModel.get_steering_dict.
 """
 import warnings
 
 # Imports
 import numpy as np
 from dataclasses import dataclass
+from collections import OrderedDict
+import hashlib
 
 import torch
 import matplotlib.pyplot as plt
 from src.config import device
 
+# default memory budget of the steering registry
+STEERING_REGISTRY_BYTES = 1024 ** 3
+
 
 @dataclass
 class SystemModelParams:
@@ -462,6 +469,90 @@ class SystemModel(object):
         steering_matrix = torch.exp(-2 * 1j * torch.pi * time_delay / self.params.wavelength)
         return steering_matrix
 
+    def steering_vec_batch(self, angles: np.ndarray, ranges: np.ndarray = None, nominal: bool = True,
+                           field_type: str = None) -> torch.Tensor:
+        """
+        Computes the steering matrices for a batch of sources sets at once.
+        This is the batched counterpart of steering_vec_far_field, steering_vec_near_field and
+        steering_vec_full_model (without search grid generation), used for the batched samples creation.
+
+        Args:
+            angles: the angles of the sources from origin, of shape [B, M].
+            ranges: the ranges of the sources from origin, of shape [B, M]. In case of Far field, the value is None.
+            nominal: a flag that suggest if there is any kind of calibration errors.
+                Ignored for the full model, as in steering_vec_full_model.
+            field_type: overrides the field type of the system model, e.g. "near" for the Fresnel approximation
+                used by the search grids. Defaults to None.
+
+        Returns:
+            torch.Tensor: the steering matrices, of shape [B, N, M].
+        """
+        if not self.params.signal_type.startswith("narrowband"):
+            raise Exception(f"SystemModel.steering_vec_batch: signal type {self.params.signal_type} is not supported")
+        field_type = (self.params.field_type if field_type is None else field_type).lower()
+        # when creating the data, better not to use GPU
+        theta = torch.as_tensor(angles, dtype=torch.float64, device="cpu")[:, None, :]  # Shape: [B, 1, M]
+        array = torch.from_numpy(self.array).to(torch.float64)[None, :, None]  # Shape: [1, N, 1]
+        dist_array_elems = self.dist_array_elems["narrowband"] * torch.ones(self.params.N, dtype=torch.float64)
+        if not nominal and not field_type.startswith("full"):
+            dist_array_elems = dist_array_elems + self.get_distance_noise(False).to(torch.float64)
+        dist_array_elems = dist_array_elems[None, :, None]  # Shape: [1, N, 1]
+
+        if field_type.startswith("far"):
+            time_delay = array * dist_array_elems * torch.sin(theta)
+        elif field_type.startswith("near"):
+            distances = torch.as_tensor(ranges, dtype=torch.float64, device="cpu")[:, None, :]
+            first_order = array * dist_array_elems * torch.sin(theta)
+            second_order = -0.5 * torch.pow(array * dist_array_elems * torch.cos(theta), 2) / distances
+            time_delay = first_order + second_order
+        elif field_type.startswith("full"):
+            distances = torch.as_tensor(ranges, dtype=torch.float64, device="cpu")[:, None, :]
+            sensor_dist_ratio = dist_array_elems * torch.abs(array) / distances
+            sqrt_delay = torch.sqrt(1 + torch.pow(sensor_dist_ratio, 2) - 2 * sensor_dist_ratio * torch.sin(theta))
+            time_delay = distances * (1 - sqrt_delay)
+        else:
+            raise Exception(f"SystemModel.steering_vec_batch: field type {field_type} is not defined")
+
+        steering_matrix = torch.exp(-2 * 1j * torch.pi * time_delay / self.params.wavelength)
+        if not nominal and not field_type.startswith("full") and self.params.sv_noise_var > 0:
+            # Calculate additional steering vector noise
+            mis_geometry_noise = ((np.sqrt(2) / 2) * np.sqrt(self.params.sv_noise_var)
+                                  * (np.random.randn(*time_delay.shape) + 1j * np.random.randn(*time_delay.shape)))
+            steering_matrix = steering_matrix + torch.from_numpy(mis_geometry_noise)
+        return steering_matrix
+
+    def get_steering_dict(self, angles: torch.Tensor, ranges: torch.Tensor = None, device=None) -> torch.Tensor:
+        """
+        Returns the nominal steering dictionary of a search grid, from the process-wide steering registry.
+        The dictionary is computed once for each array geometry and grid, and the same tensor is handed to every
+        estimator using it, so it must not be modified in place.
+
+        Args:
+            angles: the angles of the grid, of shape [A].
+            ranges: the ranges of the grid, of shape [R], or None for the far field dictionary.
+            device: the device of the dictionary. Defaults to the device of the system model.
+
+        Returns:
+            torch.Tensor: the steering dictionary, of shape [N, A] in the far field case
+                and [N, A, R] in the near field case.
+        """
+        device = torch.device(self.device if device is None else device)
+        key = (self.params.field_type.lower() if ranges is not None else "far", self.params.signal_type.lower(),
+               self.array.tobytes(), self.dist_array_elems["narrowband"], self.params.wavelength,
+               SteeringRegistry.get_grid_key(angles), SteeringRegistry.get_grid_key(ranges),
+               torch.complex128, str(device))
+
+        def create_steering_dict():
+            with torch.no_grad():
+                if ranges is None:
+                    steering_dict = self.steering_vec_far_field(angles, nominal=True, fix_sv_noise=True)
+                else:
+                    steering_dict = self.steering_vec_near_field(angles, ranges, nominal=True,
+                                                                 generate_search_grid=True)
+            return steering_dict.to(device)
+
+        return steering_registry.get_or_create(key, create_steering_dict)
+
     def steering_derivative(self, angles):
         """
         Compute the derivative of the steering vector with respect to the angles.
@@ -477,6 +568,50 @@ class SystemModel(object):
         derivative_steering = 1j * (2 * torch.pi / self.params.wavelength) * dist_array_elems * torch.cos(angles)[:, None, :] * array * steering_matrix
         return derivative_steering
 
+    def steering_vec_derivatives(self, angles: torch.Tensor, ranges: torch.Tensor = None) -> tuple:
+        """
+        Computes the nominal narrowband steering matrices of a batch of sources, with their first and second
+        derivatives with respect to the angle, or to the angle and the range, on the device of the angles.
+        The far field model is used when ranges is None, the near field (Fresnel) model otherwise.
+
+        Args:
+            angles: the angles of the sources, of shape [B, M].
+            ranges: the ranges of the sources, of shape [B, M], or None.
+
+        Returns:
+            tuple: the steering matrices of shape [B, N, M], the first derivatives of shape [B, N, M, D] and the
+                second derivatives of shape [B, N, M, D, D], for D the number of parameters (1 or 2).
+        """
+        if not self.params.signal_type.startswith("narrowband"):
+            raise Exception(f"SystemModel.steering_vec_derivatives: signal type {self.params.signal_type} is not supported")
+        theta = angles.to(torch.float64)[:, None, :]  # Shape: [B, 1, M]
+        # the distance of each sensor from the origin, Shape: [1, N, 1]
+        u = (torch.from_numpy(self.array).to(torch.float64).to(angles.device)
+             * self.dist_array_elems["narrowband"])[None, :, None]
+        sin, cos = torch.sin(theta), torch.cos(theta)
+        if ranges is None:
+            time_delay = u * sin
+            first = (u * cos)[..., None]
+            second = (-u * sin)[..., None, None]
+        else:
+            r = ranges.to(torch.float64)[:, None, :]
+            time_delay = u * sin - 0.5 * (u * cos) ** 2 / r
+            d_theta = u * cos + u ** 2 * sin * cos / r
+            d_r = 0.5 * (u * cos) ** 2 / r ** 2
+            d_theta_theta = -u * sin + u ** 2 * (cos ** 2 - sin ** 2) / r
+            d_theta_r = -u ** 2 * sin * cos / r ** 2
+            d_r_r = -(u * cos) ** 2 / r ** 3
+            first = torch.stack((d_theta, d_r), dim=-1)
+            second = torch.stack((torch.stack((d_theta_theta, d_theta_r), dim=-1),
+                                  torch.stack((d_theta_r, d_r_r), dim=-1)), dim=-2)
+        # a = exp(-jk * tau), so da = -jk * dtau * a and d2a = (-jk * d2tau - k^2 * dtau dtau^T) * a
+        k = 2 * torch.pi / self.params.wavelength
+        steering_matrix = torch.exp(-1j * k * time_delay)
+        first_derivative = -1j * k * first * steering_matrix[..., None]
+        second_derivative = ((-1j * k * second - k ** 2 * first[..., :, None] * first[..., None, :])
+                             * steering_matrix[..., None, None])
+        return steering_matrix, first_derivative, second_derivative
+
     def plot_system(self):
         """
         Plot the system model.
@@ -522,5 +657,85 @@ class SystemModel(object):
         plt.show()
 
 
+class SteeringRegistry:
+    """
+    A process-wide cache of steering dictionaries, keyed by (field type, signal type, array geometry, grid, dtype,
+    device). Each dictionary is computed once and the same tensor is shared by all the estimators, instead of each
+    one holding its own copy. The total size of the cached tensors is kept under max_bytes by evicting the least
+    recently used ones; an evicted tensor stays valid for the estimators which already hold it.
 
+    The shared tensors are read-only by contract. A tensor which was modified in place is detected by its version
+    counter, and is recomputed on the next request.
+    """
+    def __init__(self, max_bytes: int = STEERING_REGISTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.hits, self.misses = 0, 0
+        self.__entries = OrderedDict()  # key -> (tensor, version)
+        self.__size = 0
+
+    @staticmethod
+    def get_grid_key(grid):
+        """Returns a hashable key of the values of a grid, None for no grid."""
+        if grid is None:
+            return None
+        grid = torch.as_tensor(grid).detach().to("cpu", torch.float64).contiguous()
+        return tuple(grid.shape), hashlib.sha1(grid.numpy().tobytes()).hexdigest()
+
+    def get_or_create(self, key, create_fn) -> torch.Tensor:
+        """
+        Returns the cached tensor of the key, or creates it by create_fn and caches it.
 
+        Args:
+            key: a hashable key of the tensor.
+            create_fn: a function with no arguments which creates the tensor.
+
+        Returns:
+            torch.Tensor: the shared tensor.
+        """
+        entry = self.__entries.get(key)
+        if entry is not None and entry[0]._version == entry[1]:
+            self.hits += 1
+            self.__entries.move_to_end(key)
+            return entry[0]
+        if entry is not None:
+            warnings.warn("SteeringRegistry.get_or_create: a shared steering dictionary was modified in place, "
+                          "recomputing it")
+            self.remove(key)
+        self.misses += 1
+        tensor = create_fn()
+        tensor_bytes = tensor.element_size() * tensor.nelement()
+        if tensor_bytes <= self.max_bytes:
+            self.__entries[key] = (tensor, tensor._version)
+            self.__size += tensor_bytes
+            self.evict(self.max_bytes)
+        return tensor
+
+    def evict(self, max_bytes: int = 0):
+        """Evicts the least recently used tensors until the cached size is at most max_bytes."""
+        while self.__size > max_bytes and self.__entries:
+            key = next(iter(self.__entries))
+            self.remove(key)
+
+    def remove(self, key):
+        """Removes the tensor of the key from the registry, if it's cached."""
+        entry = self.__entries.pop(key, None)
+        if entry is not None:
+            self.__size -= entry[0].element_size() * entry[0].nelement()
+
+    def clear(self):
+        """Removes all the tensors from the registry."""
+        self.evict(0)
+
+    def get_size(self) -> int:
+        """Returns the total size, in bytes, of the cached tensors."""
+        return self.__size
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __repr__(self):
+        return (f"SteeringRegistry(entries={len(self)}, size={self.__size / 1024 ** 2:.1f} MiB, "
+                f"max={self.max_bytes / 1024 ** 2:.1f} MiB, hits={self.hits}, misses={self.misses})")
+
+
+steering_registry = SteeringRegistry()
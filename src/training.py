@@ -41,12 +41,14 @@ import torch.nn as nn
 import numpy as np
 from pathlib import Path
 from src.config import device
+from torch.utils.data import IterableDataset
 import warnings
 
 
 # internal imports
 from src.models import (SubspaceNet, DCDMUSIC, TransMUSIC)
 from src.evaluation import evaluate_dnn_model
+from src.methods_pack.subspace_method import eigen_cache
 
 
 class TrainingParamsNew:
@@ -98,6 +100,11 @@ class Trainer:
 
     def train(self, train_dataloader, valid_dataloader, use_wandb:bool=False, save_final:bool=False,
               load_model:bool=False):
+        # a stream of generated batches (SamplesStream) is accepted directly, and wrapped by its DataLoader
+        if isinstance(train_dataloader, IterableDataset):
+            train_dataloader = train_dataloader.get_dataloader()
+        if isinstance(valid_dataloader, IterableDataset):
+            valid_dataloader = valid_dataloader.get_dataloader()
         self.model = self.model.to(self.device)
         self.__configure_model()
         self.__init_wandb(use_wandb)
@@ -134,6 +141,7 @@ class Trainer:
             # Set model to train mode
             self.model.train()
             train_length = 0
+            self.__set_epoch(train_dataloader, epoch)
 
 
             for idx, data in tqdm(enumerate(train_dataloader), desc=f"Training {epoch + 1}/{epochs}"):
@@ -182,6 +190,8 @@ class Trainer:
                 self.model,
                 valid_dataloader,
             )
+            # the cached decompositions hold the last validation covariances, which the next epoch doesn't reuse
+            eigen_cache.clear()
 
             # Calculate the average loss
             self.loss_valid_list.append(valid_loss.get("Overall"))
@@ -211,6 +221,13 @@ class Trainer:
         self.__finish_wandb()
         return self.model
 
+    @staticmethod
+    def __set_epoch(dataloader, epoch: int):
+        """Sets the epoch of a generated stream or of a batch sampler, so each epoch is shuffled differently."""
+        for source in (getattr(dataloader, "dataset", None), getattr(dataloader, "batch_sampler", None)):
+            if hasattr(source, "set_epoch"):
+                source.set_epoch(epoch)
+
     def __report_results(self, epoch, epoch_train_loss, epoch_train_acc, valid_loss, eigenregularization=None):
         result_txt = (f"[Epoch : {epoch + 1}/{self.training_params.get('epochs', 10)}]"
                       f" Train loss = {epoch_train_loss:.6f}, Validation loss = {valid_loss.get('Overall'):.6f}")
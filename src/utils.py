@@ -13,6 +13,12 @@ This script defines some helpful functions:
     * sum_of_diag_torch: returns the some of each diagonal in a given matrix, Pytorch oriented.
     * find_roots: solves polynomial equation defines by polynomial coefficients. 
     * find_roots_torch: solves polynomial equation defines by polynomial coefficients, Pytorch oriented.. 
+    * roots_closest_unit_circle: Selects the k roots inside the unit circle that are the closest to it.
+    * unitary_matrix: The sparse unitary matrix of the unitary transform of centro-Hermitian matrices.
+    * unitary_transform: Maps a batch of covariances to the real symmetric matrices of their forward-backward average.
+    * unitary_basis: Maps real vectors of the unitary transform domain back to the sensors domain.
+    * real_valued_subspace: Maps subspaces of the forward-backward averaged covariance to the real domain.
+    * autocorrelation_lags: Calculates the lagged autocorrelation matrices, the input of SubspaceNet.
     * set_unified_seed: Sets unified seed for all random attributed in the simulation.
     * get_k_angles: Retrieves the top-k angles from a prediction tensor.
     * get_k_peaks: Retrieves the top-k peaks (angles) from a prediction tensor using peak finding.
@@ -104,6 +110,38 @@ def sample_covariance(x: torch.Tensor) -> torch.Tensor:
     Rx = torch.einsum("bmt, btl -> bml", x, torch.conj(x).transpose(1, 2)) / samples_number
     return Rx
 
+def autocorrelation_lags(x: torch.Tensor, tau: int, dtype: torch.dtype = torch.complex128) -> torch.Tensor:
+    """
+    Calculates the empirical autocorrelation matrices of the centered samples for lags 0 to tau-1,
+    with the real and imaginary parts stacked, which is the input of SubspaceNet.
+    The samples are centered, cast and conjugated once, then each lag is a matmul over strided views of them,
+    batched over the samples and written directly into the real output.
+    The output is float32, the dtype of the SubspaceNet input, whatever the dtype of the computation.
+
+    Args:
+    -----
+        x (torch.Tensor): The complex input tensor of size [batch, N, T].
+        tau (int): The number of lags.
+        dtype (torch.dtype): The complex dtype of the lag products, torch.complex128 or the faster
+            torch.complex64. Defaults to torch.complex128.
+
+    Returns:
+    --------
+        Rx_tau (torch.Tensor): The float32 tensor of size [batch, tau, 2N, N].
+    """
+    if x.dim() == 2:
+        x = x[None, :, :]
+    batch_size, N, T = x.shape
+    center_x = (x - torch.mean(x, dim=-1, keepdim=True)).to(dtype)
+    center_x_h = center_x.conj().transpose(1, 2).resolve_conj()
+    Rx_tau = torch.empty(batch_size, tau, 2 * N, N, dtype=torch.float32, device=x.device)
+    for i in range(tau):
+        Rx_lag = torch.matmul(center_x[:, :, :T - i], center_x_h[:, i:])
+        Rx_lag /= T - i - 1
+        Rx_tau[:, i, :N] = torch.real(Rx_lag)
+        Rx_tau[:, i, N:] = torch.imag(Rx_lag)
+    return Rx_tau
+
 def spatial_smoothing_covariance(x: torch.Tensor):
     """
     Calculates the covariance matrix using spatial smoothing technique for each element in the batch.
@@ -151,41 +189,6 @@ def tops_covariance(x: torch.Tensor, number_of_bins: int=1):
     return Rx
 
 
-def keep_far_enough_points(tensor, M, D):
-    # # Calculate pairwise distances between columns
-    # distances = cdist(tensor.T, tensor.T, metric="euclidean")
-    #
-    # # Keep the first M columns as far enough points
-    # selected_cols = []
-    # for i in range(tensor.shape[1]):
-    #     if len(selected_cols) >= M:
-    #         break
-    #     if all(distances[i, col] >= D for col in selected_cols):
-    #         selected_cols.append(i)
-    #
-    # # Remove columns that are less than distance D from each other
-    # filtered_tensor = tensor[:, selected_cols]
-    # retrun filtered_tensor
-    ##############################################
-    # Extract x_coords (first dimension)
-    x_coords = tensor[0, :]
-
-    # Keep the first M columns that are far enough apart in x_coords
-    selected_cols = []
-    for i in range(tensor.shape[1]):
-        if len(selected_cols) >= M:
-            break
-        if i == 0:
-            selected_cols.append(i)
-            continue
-        if all(abs(x_coords[i] - x_coords[col]) >= D for col in selected_cols):
-            selected_cols.append(i)
-
-    # Select the columns that meet the distance criterion
-    filtered_tensor = tensor[:, selected_cols]
-
-    return filtered_tensor
-
 # Functions
 # def sum_of_diag(matrix: np.ndarray) -> list:
 def sum_of_diag(matrix: np.ndarray):
@@ -223,13 +226,16 @@ def sum_of_diag(matrix: np.ndarray):
 
 def sum_of_diags_torch(matrix: torch.Tensor):
     """Calculates the sum of diagonals in a square matrix.
-    equivalent sum_of_diag, but support Pytorch.
+    equivalent sum_of_diag, but support Pytorch, and a batch of matrices.
+    The diagonals of the whole batch are summed by a single index_add, each element is added to the sum of its
+    diagonal offset.
 
     Args:
-        matrix (torch.Tensor): Square matrix for which diagonals need to be summed.
+        matrix (torch.Tensor): Square matrix for which diagonals need to be summed, of size NxN or BxNxN.
 
     Returns:
-        torch.Tensor: A list containing the sums of all diagonals in the matrix, from left to right.
+        torch.Tensor: A list containing the sums of all diagonals in the matrix, from left to right,
+            of size 2N-1 or Bx(2N-1).
 
     Raises:
         None
@@ -241,13 +247,12 @@ def sum_of_diags_torch(matrix: torch.Tensor):
         >>> sum_of_diag(matrix)
             torch.tensor([7, 12, 15, 8, 3])
     """
-    diag_sum = []
-    diag_index = torch.linspace(
-        -matrix.shape[0] + 1, matrix.shape[0] - 1, 2 * matrix.shape[0] - 1, dtype=int
-    )
-    for idx in diag_index:
-        diag_sum.append(torch.sum(torch.diagonal(matrix, idx)))
-    return torch.stack(diag_sum, dim=0)
+    N = matrix.shape[-1]
+    positions = torch.arange(N, device=matrix.device)
+    # the offset of the diagonal of each element, shifted to start at 0
+    diag_index = (positions[None, :] - positions[:, None] + N - 1).flatten()
+    diag_sum = torch.zeros(*matrix.shape[:-2], 2 * N - 1, dtype=matrix.dtype, device=matrix.device)
+    return diag_sum.index_add(-1, diag_index, matrix.flatten(-2))
 
 
 # def find_roots(coefficients: list) -> np.ndarray:
@@ -281,13 +286,15 @@ def find_roots(coefficients: list):
 
 def find_roots_torch(coefficients: torch.Tensor):
     """Finds the roots of a polynomial defined by its coefficients.
-    equivalent to src.utils.find_roots, but support Pytorch.
+    equivalent to src.utils.find_roots, but support Pytorch, and a batch of polynomials, whose companion matrices
+    are solved by a single batched eigvals.
 
     Args:
-        coefficients (torch.Tensor): List of polynomial coefficients in descending order of powers.
+        coefficients (torch.Tensor): List of polynomial coefficients in descending order of powers,
+            of size L or BxL.
 
     Returns:
-        torch.Tensor: An array containing the roots of the polynomial.
+        torch.Tensor: An array containing the roots of the polynomial, of size L-1 or Bx(L-1).
 
     Raises:
         None
@@ -298,12 +305,127 @@ def find_roots_torch(coefficients: torch.Tensor):
         tensor([3., 2.])
 
     """
-    A = torch.diag(torch.ones(len(coefficients) - 2, dtype=coefficients.dtype), -1)
-    A[0, :] = -coefficients[1:] / coefficients[0]
+    degree = coefficients.shape[-1] - 1
+    first_row = -coefficients[..., 1:] / coefficients[..., :1]
+    # the companion matrix, the negated normalized coefficients above a shifted identity
+    shift = torch.eye(degree - 1, degree, dtype=coefficients.dtype, device=coefficients.device)
+    A = torch.cat((first_row.unsqueeze(-2), shift.expand(*coefficients.shape[:-1], degree - 1, degree)), dim=-2)
     roots = torch.linalg.eigvals(A)
     return roots
 
 
+def roots_closest_unit_circle(roots: torch.Tensor, k: int):
+    """Selects the k roots inside the unit circle that are the closest to it, for each polynomial of the batch.
+    A polynomial with less than k roots inside the unit circle is completed by its closest roots outside of it.
+
+    Args:
+        roots (torch.Tensor): The roots of the polynomials, of size BxL.
+        k (int): The number of roots to select.
+
+    Returns:
+        torch.Tensor: The selected roots, of size Bxk, sorted by their distance from the unit circle.
+    """
+    magnitude = torch.abs(roots)
+    inside = magnitude < 1
+    if (inside.sum(dim=1) < k).any():
+        warnings.warn(f"roots_closest_unit_circle: Less than {k} roots inside the unit circle,"
+                      f" taking roots outside of it instead.")
+    # the distance from the unit circle is at most 1 inside of it, so the roots outside come after them
+    distance = torch.abs(magnitude - 1) + torch.where(inside, 0, 2)
+    closest = torch.topk(distance, k, dim=1, largest=False).indices
+    return torch.gather(roots, 1, closest)
+
+
+def _unitary_scale(N: int, device=None) -> torch.Tensor:
+    """The scale of the rows of Q_N, 1 / sqrt(2) for the pairs of sensors and 1 for the middle one of an odd N."""
+    scale = torch.full((N,), 1 / np.sqrt(2), dtype=torch.float64, device=device)
+    if N % 2 == 1:
+        scale[N // 2] = 1
+    return scale
+
+
+def unitary_matrix(N: int, device=None) -> torch.Tensor:
+    """The sparse unitary matrix Q_N, left Pi-real (J Q_N^* = Q_N), of the unitary transform:
+        Q_2k = [[I, jI], [J, -jJ]] / sqrt(2), and Q_2k+1 = [[I, 0, jI], [0, sqrt(2), 0], [J, 0, -jJ]] / sqrt(2),
+    for I the identity and J the exchange matrix of size k.
+
+    Args:
+        N (int): The size of the matrix.
+        device: The device of the matrix. Defaults to the CPU.
+
+    Returns:
+        torch.Tensor: The complex matrix Q_N, of size NxN.
+    """
+    return unitary_basis(torch.eye(N, dtype=torch.float64, device=device))
+
+
+def unitary_transform(covariance: torch.Tensor) -> torch.Tensor:
+    """Maps the covariances R to Re(Q^H R Q) = Q^H R_fb Q, the real symmetric matrices of their forward-backward
+    averages R_fb = (R + J R^* J) / 2. Each column of Q has two nonzero elements, so the products are computed as
+    sums and differences of the columns and of the rows of the real and imaginary parts, in O(N^2) instead of O(N^3),
+    and scaled once at the end.
+
+    Args:
+        covariance (torch.Tensor): The Hermitian covariances, of size NxN or BxNxN.
+
+    Returns:
+        torch.Tensor: The real symmetric matrices, of the size of the covariances.
+    """
+    N = covariance.shape[-1]
+    half, last = N // 2, N - N // 2
+    real, imag = torch.real(covariance), torch.imag(covariance)
+    real_flipped, imag_flipped = real[..., last:].flip(-1), imag[..., last:].flip(-1)
+    # the real and the imaginary parts of R Q, the columns of the differences are multiplied by j
+    product_real = torch.cat([real[..., :half] + real_flipped, real[..., half:last],
+                              imag_flipped - imag[..., :half]], dim=-1)
+    product_imag = torch.cat([imag[..., :half] + imag_flipped, imag[..., half:last],
+                              real[..., :half] - real_flipped], dim=-1)
+    # the real part of Q^H (R Q), the rows of the differences are multiplied by -j
+    transformed = torch.cat([product_real[..., :half, :] + product_real[..., last:, :].flip(-2),
+                             product_real[..., half:last, :],
+                             product_imag[..., :half, :] - product_imag[..., last:, :].flip(-2)], dim=-2)
+    scale = _unitary_scale(N, covariance.device)
+    return transformed * (scale[:, None] * scale[None, :])
+
+
+def unitary_basis(vectors: torch.Tensor) -> torch.Tensor:
+    """Maps the real vectors V of the unitary transform domain to Q V, in the sensors domain.
+
+    Args:
+        vectors (torch.Tensor): The real vectors as columns, of size NxK or BxNxK.
+
+    Returns:
+        torch.Tensor: The complex vectors, of the size of the input.
+    """
+    N = vectors.shape[-2]
+    half, last = N // 2, N - N // 2
+    vectors = vectors.to(torch.float64)
+    real = torch.cat([vectors[..., :half, :], vectors[..., half:last, :], vectors[..., :half, :].flip(-2)], dim=-2)
+    imag = torch.cat([vectors[..., last:, :], torch.zeros_like(vectors[..., half:last, :]),
+                      -vectors[..., last:, :].flip(-2)], dim=-2)
+    return torch.complex(real, imag) * _unitary_scale(N, vectors.device)[:, None]
+
+
+def real_valued_subspace(subspace: torch.Tensor) -> torch.Tensor:
+    """Maps the orthonormal vectors E of a subspace of a forward-backward averaged covariance, as returned by
+    the real-valued subspace separation, to the real vectors Re(Q^H E) of the unitary transform domain.
+
+    Args:
+        subspace (torch.Tensor): The vectors as columns, of size NxK or BxNxK.
+
+    Returns:
+        torch.Tensor: The real vectors, of the size of the input.
+    """
+    N = subspace.shape[-2]
+    half, last = N // 2, N - N // 2
+    if not subspace.is_complex():
+        subspace = subspace.to(torch.complex128)
+    real, imag = torch.real(subspace), torch.imag(subspace)
+    vectors = torch.cat([real[..., :half, :] + real[..., last:, :].flip(-2), real[..., half:last, :],
+                         imag[..., :half, :] - imag[..., last:, :].flip(-2)], dim=-2)
+    return vectors * _unitary_scale(N, subspace.device)[:, None].to(vectors.dtype)
+
+
 def set_unified_seed(seed: int = 42):
     """
     Sets the seed value for random number generators in Python libraries.
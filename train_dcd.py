@@ -131,6 +131,7 @@ def train_dcd_music(*args, **kwargs):
             true_doa=TRAINING_PARAMS["true_doa_train"],
             true_range=TRAINING_PARAMS["true_range_train"],
             phase="train",
+            num_workers=TRAINING_PARAMS.get("num_workers", 1),
         )
     # Generate model configuration
     model_config = ModelGenerator()
@@ -215,6 +216,7 @@ def parse_arguments():
     parser.add_argument('-sp', "--step_size", type=int, help='Step size for schedular', default=step_size)
     parser.add_argument('-gm', "--gamma", type=float, help='Gamma value for schedular', default=gamma)
     parser.add_argument('-w', "--wandb", action="store_true", help='Use wandb', default=wandb_flag)
+    parser.add_argument('-cores', "--num_workers", type=int, help='Number of processes used for the dataset creation', default=1)
 
     return parser.parse_args()
 
@@ -258,7 +260,8 @@ if __name__ == "__main__":
         "true_range_train": None,  # if set, this range will be set to all samples in the train dataset
         "true_doa_test": None,  # if set, this doa will be set to all samples in the test dataset
         "true_range_test": None,  # if set, this range will be set to all samples in the train dataset
-        "use_wandb": args.wandb
+        "use_wandb": args.wandb,
+        "num_workers": args.num_workers,
     }
     simulation_commands = {
         "SAVE_TO_FILE": False,